@@ -0,0 +1,69 @@
+'''
+Compare the compiled content binding matcher with a linear scan
+over supported content bindings.
+
+Usage:
+
+    python benchmarks/bench_binding_matcher.py [--bindings 50] [--blocks 5000]
+'''
+import timeit
+import argparse
+
+from libtaxii import messages_11 as tm11
+
+from opentaxii.taxii.entities import ContentBindingEntity
+from opentaxii.taxii.utils import ContentBindingMatcher
+
+
+def linear_scan(supported_bindings, content_binding):
+
+    binding_id = content_binding.binding_id
+    subtype = content_binding.subtype_ids[0] if content_binding.subtype_ids else None
+
+    matches = [
+        ((supported.binding == binding_id) and (not supported.subtypes or subtype in supported.subtypes))
+        for supported in supported_bindings
+    ]
+
+    return any(matches)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bindings', type=int, default=50)
+    parser.add_argument('--blocks', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    supported = [
+        ContentBindingEntity('urn:example:binding:%d' % i,
+            subtypes=['urn:example:subtype:%d' % i] if i % 2 else [])
+        for i in range(args.bindings)
+    ]
+
+    blocks = []
+    for i in range(args.blocks):
+        binding = tm11.ContentBinding('urn:example:binding:%d' % (i % (args.bindings * 2)))
+        binding.subtype_ids.append('urn:example:subtype:%d' % (i % args.bindings))
+        blocks.append(binding)
+
+    matcher = ContentBindingMatcher(supported)
+
+    assert [linear_scan(supported, b) for b in blocks] == \
+            [matcher.matches(b) for b in blocks]
+
+    linear = min(timeit.repeat(lambda: [linear_scan(supported, b) for b in blocks],
+        number=1, repeat=args.repeat))
+
+    compiled = min(timeit.repeat(lambda: [matcher.matches(b) for b in blocks],
+        number=1, repeat=args.repeat))
+
+    print '%d blocks, %d supported bindings' % (args.blocks, args.bindings)
+    print '%-10s %10.2f ms' % ('linear', linear * 1000)
+    print '%-10s %10.2f ms' % ('compiled', compiled * 1000)
+
+
+if __name__ == '__main__':
+    main()
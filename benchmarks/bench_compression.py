@@ -0,0 +1,107 @@
+'''
+Compare database size and poll latency with and without content compression.
+
+Usage:
+
+    python benchmarks/bench_compression.py [--blocks 2000] [--page 100]
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from opentaxii.persistence import PersistenceManager
+from opentaxii.persistence.sqldb import SQLDatabaseAPI
+from opentaxii.taxii import entities
+from opentaxii.taxii.utils import get_utc_now
+
+STIX_BINDING = 'urn:stix.mitre.org:xml:1.1.1'
+
+INDICATOR = '''
+  <stix:Indicator id="example:indicator-%(i)d" timestamp="2015-03-16T00:00:00Z"
+        xsi:type="indicator:IndicatorType" version="2.1.1">
+    <indicator:Title>Malicious domain %(i)d</indicator:Title>
+    <indicator:Type xsi:type="stixVocabs:IndicatorTypeVocab-1.1">Domain Watchlist</indicator:Type>
+    <indicator:Observable id="example:Observable-%(i)d">
+      <cybox:Object id="example:Object-%(i)d">
+        <cybox:Properties xsi:type="DomainNameObj:DomainNameObjectType" type="FQDN">
+          <DomainNameObj:Value condition="Equals">bad-%(i)d.example.com</DomainNameObj:Value>
+        </cybox:Properties>
+      </cybox:Object>
+    </indicator:Observable>
+  </stix:Indicator>'''
+
+PACKAGE = '''<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:indicator="http://stix.mitre.org/Indicator-2"
+    xmlns:cybox="http://cybox.mitre.org/cybox-2"
+    xmlns:DomainNameObj="http://cybox.mitre.org/objects#DomainNameObject-1"
+    xmlns:stixVocabs="http://stix.mitre.org/default_vocabularies-1"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    id="example:Package-%(n)d" version="1.1.1">
+  <stix:Indicators>%(indicators)s
+  </stix:Indicators>
+</stix:STIX_Package>'''
+
+
+def make_package(n, indicators=20):
+    body = ''.join(INDICATOR % dict(i=n * indicators + i) for i in range(indicators))
+    return PACKAGE % dict(n=n, indicators=body)
+
+
+def run(path, compress, blocks, page_size):
+
+    api = SQLDatabaseAPI('sqlite:///%s' % path, create_tables=True)
+    manager = PersistenceManager(api)
+
+    collection = manager.create_collection(entities.CollectionEntity(
+        name='benchmark', accept_all_content=True, compress_content=compress))
+
+    batch = []
+    for n in range(blocks):
+        batch.append(entities.ContentBlockEntity(
+            content = make_package(n),
+            timestamp_label = get_utc_now(),
+            content_binding = entities.ContentBindingEntity(STIX_BINDING)))
+
+    started = time.time()
+    manager.create_content_blocks(batch, collections=[[collection]] * len(batch))
+    write_time = time.time() - started
+
+    started = time.time()
+    pages = 0
+    for offset in range(0, blocks, page_size):
+        manager.get_content_blocks(collection.id, offset=offset, limit=page_size)
+        pages += 1
+    poll_time = (time.time() - started) / pages
+
+    api.Session.remove()
+
+    return os.path.getsize(path), write_time, poll_time
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--page', type=int, default=100)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        print '%-12s %12s %12s %16s' % ('mode', 'db size, KB', 'write, s', 'poll page, ms')
+
+        for compress in (False, True):
+            path = os.path.join(directory, 'compress-%s.db' % compress)
+            size, write_time, poll_time = run(path, compress, args.blocks, args.page)
+
+            print '%-12s %12d %12.2f %16.2f' % ('zlib' if compress else 'plain',
+                    size / 1024, write_time, poll_time * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Compare latency of the first and the last poll result parts, paged with
+OFFSET and with result set cursors.
+
+Usage:
+
+    python benchmarks/bench_poll_parts.py [--blocks 50000] [--page 100]
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from opentaxii.persistence import PersistenceManager
+from opentaxii.persistence.sqldb import SQLDatabaseAPI
+from opentaxii.taxii import entities
+from opentaxii.taxii.utils import get_utc_now
+
+STIX_BINDING = 'urn:stix.mitre.org:xml:1.1.1'
+
+CONTENT = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="example:Package-%d"/>'
+
+
+def fill(manager, collection, blocks, batch_size=5000):
+
+    for start in range(0, blocks, batch_size):
+        batch = [entities.ContentBlockEntity(
+            content = CONTENT % n,
+            timestamp_label = get_utc_now(),
+            content_binding = entities.ContentBindingEntity(STIX_BINDING))
+            for n in range(start, min(start + batch_size, blocks))]
+
+        manager.create_content_blocks(batch, collections=[[collection]] * len(batch))
+
+
+def timed(func, *args, **kwargs):
+    started = time.time()
+    func(*args, **kwargs)
+    return time.time() - started
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=50000)
+    parser.add_argument('--page', type=int, default=100)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        api = SQLDatabaseAPI('sqlite:///%s' % os.path.join(directory, 'poll.db'),
+                create_tables=True)
+        manager = PersistenceManager(api)
+
+        collection = manager.create_collection(entities.CollectionEntity(
+            name='benchmark', accept_all_content=True))
+
+        fill(manager, collection, args.blocks)
+
+        last_offset = args.blocks - args.page
+
+        # Cursor of the part preceding the last one
+        before_last = manager.get_content_blocks(collection.id,
+                offset=last_offset - 1, limit=1)[0]
+        cursor = (before_last.date_created, before_last.id)
+
+        print '%-8s %16s %16s' % ('paging', 'first part, ms', 'last part, ms')
+
+        first = timed(manager.get_content_blocks, collection.id, limit=args.page)
+        last = timed(manager.get_content_blocks, collection.id,
+                offset=last_offset, limit=args.page)
+        print '%-8s %16.2f %16.2f' % ('offset', first * 1000, last * 1000)
+
+        last = timed(manager.get_content_blocks, collection.id, limit=args.page,
+                after=cursor)
+        print '%-8s %16.2f %16.2f' % ('cursor', first * 1000, last * 1000)
+
+        api.Session.remove()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''
+Compare serialization time of a poll response by libtaxii and by the
+template-based writer.
+
+Usage:
+
+    python benchmarks/bench_serialization.py [--blocks 1000] [--rounds 5]
+'''
+import time
+import argparse
+
+import libtaxii.messages_11 as tm11
+
+from opentaxii.taxii import entities
+from opentaxii.taxii.converters import content_block_entity_to_content_block
+from opentaxii.taxii.serialization import message_to_xml
+from opentaxii.taxii.utils import get_utc_now
+
+STIX_BINDING = 'urn:stix.mitre.org:xml:1.1.1'
+
+INDICATOR = '''<stix:Indicator id="example:indicator-%(i)d" timestamp="2015-03-16T00:00:00Z"
+        xsi:type="indicator:IndicatorType" version="2.1.1">
+    <indicator:Title>Malicious domain %(i)d</indicator:Title>
+  </stix:Indicator>'''
+
+PACKAGE = '''<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:indicator="http://stix.mitre.org/Indicator-2"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    id="example:Package-%(n)d" version="1.1.1">
+  <stix:Indicators>%(indicators)s
+  </stix:Indicators>
+</stix:STIX_Package>'''
+
+
+def make_package(n, indicators=20):
+    body = ''.join(INDICATOR % dict(i=n * indicators + i) for i in range(indicators))
+    return PACKAGE % dict(n=n, indicators=body)
+
+
+def make_response(blocks):
+    response = tm11.PollResponse(message_id='1', in_response_to='2',
+            collection_name='benchmark', record_count=tm11.RecordCount(blocks, False))
+
+    for n in range(blocks):
+        entity = entities.ContentBlockEntity(content=make_package(n),
+                timestamp_label=get_utc_now(),
+                content_binding=entities.ContentBindingEntity(STIX_BINDING))
+        response.content_blocks.append(content_block_entity_to_content_block(entity, 11))
+
+    return response
+
+
+def timed(rounds, blocks, serialize):
+    elapsed = 0
+    for _ in range(rounds):
+        # Responses are built every round, libtaxii parses stored content once
+        response = make_response(blocks)
+        started = time.time()
+        serialize(response)
+        elapsed += time.time() - started
+    return elapsed / rounds
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    print '%-10s %16s' % ('writer', 'response, ms')
+
+    for name, serialize in [
+            ('libtaxii', lambda r: r.to_xml()),
+            ('template', lambda r: message_to_xml(r))]:
+
+        print '%-10s %16.2f' % (name, timed(args.rounds, args.blocks, serialize) * 1000)
+
+
+if __name__ == '__main__':
+    main()
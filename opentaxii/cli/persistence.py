@@ -1,10 +1,162 @@
+import sys
+import argparse
 import structlog
 
-from .config import ServerConfig
-from .utils import configure_logging
+from libtaxii.constants import CB_STIX_XML_111
+
+from opentaxii.config import ServerConfig
+from opentaxii.loader import ContentLoader
+from opentaxii.server import create_server
+from opentaxii.utils import configure_logging
 
 config = ServerConfig()
 configure_logging(config.get('logging'), plain=True)
 
 log = structlog.getLogger(__name__)
 
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description = "OpenTAXII CLI tools",
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+    return parser
+
+
+def deduplicate_content():
+
+    parser = get_parser()
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+            help="Amount of content blocks processed in one transaction")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+    total = server.persistence.deduplicate_content(batch_size=args.batch_size)
+
+    log.info("Content deduplicated", blocks=total)
+
+
+def compress_content():
+
+    parser = get_parser()
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+            help="Amount of content payloads processed in one transaction")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+    total = server.persistence.compress_content(batch_size=args.batch_size)
+
+    log.info("Content compressed", payloads=total)
+
+
+def backfill_timeline():
+
+    parser = get_parser()
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+            help="Amount of timeline entries added in one transaction")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+    total = server.persistence.backfill_timeline(batch_size=args.batch_size)
+
+    log.info("Collection timeline filled", entries=total)
+
+
+def rebuild_statistics():
+
+    parser = get_parser()
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+            help="Amount of collection links read at once")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+    total = server.persistence.rebuild_statistics(batch_size=args.batch_size)
+
+    log.info("Collection statistics rebuilt", entries=total)
+
+
+def upgrade_database():
+
+    parser = get_parser()
+    parser.add_argument("-c", "--collection",
+            help="Name of the collection to explain poll queries for")
+    parser.add_argument("--offline", action="store_true",
+            help="Build indexes with the default locking of the database")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+
+    collection_id = None
+    if args.collection:
+        collections = dict((c.name, c) for c in server.persistence.get_collections())
+        if args.collection not in collections:
+            parser.error("Unknown collection: %s" % args.collection)
+        collection_id = collections[args.collection].id
+
+    try:
+        print_query_plans(server.persistence, collection_id, "before")
+    except Exception:
+        # Queries may use columns the upgrade is about to add
+        log.warning("Query plans not available before the upgrade", exc_info=True)
+
+    server.persistence.upgrade_tables(online=not args.offline)
+
+    print_query_plans(server.persistence, collection_id, "after")
+
+    log.info("Database upgraded")
+
+
+def print_query_plans(persistence, collection_id, stage):
+
+    for name, plan in persistence.explain_content_queries(collection_id=collection_id):
+        sys.stdout.write("-- %s query plan, %s upgrade\n" % (name, stage))
+        for line in plan:
+            sys.stdout.write("%s\n" % line)
+        sys.stdout.write("\n")
+
+
+def load_content():
+
+    parser = get_parser()
+    parser.add_argument("paths", nargs="+", metavar="path",
+            help="Directory, tarball, XML or ndjson file to load")
+    parser.add_argument("-c", "--collection", action="append", required=True,
+            dest="collections", help="Name of the collection to attach content to")
+    parser.add_argument("--binding", default=CB_STIX_XML_111,
+            help="Content binding of the loaded content")
+    parser.add_argument("--subtype", help="Content binding subtype of the loaded content")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+            help="Amount of parsing processes")
+    parser.add_argument("-b", "--batch-size", type=int, default=5000,
+            help="Amount of content blocks written in one transaction")
+    parser.add_argument("--checkpoint",
+            help="File to keep the progress in, to resume an interrupted load")
+    parser.add_argument("--signals", action="store_true",
+            help="Send a signal for every loaded content block")
+
+    args = parser.parse_args()
+
+    server = create_server(config)
+
+    collections = dict((c.name, c) for c in server.persistence.get_collections())
+    missing = [name for name in args.collections if name not in collections]
+    if missing:
+        parser.error("Unknown collections: %s" % ", ".join(missing))
+
+    loader = ContentLoader(server.persistence,
+            collections = [collections[name] for name in args.collections],
+            binding = args.binding,
+            subtype = args.subtype,
+            workers = args.workers,
+            batch_size = args.batch_size,
+            checkpoint = args.checkpoint,
+            signals = args.signals)
+
+    loaded, failed = loader.load(args.paths)
+
+    log.info("Content loaded", blocks=loaded, failed=failed)
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import pytz
+import tarfile
+import itertools
+import structlog
+
+from lxml import etree
+from libtaxii.common import get_xml_parser, parse_datetime_string
+from libtaxii.constants import CB_STIX_XML_111
+
+from .taxii.entities import ContentBlockEntity, ContentBindingEntity
+from .taxii.pipeline import WorkerPool, POOL_PROCESS, batches
+from .taxii.utils import get_utc_now
+
+log = structlog.getLogger(__name__)
+
+XML = 'xml'
+NDJSON = 'ndjson'
+
+EXTENSIONS = {
+    '.xml' : XML,
+    '.ndjson' : NDJSON,
+    '.jsonl' : NDJSON,
+}
+
+
+def get_kind(name):
+    return EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+
+def iter_file_records(kind, f, source, offset=None):
+    '''
+    Yield `(kind, data, position)` records of a file object, `position`
+    being a tuple `(source, offset)` of the end of the record. ndjson files
+    are read line by line, only XML files are read whole.
+
+    If `offset` is set, the file was loaded up to it: ndjson files are
+    read from the offset on and XML files are skipped.
+    '''
+
+    if kind == NDJSON:
+        if offset:
+            f.seek(offset)
+        offset = offset or 0
+
+        for line in iter(f.readline, ''):
+            offset += len(line)
+            if line.strip():
+                yield NDJSON, line, (source, offset)
+
+    elif offset is None:
+        data = f.read()
+        yield XML, data, (source, len(data))
+
+
+def iter_input_files(path):
+    '''
+    Yield `(source, kind, file)` for the files of an input, in a stable
+    order. `source` names the file within the input.
+
+    An input is a directory, a tarball, an XML file with one content block
+    or an ndjson file with a JSON object per line. Directories and tarballs
+    are searched for XML and ndjson files, other files are ignored.
+    '''
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                kind = get_kind(name)
+                if kind:
+                    file_path = os.path.join(root, name)
+                    with open(file_path, 'rb') as f:
+                        yield os.path.relpath(file_path, path), kind, f
+
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            for member in tar:
+                kind = get_kind(member.name)
+                if member.isfile() and kind:
+                    yield member.name, kind, tar.extractfile(member)
+
+    else:
+        with open(path, 'rb') as f:
+            yield '', get_kind(path) or XML, f
+
+
+def iter_records(path, start=None):
+    '''
+    Yield `(kind, data, position)` records of an input, in a stable order.
+
+    `start` is a position of a record returned before. Records up to it
+    are skipped without being read: files before it in the input are
+    passed over and its file is read from the offset on.
+    '''
+
+    resume_source, resume_offset = start or (None, None)
+
+    for source, kind, f in iter_input_files(path):
+
+        offset = None
+
+        if resume_source is not None:
+            if source != resume_source:
+                continue
+            resume_source, offset = None, resume_offset
+
+        for record in iter_file_records(kind, f, source, offset=offset):
+            yield record
+
+
+def parse_record(task):
+    '''
+    Convert a record into a content block entity. Takes a tuple
+    `(kind, data, binding, subtype)` and returns a tuple `(entity, error)`.
+
+    ndjson records are objects with `content` and optional `binding`,
+    `subtype` and `timestamp` fields.
+    '''
+
+    kind, data, binding, subtype = task
+    timestamp = None
+
+    try:
+        if kind == NDJSON:
+            record = json.loads(data)
+            content = record['content']
+            binding = record.get('binding', binding)
+            subtype = record.get('subtype', subtype)
+            if record.get('timestamp'):
+                timestamp = parse_datetime_string(record['timestamp'])
+        else:
+            content = data.decode('utf-8')
+
+        # Only well-formed XML is loaded
+        etree.fromstring(content.encode('utf-8'), get_xml_parser())
+
+    except (ValueError, KeyError, etree.XMLSyntaxError), e:
+        return None, '%s: %s' % (e.__class__.__name__, e)
+
+    if timestamp and not timestamp.tzinfo:
+        timestamp = timestamp.replace(tzinfo=pytz.UTC)
+
+    return ContentBlockEntity(
+        content = content,
+        timestamp_label = timestamp or get_utc_now(),
+        content_binding = ContentBindingEntity(binding, subtypes=[subtype] if subtype else [])
+    ), None
+
+
+class ContentLoader(object):
+    '''
+    Bulk loader of content blocks into collections.
+
+    Records are parsed in a pool of worker processes and written in
+    transactions of `batch_size` blocks. If `checkpoint` is set, the amount
+    of records processed for every input and the position of the last one
+    are saved to this file after every transaction. Inputs are resumed
+    from the saved positions.
+
+    :param persistence: :class:`opentaxii.persistence.PersistenceManager` instance
+    :param collections: list of collection entities to attach blocks to
+    :param binding=CB_STIX_XML_111: content binding of the blocks
+    :param subtype=None: content binding subtype of the blocks
+    :param workers=0: amount of worker processes, 0 parses in this process
+    :param batch_size=5000: amount of blocks written in one transaction
+    :param checkpoint=None: path to the checkpoint file
+    :param signals=False: if True, `POST_SAVE_CONTENT_BLOCK` signal is sent
+                          for every block
+    '''
+
+    def __init__(self, persistence, collections, binding=CB_STIX_XML_111, subtype=None,
+            workers=0, batch_size=5000, checkpoint=None, signals=False):
+
+        self.persistence = persistence
+        self.collections = collections
+
+        self.binding = binding
+        self.subtype = subtype
+
+        self.pool = WorkerPool(workers=workers, pool_type=POOL_PROCESS)
+        self.batch_size = batch_size
+
+        self.checkpoint = checkpoint
+        self.signals = signals
+
+        self.progress = self.load_checkpoint()
+
+        self.loaded = 0
+        self.failed = 0
+
+
+    def load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        return {}
+
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.progress, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.checkpoint)
+
+
+    def load(self, paths):
+        '''
+        Load all inputs. Returns a tuple `(loaded, failed)` with the amounts
+        of blocks loaded and records that could not be parsed.
+        '''
+
+        started = time.time()
+
+        try:
+            for path in paths:
+                self.load_input(path, started)
+        finally:
+            self.pool.stop()
+
+        log.info("Content loading finished", loaded=self.loaded, failed=self.failed,
+                elapsed=time.time() - started)
+
+        return self.loaded, self.failed
+
+
+    def load_input(self, path, started):
+
+        key = os.path.abspath(path)
+        state = self.progress.get(key)
+
+        if state:
+            done, start = state['records'], tuple(state['position'])
+            log.info("Resuming input", source=path, skipped=done,
+                    file=start[0], offset=start[1])
+        else:
+            done, start = 0, None
+
+        for batch in batches(iter_records(path, start=start), self.batch_size):
+
+            tasks = [(kind, data, self.binding, self.subtype) for kind, data, _ in batch]
+
+            blocks = []
+            for (entity, error), position in zip(self.pool.map(parse_record, tasks),
+                    itertools.count(done)):
+                if error:
+                    log.warning("Record skipped", source=path, position=position,
+                            error=error)
+                    self.failed += 1
+                else:
+                    blocks.append(entity)
+
+            if blocks:
+                self.persistence.create_content_blocks(blocks,
+                        collections=[self.collections] * len(blocks),
+                        signals=self.signals)
+
+            done += len(batch)
+            self.loaded += len(blocks)
+
+            self.progress[key] = dict(records=done, position=batch[-1][2])
+            self.save_checkpoint()
+
+            elapsed = time.time() - started
+            log.info("Content loaded", source=path, position=done, loaded=self.loaded,
+                    failed=self.failed, blocks_per_second=int(self.loaded / elapsed) if elapsed else None)
@@ -1,11 +1,15 @@
 import structlog
 from functools import wraps
-from flask import Flask, request, make_response
+from flask import (
+    Flask, Response, request, current_app, make_response, stream_with_context
+)
 
 from .taxii.exceptions import (
     raise_failure, StatusMessageException, FailureStatus, UnauthorizedStatus
 )
 from .taxii.utils import parse_message
+from .taxii.streaming import StreamedMessage
+from .taxii.serialization import message_to_xml
 from .taxii.status import process_status_exception
 from .taxii.bindings import (
     MESSAGE_BINDINGS, SERVICE_BINDINGS, ALL_PROTOCOL_BINDINGS
@@ -50,6 +54,8 @@ def service_wrapper(service):
     @wraps(service.process)
     def wrapper(*args, **kwargs):
 
+        account = None
+
         if service.authentication_required:
             token = extract_token(request.headers)
             if not token:
@@ -58,36 +64,97 @@ def service_wrapper(service):
             if not account:
                 raise UnauthorizedStatus()
 
+        limiter = service.rate_limiter
+        limit_key = get_rate_limit_key(service, account)
+
         if 'application/xml' not in request.accept_mimetypes:
             raise_failure("The specified values of Accept is not supported: %s" % (request.accept_mimetypes or []))
 
         validate_request_headers(request.headers, MESSAGE_BINDINGS)
 
-        body = request.data
+        if service.max_body_size and request.content_length > service.max_body_size:
+            raise_failure("Request body exceeds maximum allowed size of %d bytes"
+                    % service.max_body_size)
 
-        taxii_message = parse_message(get_content_type(request.headers), body)
-        try:
+        if limiter:
+            limiter.acquire(limit_key, requests=1, bytes=request.content_length or 0)
+
+        if service.streaming:
             validate_request_headers_post_parse(request.headers,
                     supported_message_bindings=MESSAGE_BINDINGS,
                     service_bindings=SERVICE_BINDINGS,
                     protocol_bindings=ALL_PROTOCOL_BINDINGS)
-        except StatusMessageException, e:
-            e.in_response_to = taxii_message.message_id
-            raise e
 
-        response_message = service.process(request.headers, taxii_message)
+            response_message = service.process_stream(request.headers,
+                    get_content_type(request.headers), request.stream,
+                    account=account, limit_key=limit_key)
+        else:
+            response_message = process_message(service, limit_key, account=account)
 
         response_headers = get_http_headers(response_message.version, request.is_secure)
         validate_response_headers(response_headers)
 
-        # FIXME: pretty-printing should be configurable
-        taxii_xml = response_message.to_xml(pretty_print=True)
+        if isinstance(response_message, StreamedMessage):
+            taxii_xml = stream_with_context(stream_message(response_message,
+                service.server.pretty_print, limiter, limit_key))
+
+            return make_taxii_response(Response(taxii_xml), response_headers)
+
+        if limiter:
+            # Content blocks sent back, e.g. in poll responses, delay the following requests
+            limiter.charge(limit_key,
+                    blocks=len(getattr(response_message, 'content_blocks', None) or []))
+
+        taxii_xml = message_to_xml(response_message,
+                pretty_print=service.server.pretty_print)
 
         return make_taxii_response(taxii_xml, response_headers)
 
     return wrapper
 
 
+def stream_message(message, pretty_print=False, limiter=None, limit_key=None):
+
+    for fragment in message.iter_xml(pretty_print=pretty_print):
+        yield fragment
+
+    if limiter:
+        limiter.charge(limit_key, blocks=message.blocks_written)
+
+
+def get_rate_limit_key(service, account):
+    # Anonymous clients are told apart by their address
+    client = 'account-%s' % account['id'] if account else 'address-%s' % request.remote_addr
+    return '%s:%s' % (service.id, client)
+
+
+def process_message(service, limit_key=None, account=None):
+
+    body = request.data
+
+    taxii_message = parse_message(get_content_type(request.headers), body,
+            envelope_only=service.validate_envelope_only)
+    try:
+        validate_request_headers_post_parse(request.headers,
+                supported_message_bindings=MESSAGE_BINDINGS,
+                service_bindings=SERVICE_BINDINGS,
+                protocol_bindings=ALL_PROTOCOL_BINDINGS)
+    except StatusMessageException, e:
+        e.in_response_to = taxii_message.message_id
+        raise e
+
+    if service.rate_limiter:
+        service.rate_limiter.acquire(limit_key, in_response_to=taxii_message.message_id,
+                blocks=len(getattr(taxii_message, 'content_blocks', None) or []))
+
+    if service.accepts_request_details:
+        kwargs = dict(raw_message=body, account=account)
+    else:
+        kwargs = {}
+
+    return service.process(request.headers, taxii_message, **kwargs)
+
+
 def make_taxii_response(taxii_xml, taxii_headers):
 
     validate_response_headers(taxii_headers)
@@ -106,7 +173,8 @@ def handle_status_exception(error):
     if 'application/xml' not in request.accept_mimetypes:
         return 'Unacceptable', 406
 
-    xml, headers = process_status_exception(error, request.headers, request.is_secure)
+    xml, headers = process_status_exception(error, request.headers, request.is_secure,
+            pretty_print=current_app.taxii.pretty_print)
     return make_taxii_response(xml, headers)
 
 
@@ -118,6 +186,7 @@ def handle_internal_error(error):
 
     new_error = FailureStatus("Error occured", e=error)
 
-    xml, headers = process_status_exception(new_error, request.headers, request.is_secure)
+    xml, headers = process_status_exception(new_error, request.headers, request.is_secure,
+            pretty_print=current_app.taxii.pretty_print)
     return make_taxii_response(xml, headers)
 
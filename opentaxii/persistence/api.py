@@ -22,18 +22,56 @@ class OpenTAXIIPersistenceAPI(object):
     def create_inbox_message(self, inbox_message_entity): 
         raise NotImplementedError()
 
+    def update_inbox_message(self, inbox_message_entity):
+        raise NotImplementedError()
+
+    def get_inbox_message(self, idempotency_key):
+        raise NotImplementedError()
+
+    def claim_inbox_message(self, idempotency_key, lease):
+        raise NotImplementedError()
+
+    def release_inbox_message(self, entity):
+        raise NotImplementedError()
+
     def create_content_block(self, content_block_entity): 
         raise NotImplementedError()
 
+    def create_content_blocks(self, content_block_entities, collections_ids):
+        raise NotImplementedError()
+
     def attach_content_to_collections(self, content_block_id, collections_ids): 
         raise NotImplementedError()
 
+    def deduplicate_content(self, batch_size=1000):
+        raise NotImplementedError()
+
+    def compress_content(self, batch_size=1000):
+        raise NotImplementedError()
+
+    def backfill_timeline(self, batch_size=1000):
+        raise NotImplementedError()
+
+    def rebuild_statistics(self, batch_size=1000):
+        raise NotImplementedError()
+
+    def upgrade_tables(self, online=False):
+        raise NotImplementedError()
+
+    def explain_content_queries(self, collection_id=None, bindings=[]):
+        raise NotImplementedError()
+
     def get_content_blocks_count(self, collection_id, start_time=None,
-            end_time=None, bindings=[]):
+            end_time=None, bindings=[], until=None):
         raise NotImplementedError()
 
     def get_content_blocks(self, collection_id, start_time=None, end_time=None,
-            bindings=[], offset=0, limit=10):
+            bindings=[], offset=0, limit=10, after=None, until=None):
+        raise NotImplementedError()
+
+    def iter_content_blocks(self, collection_id, start_time=None, end_time=None,
+            bindings=[], offset=0, limit=None, after=None, until=None,
+            batch_size=100):
         raise NotImplementedError()
 
     def create_result_set(self, result_set_entity):
@@ -42,6 +80,27 @@ class OpenTAXIIPersistenceAPI(object):
     def get_result_set(self, result_set_id):
         raise NotImplementedError()
 
+    def get_result_set_cursor(self, result_set_id, part_number):
+        raise NotImplementedError()
+
+    def update_result_set_cursor(self, result_set_id, part_number, cursor):
+        raise NotImplementedError()
+
+    def get_high_water_mark(self, collection_id):
+        raise NotImplementedError()
+
+    def claim_result_set(self, result_set_id, lease):
+        raise NotImplementedError()
+
+    def release_result_set(self, result_set_id):
+        raise NotImplementedError()
+
+    def materialize_result_set(self, result_set_id, batch_size=1000):
+        raise NotImplementedError()
+
+    def get_result_set_blocks(self, result_set_id, offset=0, limit=10):
+        raise NotImplementedError()
+
     def create_subscription(self, subscription_entity, service_id=None):
         raise NotImplementedError()
 
@@ -1,3 +1,7 @@
 
 class ResultsNotReady(Exception):
     pass
+
+
+class DuplicateInboxMessage(Exception):
+    pass
@@ -1,7 +1,7 @@
 
 from blinker import signal
 
-from ..signals import POST_SAVE_CONTENT_BLOCK
+from ..signals import POST_SAVE_CONTENT_BLOCK, POST_SAVE_COLLECTION
 
 
 class PersistenceManager(object):
@@ -15,7 +15,35 @@ class PersistenceManager(object):
         return self.api.create_service(entity)
 
     def attach_collection_to_services(self, collection_id, services_ids):
-        return self.api.attach_collection_to_services(collection_id, services_ids)
+        result = self.api.attach_collection_to_services(collection_id, services_ids)
+
+        signal(POST_SAVE_COLLECTION).send(self, collection_id=collection_id,
+                service_ids=services_ids)
+
+        return result
+
+    def deduplicate_content(self, batch_size=1000):
+        return self.api.deduplicate_content(batch_size=batch_size)
+
+    def compress_content(self, batch_size=1000):
+        return self.api.compress_content(batch_size=batch_size)
+
+    def backfill_timeline(self, batch_size=1000):
+        return self.api.backfill_timeline(batch_size=batch_size)
+
+    def rebuild_statistics(self, batch_size=1000):
+        return self.api.rebuild_statistics(batch_size=batch_size)
+
+    def upgrade_tables(self, online=False):
+        return self.api.upgrade_tables(online=online)
+
+    def explain_content_queries(self, collection_id=None, bindings=[]):
+        '''
+        Return query plans of the queries run by polls, as a list of
+        `(name, plan)` tuples with plans as lists of lines.
+        '''
+        return self.api.explain_content_queries(collection_id=collection_id,
+                bindings=bindings)
 
     # ====
 
@@ -33,43 +61,88 @@ class PersistenceManager(object):
         return self.api.get_collection(name, service_id)
 
     def create_collection(self, entity):
-        return self.api.create_collection(entity)
+        collection = self.api.create_collection(entity)
+
+        # Collection may be attached to any service
+        signal(POST_SAVE_COLLECTION).send(self, collection_id=collection.id,
+                service_ids=None)
+
+        return collection
 
     def create_inbox_message(self, entity):
         return self.api.create_inbox_message(entity)
 
+    def update_inbox_message(self, entity):
+        return self.api.update_inbox_message(entity)
+
+    def get_inbox_message(self, idempotency_key):
+        return self.api.get_inbox_message(idempotency_key)
+
+    def claim_inbox_message(self, idempotency_key, lease):
+        '''
+        Take over an incomplete inbox message not updated for `lease`
+        seconds. Returns None if the message is completed or still being
+        stored by another request.
+        '''
+        return self.api.claim_inbox_message(idempotency_key, lease)
+
+    def release_inbox_message(self, message):
+        return self.api.release_inbox_message(message)
+
     def create_content(self, content, service_id=None, inbox_message=None,
             collections=[]):
 
+        return self.create_content_blocks([content], inbox_message=inbox_message,
+                collections=[collections])[0]
+
+    def create_content_blocks(self, blocks, inbox_message=None, collections=[],
+            signals=True):
+        '''
+        Persist all content blocks at once, in a single transaction.
+
+        `collections` is a list of the same length as `blocks`, holding
+        the list of collections each content block should be attached to.
+        If `signals` is False, `POST_SAVE_CONTENT_BLOCK` is not sent.
+        '''
+
         if inbox_message:
             if not inbox_message.id:
                 inbox_message = self.api.create_inbox_message(inbox_message)
-            content.inbox_message_id = inbox_message.id
+            for block in blocks:
+                block.inbox_message_id = inbox_message.id
 
-        content = self.api.create_content_block(content)
+        collections = collections or [[]] * len(blocks)
+        collections_ids = [[c.id for c in colls] for colls in collections]
 
-        collection_ids = [c.id for c in collections]
+        blocks = self.api.create_content_blocks(blocks, collections_ids)
 
-        if collection_ids:
-            self.api.attach_content_to_collections(content, collection_ids)
+        if not signals:
+            return blocks
 
-        signal(POST_SAVE_CONTENT_BLOCK).send(self, content_block=content,
-                collection_ids=collection_ids)
+        for block, ids in zip(blocks, collections_ids):
+            signal(POST_SAVE_CONTENT_BLOCK).send(self, content_block=block,
+                    collection_ids=ids)
 
-        return content
+        return blocks
 
     def get_content_blocks_count(self, collection_id, start_time=None, end_time=None,
-            bindings=[]):
+            bindings=[], until=None):
 
         return self.api.get_content_blocks_count(
             collection_id = collection_id,
             start_time = start_time,
             end_time = end_time,
             bindings = bindings,
+            until = until,
         )
 
     def get_content_blocks(self, collection_id, start_time=None, end_time=None,
-            bindings=[], offset=0, limit=10):
+            bindings=[], offset=0, limit=10, after=None, until=None):
+        '''
+        Get content blocks ordered by creation. `after` and `until` are
+        `(date_created, id)` cursors: blocks up to `after` are skipped and
+        blocks past `until` are not visible.
+        '''
 
         return self.api.get_content_blocks(
             collection_id = collection_id,
@@ -78,6 +151,27 @@ class PersistenceManager(object):
             bindings = bindings,
             offset = offset,
             limit = limit,
+            after = after,
+            until = until,
+        )
+
+    def iter_content_blocks(self, collection_id, start_time=None, end_time=None,
+            bindings=[], offset=0, limit=None, after=None, until=None, batch_size=100):
+        '''
+        Generator of content blocks, ordered like :meth:`get_content_blocks`.
+        Blocks are read from the database in batches of `batch_size`.
+        '''
+
+        return self.api.iter_content_blocks(
+            collection_id = collection_id,
+            start_time = start_time,
+            end_time = end_time,
+            bindings = bindings,
+            offset = offset,
+            limit = limit,
+            after = after,
+            until = until,
+            batch_size = batch_size,
         )
 
 
@@ -87,6 +181,52 @@ class PersistenceManager(object):
     def get_result_set(self, result_set_id):
         return self.api.get_result_set(result_set_id)
 
+    def get_result_set_cursor(self, result_set_id, part_number):
+        '''
+        Get the cursor of the closest stored part preceding `part_number`
+        in the result set.
+
+        :return: tuple `(part_number, cursor)`, `(0, None)` if no
+                 preceding part is stored
+        '''
+        return self.api.get_result_set_cursor(result_set_id, part_number)
+
+    def update_result_set_cursor(self, result_set_id, part_number, cursor):
+        return self.api.update_result_set_cursor(result_set_id, part_number, cursor)
+
+    def get_high_water_mark(self, collection_id):
+        '''
+        Return the `(date_created, id)` cursor of the last content block
+        of a collection, None if the collection is empty.
+        '''
+        return self.api.get_high_water_mark(collection_id)
+
+    def claim_result_set(self, result_set_id, lease):
+        '''
+        Claim a result set to be materialized by this worker. Returns
+        False if it is ready or claimed by another worker less than
+        `lease` seconds ago.
+        '''
+        return self.api.claim_result_set(result_set_id, lease)
+
+    def release_result_set(self, result_set_id):
+        return self.api.release_result_set(result_set_id)
+
+    def materialize_result_set(self, result_set_id, batch_size=1000):
+        '''
+        Write the snapshot of a result set: IDs of all content blocks
+        matching it, in the order they are served. The result set is
+        marked ready and the amount of blocks is returned.
+        '''
+        return self.api.materialize_result_set(result_set_id, batch_size=batch_size)
+
+    def get_result_set_blocks(self, result_set_id, offset=0, limit=10):
+        '''
+        Get content blocks of a materialized result set by their
+        positions in the snapshot.
+        '''
+        return self.api.get_result_set_blocks(result_set_id, offset=offset, limit=limit)
+
     def create_subscription(self, subscription, service_id=None):
         return self.api.create_subscription(subscription, service_id=service_id)
 
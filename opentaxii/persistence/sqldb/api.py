@@ -1,9 +1,18 @@
 import json
+import zlib
+import hashlib
+import pytz
 import structlog
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
 from sqlalchemy import orm, engine
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, exists, bindparam, func, literal_column
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.engine import reflection
+from sqlalchemy.exc import IntegrityError
 
 from opentaxii.persistence import OpenTAXIIPersistenceAPI
+from opentaxii.persistence.exceptions import DuplicateInboxMessage
 
 from . import models
 from . import converters as conv
@@ -12,6 +21,12 @@ __all__ = ['SQLDatabaseAPI']
 
 log = structlog.getLogger(__name__)
 
+# SQLite does not allow more than 999 parameters in a single statement
+MAX_BOUND_PARAMETERS = 500
+
+# Time span of a bucket of the collection histogram
+BUCKET_SIZE = timedelta(hours=1)
+
 
 class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
     """
@@ -23,10 +38,37 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
                           connection arguments that will be passed directly
                           to :func:`~sqlalchemy.engine.create_engine` method.
 
-    :param create_tables=False: if True, tables will be created in the DB.
+    :param create_tables=False: if True, missing tables and columns will be
+                                created in the DB. Indexes of existing
+                                tables that are only needed for performance
+                                are created by :meth:`upgrade_tables`.
+
+    :param compression_level=6: zlib compression level used for content
+                                of collections with enabled compression
+                                and for compressed inbox messages.
+
+    :param compression_min_size=1024: content shorter than this amount of
+                                      bytes is never compressed.
+
+    :param use_timeline=False: if True, poll queries of a collection read
+                               the collection timeline table. The timeline
+                               of existing content has to be filled with
+                               :meth:`backfill_timeline` first.
+
+    :param use_statistics=False: if True, content of a collection is counted
+                                 with the collection counters and histogram.
+                                 Statistics of existing content have to be
+                                 built with :meth:`rebuild_statistics` first.
     """
 
-    def __init__(self, db_connection, create_tables=False):
+    def __init__(self, db_connection, create_tables=False, compression_level=6,
+            compression_min_size=1024, use_timeline=False, use_statistics=False):
+
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+
+        self.use_timeline = use_timeline
+        self.use_statistics = use_statistics
 
         self.engine = engine.create_engine(db_connection, convert_unicode=True)
 
@@ -38,13 +80,130 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         self.Base.query = self.Session.query_property()
 
         if create_tables:
-            self.create_tables()
+            self.upgrade_tables(indexes=False)
 
 
     def create_tables(self):
         self.Base.metadata.create_all(bind=self.engine)
 
 
+    def upgrade_tables(self, online=False, indexes=True):
+        '''
+        Create missing tables, add missing columns and indexes
+        to existing tables.
+
+        Only nullable columns can be added this way. If `online` is True,
+        indexes are built without blocking writes to the table where the
+        database supports it: concurrently in PostgreSQL and in place in
+        MySQL. SQLite locks the database while an index is built.
+
+        If `indexes` is False, only unique indexes are created, as other
+        indexes of large tables may take long to build.
+        '''
+
+        self.create_tables()
+
+        inspector = reflection.Inspector.from_engine(self.engine)
+
+        for table in self.Base.metadata.sorted_tables:
+
+            existing = set(c['name'] for c in inspector.get_columns(table.name))
+
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                if not column.nullable:
+                    raise RuntimeError('Can not add non-nullable column %s.%s' % (
+                        table.name, column.name))
+
+                column_type = column.type.compile(dialect=self.engine.dialect)
+                self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column_type))
+
+                log.info("Column added", table=table.name, column=column.name)
+
+            existing = set(i['name'] for i in inspector.get_indexes(table.name))
+
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                if not indexes and not index.unique:
+                    log.warning("Index missing, run opentaxii-upgrade-db to create it",
+                            table=table.name, index=index.name)
+                    continue
+
+                self._create_index(index, online=online)
+                log.info("Index created", table=table.name, index=index.name)
+
+
+    def _create_index(self, index, online=False):
+
+        dialect = self.engine.dialect.name
+
+        if not online or dialect not in ('postgresql', 'mysql'):
+            index.create(bind=self.engine)
+            return
+
+        ddl = unicode(CreateIndex(index).compile(dialect=self.engine.dialect))
+
+        if dialect == 'postgresql':
+            # Can not run inside a transaction
+            ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            connection = self.engine.connect().execution_options(
+                    isolation_level='AUTOCOMMIT')
+        else:
+            ddl += ' ALGORITHM=INPLACE LOCK=NONE'
+            connection = self.engine.connect()
+
+        try:
+            connection.execute(ddl)
+        finally:
+            connection.close()
+
+
+    def explain_content_queries(self, collection_id=None, bindings=[]):
+        '''
+        Return query plans of the content queries of a poll, as a list of
+        `(name, plan)` tuples with plans as lists of lines.
+        '''
+
+        ordered = self._get_ordered_content_query(collection_id=collection_id,
+                bindings=bindings)
+
+        cursor = self.get_high_water_mark(collection_id) or (datetime.utcnow(), 0)
+
+        queries = [
+            ('count', self._get_position_query(collection_id=collection_id,
+                bindings=bindings).from_self(func.count(literal_column('*')))),
+            ('page', ordered.limit(100)),
+            ('seek', self._get_ordered_content_query(collection_id=collection_id,
+                bindings=bindings, after=cursor, until=cursor).limit(100)),
+        ]
+
+        return [(name, self._explain(query.with_labels().statement))
+                for name, query in queries]
+
+
+    def _explain(self, statement):
+
+        dialect = self.engine.dialect
+
+        prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+
+        compiled = statement.compile(dialect=dialect)
+
+        if compiled.positional:
+            params = tuple(compiled.params[name] for name in compiled.positiontup)
+        else:
+            params = compiled.params
+
+        rows = self.engine.execute(prefix + unicode(compiled), params)
+
+        return [' | '.join(unicode(value) for value in row) for row in rows]
+
+
     def _merge(self, obj):
         s = self.Session()
         updated = s.merge(obj)
@@ -68,10 +227,20 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         if not collections:
             raise ValueError("No collections were found with ids: %s" % collection_ids)
 
+        self._count_content(s, [(c.id, content_block.date_created, content_block.binding_id,
+            content_block.binding_subtype) for c in collections])
+
         for collection in collections:
             collection.content_blocks.append(content_block)
             s.add(collection)
 
+            s.add(self.CollectionTimeline(
+                collection_id = collection.id,
+                date_created = content_block.date_created,
+                content_block_id = content_block.id,
+                binding_id = content_block.binding_id,
+                binding_subtype = content_block.binding_subtype))
+
             log.debug("Content block added to collection", content_block_id=content_block_id,
                     collection_id=collection.id, collection_name=collection.name)
 
@@ -127,55 +296,284 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
                 return conv.to_collection_entity(c)
 
 
-    def _get_content_query(self, collection_id=None, start_time=None,
-            end_time=None, bindings=[]):
+    def _use_timeline(self, collection_id):
+        return bool(collection_id) and self.use_timeline
 
-        query = self.ContentBlock.query
 
-        if collection_id:
-            query = query.filter(self.ContentBlock.collections.any(id=collection_id))
+    def _get_position_columns(self, collection_id=None):
+        '''
+        Return `(date_created, id)` columns content blocks are filtered and
+        ordered on: columns of the collection timeline if it is used.
+        '''
+        if self._use_timeline(collection_id):
+            return self.CollectionTimeline.date_created, self.CollectionTimeline.content_block_id
+        return self.ContentBlock.date_created, self.ContentBlock.id
+
+
+    def _filter_content(self, query, collection_id=None, start_time=None,
+            end_time=None, bindings=[], until=None):
+
+        if self._use_timeline(collection_id):
+            source = self.CollectionTimeline
+            query = query.filter(source.collection_id == collection_id)
+
+        else:
+            source = self.ContentBlock
+
+            if collection_id:
+                # Checked on the link table alone, using its block index
+                links = self.collection_to_content_block.c
+                query = query.filter(exists().where(and_(
+                    links.content_block_id == self.ContentBlock.id,
+                    links.collection_id == collection_id)))
+
+        date_created, block_id = self._get_position_columns(collection_id)
 
         if start_time:
-            query = query.filter(self.ContentBlock.date_created > start_time)
+            query = query.filter(date_created > start_time)
 
         if end_time:
-            query = query.filter(self.ContentBlock.date_created <= end_time)
+            query = query.filter(date_created <= end_time)
 
-        if bindings:
-            criteria = []
-            for binding in bindings:
-                if binding.subtypes:
-                    criterion = and_(self.ContentBlock.binding_id == binding.binding,
-                            self.ContentBinding.binding_subtype.in_(binding.subtypes))
-                else:
-                    criterion = self.ContentBlock.binding_id == binding.binding
-                criteria.append(criterion)
+        if until:
+            # Blocks created after the high-water mark are not visible,
+            # a range on the (date_created, id) index
+            mark_date, mark_id = until
+            query = query.filter(date_created <= mark_date,
+                    or_(date_created < mark_date, block_id <= mark_id))
 
-            query = query.filter(or_(*criteria))
+        if bindings:
+            query = query.filter(_get_binding_criteria(source, bindings))
 
         return query
 
 
+    def _get_block_columns(self):
+        '''
+        Columns of content blocks and their payloads needed for entities.
+        Rows of columns, unlike models, are not kept in the session.
+        '''
+
+        blocks = self.ContentBlock
+        payloads = self.ContentPayload
+
+        return [blocks.id, blocks.date_created, blocks.timestamp_label,
+                blocks.message, blocks.inbox_message_id, blocks.binding_id,
+                blocks.binding_subtype, blocks.content, blocks.payload_id,
+                payloads.content.label('payload_content'),
+                payloads.compressed_content.label('payload_compressed_content')]
+
+
+    def _get_content_query(self, collection_id=None, start_time=None,
+            end_time=None, bindings=[], until=None):
+
+        query = self.Session().query(*self._get_block_columns())
+
+        if self._use_timeline(collection_id):
+            # Blocks are found with a range scan of the timeline and
+            # fetched by primary key
+            timeline = self.CollectionTimeline
+            query = query.select_from(timeline).join(self.ContentBlock,
+                    self.ContentBlock.id == timeline.content_block_id)
+        else:
+            query = query.select_from(self.ContentBlock)
+
+        query = query.outerjoin(self.ContentPayload,
+                self.ContentPayload.id == self.ContentBlock.payload_id)
+
+        return self._filter_content(query, collection_id=collection_id,
+                start_time=start_time, end_time=end_time, bindings=bindings,
+                until=until)
+
+
+    def _get_position_query(self, collection_id=None, start_time=None,
+            end_time=None, bindings=[], until=None):
+        '''
+        Query of `(date_created, id)` of matching content blocks, read from
+        the collection timeline alone if it is used.
+        '''
+
+        date_created, block_id = self._get_position_columns(collection_id)
+
+        query = self.Session().query(date_created.label('date_created'),
+                block_id.label('id'))
+
+        return self._filter_content(query, collection_id=collection_id,
+                start_time=start_time, end_time=end_time, bindings=bindings,
+                until=until)
+
+
     def get_content_blocks_count(self, collection_id=None, start_time=None,
-            end_time=None, bindings=[]):
+            end_time=None, bindings=[], until=None):
 
-        query = self._get_content_query(collection_id=collection_id,
+        if collection_id and self.use_statistics:
+            return self._count_from_statistics(collection_id, start_time=start_time,
+                    end_time=end_time, bindings=bindings, until=until)
+
+        query = self._get_position_query(collection_id=collection_id,
                 start_time=start_time, end_time=end_time,
-                bindings=bindings)
+                bindings=bindings, until=until)
 
         return query.count()
 
 
-    def get_content_blocks(self, collection_id=None, start_time=None,
-            end_time=None, bindings=[], offset=0, limit=10):
+    def _count_from_statistics(self, collection_id, start_time=None,
+            end_time=None, bindings=[], until=None):
+        '''
+        Count content blocks of a collection with the collection counters
+        if no timeframe is given, otherwise by adding up histogram buckets
+        fully within the timeframe and counting blocks of the two edge
+        buckets.
+        '''
+
+        s = self.Session()
+
+        if not (start_time or end_time or until):
+            counters = self.CollectionCounter
+            query = s.query(func.sum(counters.blocks_count)) \
+                    .filter(counters.collection_id == collection_id)
+            if bindings:
+                query = query.filter(_get_binding_criteria(counters, bindings))
+            return query.scalar() or 0
+
+        upper = [_to_utc(d) for d in [end_time, until and until[0]] if d]
+        upper = min(upper) if upper else None
+        lower = _to_utc(start_time) if start_time else None
+
+        histogram = self.CollectionHistogram
+        query = s.query(func.sum(histogram.blocks_count)) \
+                .filter(histogram.collection_id == collection_id)
+
+        date_created, _ = self._get_position_columns(collection_id)
+        edges = []
+
+        if lower:
+            query = query.filter(histogram.bucket > _get_bucket(lower))
+            edges.append(date_created < _get_bucket(lower) + BUCKET_SIZE)
+
+        if upper:
+            query = query.filter(histogram.bucket < _get_bucket(upper))
+            edges.append(date_created >= _get_bucket(upper))
+
+        if bindings:
+            query = query.filter(_get_binding_criteria(histogram, bindings))
+
+        edge_count = self._get_position_query(collection_id=collection_id,
+                start_time=start_time, end_time=end_time, bindings=bindings,
+                until=until).filter(or_(*edges)).count()
+
+        return (query.scalar() or 0) + edge_count
+
+
+    def _count_content(self, session, entries):
+        '''
+        Add content blocks attached to collections to the collection
+        statistics. `entries` are `(collection_id, date_created, binding_id,
+        binding_subtype)` tuples.
+        '''
+
+        counters = Counter()
+        buckets = Counter()
+
+        _add_counts(entries, counters, buckets)
+
+        self._write_counts(session, counters, buckets)
+
+
+    def _write_counts(self, session, counters, buckets):
+
+        self._increment_counts(session, self.CollectionCounter.__table__,
+                ['collection_id', 'binding_id', 'binding_subtype'], counters)
+        self._increment_counts(session, self.CollectionHistogram.__table__,
+                ['collection_id', 'bucket', 'binding_id', 'binding_subtype'], buckets)
+
+
+    def _increment_counts(self, session, table, columns, counts):
+
+        update = table.update() \
+            .where(and_(*[table.c[c] == bindparam('key_' + c) for c in columns])) \
+            .values(blocks_count=table.c.blocks_count + bindparam('increment'))
+
+        for key, count in counts.items():
+
+            params = dict(('key_' + c, value) for c, value in zip(columns, key))
+            params['increment'] = count
+
+            if session.execute(update, params).rowcount:
+                continue
+
+            values = dict(zip(columns, key))
+            values['blocks_count'] = count
+
+            if self.engine.dialect.name == 'sqlite':
+                # Writers are serialized by the database lock already taken
+                # by the update, and pysqlite does not support savepoints
+                session.execute(table.insert(), values)
+                continue
+
+            try:
+                with session.begin_nested():
+                    session.execute(table.insert(), values)
+            except IntegrityError:
+                # Inserted by a concurrent writer in the meantime
+                session.execute(update, params)
+
+
+    def _seek(self, query, collection_id=None, after=None):
+
+        date_created, block_id = self._get_position_columns(collection_id)
+
+        if after:
+            # Seek past the cursor using the (date_created, id) index
+            # instead of skipping all preceding rows with OFFSET
+            cursor_date, cursor_id = after
+            query = query.filter(or_(
+                date_created > cursor_date,
+                and_(date_created == cursor_date, block_id > cursor_id)))
+
+        return query.order_by(date_created, block_id)
+
+
+    def _get_ordered_content_query(self, collection_id=None, start_time=None,
+            end_time=None, bindings=[], after=None, until=None):
 
         query = self._get_content_query(collection_id=collection_id,
                 start_time=start_time, end_time=end_time,
-                bindings=bindings)
-        
-        blocks = query[offset : offset + limit]
+                bindings=bindings, until=until)
+
+        return self._seek(query, collection_id=collection_id, after=after)
+
+
+    def get_content_blocks(self, collection_id=None, start_time=None,
+            end_time=None, bindings=[], offset=0, limit=10, after=None, until=None):
+
+        query = self._get_ordered_content_query(collection_id=collection_id,
+                start_time=start_time, end_time=end_time,
+                bindings=bindings, after=after, until=until)
+
+        rows = query[offset : offset + limit]
 
-        return map(conv.to_block_entity, blocks)
+        return map(conv.row_to_block_entity, rows)
+
+
+    def iter_content_blocks(self, collection_id=None, start_time=None,
+            end_time=None, bindings=[], offset=0, limit=None, after=None,
+            until=None, batch_size=100):
+
+        query = self._get_ordered_content_query(collection_id=collection_id,
+                start_time=start_time, end_time=end_time,
+                bindings=bindings, after=after, until=until)
+
+        if offset:
+            query = query.offset(offset)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        # Rows are streamed from a server-side cursor where the database
+        # supports it, and fetched in batches
+        for row in query.yield_per(batch_size):
+            yield conv.row_to_block_entity(row)
 
 
     def update_collection(self, entity):
@@ -189,6 +587,8 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
             description = entity.description,
             available = entity.available,
             accept_all_content = entity.accept_all_content,
+            compress_content = entity.compress_content,
+            validate_content = entity.validate_content,
             bindings = _bindings
         )
 
@@ -222,7 +622,63 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
 
 
     def create_inbox_message(self, entity):
-        return self.update_inbox_message(entity)
+        try:
+            return self.update_inbox_message(entity)
+        except IntegrityError:
+            self.Session().rollback()
+            if not entity.idempotency_key:
+                raise
+            raise DuplicateInboxMessage(entity.message_id)
+
+
+    def get_inbox_message(self, idempotency_key):
+        message = self.InboxMessage.query \
+                .filter_by(idempotency_key=idempotency_key).first()
+        return conv.to_inbox_message_entity(message)
+
+
+    def claim_inbox_message(self, idempotency_key, lease):
+        '''
+        Take over an incomplete message not updated for `lease` seconds,
+        left by a process that stopped while storing its content. Returns
+        None if the message is completed or still being stored.
+        '''
+
+        table = self.InboxMessage.__table__
+        now = datetime.utcnow()
+
+        s = self.Session()
+        result = s.execute(table.update()
+                .where(and_(table.c.idempotency_key == idempotency_key,
+                    table.c.completed == False,
+                    table.c.date_updated < now - timedelta(seconds=lease)))
+                .values(date_updated=now))
+        s.commit()
+
+        if not result.rowcount:
+            return None
+
+        return self.get_inbox_message(idempotency_key)
+
+
+    def release_inbox_message(self, entity):
+        '''
+        Remove the idempotency key of a message whose content could not be
+        stored, so the message can be sent again.
+        '''
+
+        table = self.InboxMessage.__table__
+
+        s = self.Session()
+
+        # Transaction that failed to store the content may still be open
+        s.rollback()
+
+        s.execute(table.update().where(table.c.id == entity.id)
+                .values(idempotency_key=None))
+        s.commit()
+
+        entity.idempotency_key = None
 
 
     def update_inbox_message(self, entity):
@@ -232,10 +688,26 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         else:
             names = None
 
+        original, raw, compressed = entity.original_message or '', None, None
+
+        # Bytes are kept exactly as received, text is stored as text
+        if isinstance(original, str):
+            original, raw = '', original or None
+
+        if entity.compress_original_message:
+            compressed = self._compress(raw if raw is not None else original)
+            if compressed is not None:
+                original, raw = '', None
+
         message = self.InboxMessage(
             id = entity.id,
             message_id = entity.message_id,
-            original_message = entity.original_message,
+            original_message = original,
+            raw_message = raw,
+            compressed_message = compressed,
+            idempotency_key = entity.idempotency_key,
+            rejected_blocks = json.dumps(entity.rejected_blocks) if entity.rejected_blocks else None,
+            completed = entity.completed,
             content_block_count = entity.content_block_count,
             destination_collections = names,
 
@@ -260,19 +732,16 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
 
     def update_content_block(self, entity):
 
-        if entity.content_binding:
-            binding = entity.content_binding.binding
-            subtype = entity.content_binding.subtypes[0] \
-                    if entity.content_binding.subtypes else None
-        else:
-            binding = None
-            subtype = None
+        binding, subtype = _get_binding_columns(entity)
+
+        payload_ids = self._store_payloads(self.Session(), [entity.content])
 
         content = self.ContentBlock(
             id = entity.id,
             timestamp_label = entity.timestamp_label,
             inbox_message_id = entity.inbox_message_id,
-            content = entity.content,
+            payload_id = payload_ids.get(_get_digest(entity.content)),
+            digest = _get_digest(binding, subtype, entity.content),
             binding_id = binding,
             binding_subtype = subtype
         )
@@ -286,6 +755,373 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         return self.update_content_block(entity)
 
 
+    def create_content_blocks(self, entities, collections_ids):
+
+        s = self.Session()
+
+        blocks_table = self.ContentBlock.__table__
+        links = []
+        timeline = []
+        created = []
+
+        # A collection may be named more than once for the same block
+        collections_ids = [list(OrderedDict.fromkeys(ids)) for ids in collections_ids]
+
+        try:
+            compressing = self._get_compressing_collections(s,
+                    set(cid for ids in collections_ids for cid in ids))
+
+            payload_ids = self._store_payloads(s, [e.content for e in entities],
+                    compress=[bool(compressing.intersection(ids)) for ids in collections_ids])
+
+            # Primary keys are needed for the links, so content blocks are
+            # inserted one by one, but all within the same transaction
+            for entity, collection_ids in zip(entities, collections_ids):
+
+                binding, subtype = _get_binding_columns(entity)
+
+                # Set here, as it is copied to the timeline
+                date_created = datetime.utcnow()
+
+                result = s.execute(blocks_table.insert(), dict(
+                    date_created = date_created,
+                    timestamp_label = entity.timestamp_label,
+                    inbox_message_id = entity.inbox_message_id,
+                    message = entity.message,
+                    payload_id = payload_ids.get(_get_digest(entity.content)),
+                    digest = _get_digest(binding, subtype, entity.content),
+                    binding_id = binding,
+                    binding_subtype = subtype
+                ))
+
+                entity.id = result.inserted_primary_key[0]
+                created.append(entity)
+
+                links.extend(dict(collection_id=cid, content_block_id=entity.id)
+                        for cid in collection_ids)
+
+                timeline.extend(dict(collection_id=cid, date_created=date_created,
+                    content_block_id=entity.id, binding_id=binding,
+                    binding_subtype=subtype) for cid in collection_ids)
+
+            if links:
+                s.execute(self.collection_to_content_block.insert(), links)
+                s.execute(self.CollectionTimeline.__table__.insert(), timeline)
+
+                self._count_content(s, [(e['collection_id'], e['date_created'],
+                    e['binding_id'], e['binding_subtype']) for e in timeline])
+
+            s.commit()
+        except:
+            s.rollback()
+            raise
+
+        log.debug("Content blocks created", blocks=len(created), links=len(links))
+
+        return created
+
+
+    def _store_payloads(self, session, contents, compress=None):
+        '''
+        Make sure all contents are stored as payloads, linking the existing
+        ones. Returns a dict of content digest to payload id.
+
+        `compress` is an optional list of flags, one per content, telling
+        if the content should be stored compressed.
+        '''
+
+        compress = compress or [False] * len(contents)
+
+        digests = dict()
+        for content, should_compress in zip(contents, compress):
+            if content is None:
+                continue
+            digest = _get_digest(content)
+            # Content shared by several blocks is compressed if any of them asks for it
+            _, compressed = digests.get(digest, (None, False))
+            digests[digest] = (content, compressed or should_compress)
+
+        payload_ids = self._get_payload_ids(session, digests.keys())
+
+        missing = [self._get_payload_values(d, c, should_compress)
+                for d, (c, should_compress) in digests.items()
+                if d not in payload_ids]
+
+        if missing:
+            session.execute(self.ContentPayload.__table__.insert(), missing)
+            payload_ids.update(self._get_payload_ids(session,
+                [m['digest'] for m in missing]))
+
+            log.debug("Content payloads created", payloads=len(missing),
+                    linked=len(digests) - len(missing))
+
+        return payload_ids
+
+
+    def _get_payload_values(self, digest, content, compress):
+
+        values = dict(digest=digest, content=content, compressed_content=None)
+
+        if compress:
+            compressed = self._compress(content)
+            if compressed is not None:
+                values.update(content='', compressed_content=compressed)
+
+        return values
+
+
+    def _compress(self, content):
+
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        if len(content) < self.compression_min_size:
+            return None
+
+        return zlib.compress(content, self.compression_level)
+
+
+    def _get_compressing_collections(self, session, collection_ids):
+
+        if not collection_ids:
+            return set()
+
+        table = self.DataCollection.__table__
+        query = select([table.c.id]).where(and_(
+            table.c.id.in_(list(collection_ids)), table.c.compress_content == True))
+
+        return set(row.id for row in session.execute(query))
+
+
+    def compress_content(self, batch_size=1000):
+        '''
+        Compress stored payloads of content blocks that belong to collections
+        with enabled compression.
+        '''
+
+        self.upgrade_tables()
+
+        s = self.Session()
+
+        payloads = self.ContentPayload.__table__
+        blocks = self.ContentBlock.__table__
+        links = self.collection_to_content_block
+        collections = self.DataCollection.__table__
+
+        in_compressing_collection = exists() \
+            .where(and_(
+                blocks.c.payload_id == payloads.c.id,
+                links.c.content_block_id == blocks.c.id,
+                collections.c.id == links.c.collection_id,
+                collections.c.compress_content == True))
+
+        query = select([payloads.c.id, payloads.c.content]) \
+            .where(and_(payloads.c.id > bindparam('last_id'),
+                payloads.c.compressed_content == None,
+                in_compressing_collection)) \
+            .order_by(payloads.c.id) \
+            .limit(batch_size)
+
+        update = payloads.update() \
+            .where(payloads.c.id == bindparam('payload_id')) \
+            .values(content='', compressed_content=bindparam('compressed'))
+
+        last_id = 0
+        total = 0
+
+        while True:
+            rows = s.execute(query, dict(last_id=last_id)).fetchall()
+            if not rows:
+                break
+
+            last_id = rows[-1].id
+
+            values = []
+            for row in rows:
+                compressed = self._compress(row.content)
+                if compressed is not None:
+                    values.append(dict(payload_id=row.id, compressed=compressed))
+
+            if values:
+                s.execute(update, values)
+            s.commit()
+
+            total += len(values)
+
+            log.info("Content payloads compressed", payloads=total, last_id=last_id)
+
+        return total
+
+
+    def _get_payload_ids(self, session, digests):
+
+        table = self.ContentPayload.__table__
+
+        payload_ids = dict()
+        for chunk in _chunks(list(digests), MAX_BOUND_PARAMETERS):
+            query = select([table.c.digest, table.c.id]).where(table.c.digest.in_(chunk))
+            payload_ids.update(session.execute(query).fetchall())
+
+        return payload_ids
+
+
+    def deduplicate_content(self, batch_size=1000):
+        '''
+        Move content stored inline in content blocks to the payloads table,
+        linking identical contents to the same payload.
+        '''
+
+        self.upgrade_tables()
+
+        s = self.Session()
+        blocks = self.ContentBlock.__table__
+
+        query = select([blocks.c.id, blocks.c.content, blocks.c.binding_id,
+                blocks.c.binding_subtype]) \
+            .where(and_(blocks.c.id > bindparam('last_id'),
+                blocks.c.payload_id == None, blocks.c.content != None)) \
+            .order_by(blocks.c.id) \
+            .limit(batch_size)
+
+        update = blocks.update() \
+            .where(blocks.c.id == bindparam('block_id')) \
+            .values(payload_id=bindparam('new_payload_id'),
+                    digest=bindparam('new_digest'), content=None)
+
+        last_id = 0
+        total = 0
+
+        while True:
+            rows = s.execute(query, dict(last_id=last_id)).fetchall()
+            if not rows:
+                break
+
+            payload_ids = self._store_payloads(s, [r.content for r in rows])
+
+            s.execute(update, [dict(
+                block_id = r.id,
+                new_payload_id = payload_ids[_get_digest(r.content)],
+                new_digest = _get_digest(r.binding_id, r.binding_subtype, r.content)
+            ) for r in rows])
+
+            s.commit()
+
+            last_id = rows[-1].id
+            total += len(rows)
+
+            log.info("Content blocks deduplicated", blocks=total, last_id=last_id)
+
+        return total
+
+
+    def backfill_timeline(self, batch_size=1000):
+        '''
+        Add content blocks attached to collections before the collection
+        timeline existed to the timeline.
+        '''
+
+        self.upgrade_tables()
+
+        s = self.Session()
+
+        links = self.collection_to_content_block
+        blocks = self.ContentBlock.__table__
+        timeline = self.CollectionTimeline.__table__
+
+        missing = ~exists().where(and_(
+            timeline.c.collection_id == links.c.collection_id,
+            timeline.c.content_block_id == links.c.content_block_id))
+
+        # Links of a block may be split between batches, so the last block
+        # is read again and links already added are skipped
+        query = select([links.c.collection_id, blocks.c.date_created,
+                blocks.c.id.label('content_block_id'), blocks.c.binding_id,
+                blocks.c.binding_subtype]) \
+            .select_from(links.join(blocks, blocks.c.id == links.c.content_block_id)) \
+            .where(and_(blocks.c.id >= bindparam('last_id'),
+                links.c.collection_id != None, missing)) \
+            .distinct() \
+            .order_by(blocks.c.id) \
+            .limit(batch_size)
+
+        last_id = 0
+        total = 0
+
+        while True:
+            rows = s.execute(query, dict(last_id=last_id)).fetchall()
+            if not rows:
+                break
+
+            s.execute(timeline.insert(), [dict(row) for row in rows])
+            s.commit()
+
+            last_id = rows[-1].content_block_id
+            total += len(rows)
+
+            log.info("Collection timeline filled", entries=total, last_id=last_id)
+
+        return total
+
+
+    def rebuild_statistics(self, batch_size=1000):
+        '''
+        Count content of all collections again, replacing the collection
+        statistics. Content received meanwhile may not be counted.
+        '''
+
+        self.upgrade_tables()
+
+        s = self.Session()
+
+        links = self.collection_to_content_block
+        blocks = self.ContentBlock.__table__
+
+        # Links are read in batches seeking on the link table index
+        query = select([links.c.content_block_id, links.c.collection_id,
+                blocks.c.date_created, blocks.c.binding_id, blocks.c.binding_subtype]) \
+            .select_from(links.join(blocks, blocks.c.id == links.c.content_block_id)) \
+            .where(and_(links.c.collection_id != None, or_(
+                links.c.content_block_id > bindparam('last_id'),
+                and_(links.c.content_block_id == bindparam('last_id'),
+                    links.c.collection_id > bindparam('last_collection_id'))))) \
+            .distinct() \
+            .order_by(links.c.content_block_id, links.c.collection_id) \
+            .limit(batch_size)
+
+        counters = Counter()
+        buckets = Counter()
+
+        total = 0
+        last = (0, 0)
+
+        try:
+            s.execute(self.CollectionCounter.__table__.delete())
+            s.execute(self.CollectionHistogram.__table__.delete())
+
+            while True:
+                rows = s.execute(query, dict(last_id=last[0],
+                    last_collection_id=last[1])).fetchall()
+                if not rows:
+                    break
+
+                # Only the totals are kept while links are read
+                _add_counts([(r.collection_id, r.date_created, r.binding_id,
+                    r.binding_subtype) for r in rows], counters, buckets)
+
+                total += len(rows)
+                last = (rows[-1].content_block_id, rows[-1].collection_id)
+
+                log.info("Collection content counted", entries=total, last_id=last[0])
+
+            self._write_counts(s, counters, buckets)
+            s.commit()
+        except:
+            s.rollback()
+            raise
+
+        return total
+
+
     def update_result_set(self, entity):
 
         _bindings = conv.serialize_content_bindings(entity.content_bindings)
@@ -295,7 +1131,11 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
             collection_id = entity.collection_id,
             bindings = _bindings,
             begin_time = entity.timeframe[0],
-            end_time = entity.timeframe[1]
+            end_time = entity.timeframe[1],
+            high_water_date = entity.high_water_mark[0] if entity.high_water_mark else None,
+            high_water_id = entity.high_water_mark[1] if entity.high_water_mark else None,
+            ready = entity.ready,
+            blocks_count = entity.blocks_count
         )
 
         updated = self._merge(result_set)
@@ -309,6 +1149,146 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         result_set = self.ResultSet.query.get(result_set_id)
         return conv.to_result_set_entity(result_set)
 
+    def get_result_set_cursor(self, result_set_id, part_number):
+
+        part = self.ResultSetPart.query \
+                .filter(self.ResultSetPart.result_set_id == result_set_id,
+                        self.ResultSetPart.part_number < part_number) \
+                .order_by(self.ResultSetPart.part_number.desc()) \
+                .first()
+
+        if not part:
+            return 0, None
+
+        return part.part_number, (part.cursor_date, part.cursor_id)
+
+    def update_result_set_cursor(self, result_set_id, part_number, cursor):
+
+        cursor_date, cursor_id = cursor
+
+        part = self.ResultSetPart(
+            result_set_id = result_set_id,
+            part_number = part_number,
+            cursor_date = cursor_date,
+            cursor_id = cursor_id
+        )
+
+        try:
+            self._merge(part)
+        except IntegrityError:
+            # Stored by a concurrent request for the same part
+            self.Session().rollback()
+
+    def get_high_water_mark(self, collection_id):
+
+        date_created, block_id = self._get_position_columns(collection_id)
+
+        last = self._get_position_query(collection_id=collection_id) \
+                .order_by(date_created.desc(), block_id.desc()) \
+                .first()
+
+        return (last.date_created, last.id) if last else None
+
+    def claim_result_set(self, result_set_id, lease):
+        '''
+        Claim a result set to be materialized. Returns False if it is
+        ready or claimed by another worker less than `lease` seconds ago.
+        '''
+
+        table = self.ResultSet.__table__
+        now = datetime.utcnow()
+
+        s = self.Session()
+        result = s.execute(table.update()
+                .where(and_(table.c.id == result_set_id,
+                    table.c.ready == False,
+                    or_(table.c.claimed_at == None,
+                        table.c.claimed_at < now - timedelta(seconds=lease))))
+                .values(claimed_at=now))
+        s.commit()
+
+        return bool(result.rowcount)
+
+
+    def release_result_set(self, result_set_id):
+        '''
+        Remove the claim of a result set that could not be materialized,
+        so it can be claimed again.
+        '''
+
+        table = self.ResultSet.__table__
+
+        s = self.Session()
+
+        # Transaction that failed to write the snapshot may still be open
+        s.rollback()
+
+        s.execute(table.update().where(table.c.id == result_set_id)
+                .values(claimed_at=None))
+        s.commit()
+
+
+    def materialize_result_set(self, result_set_id, batch_size=1000):
+
+        result_set = self.ResultSet.query.get(result_set_id)
+        entity = conv.to_result_set_entity(result_set)
+
+        start_time, end_time = entity.timeframe
+
+        session = self.Session()
+        table = self.ResultSetBlock.__table__
+
+        # A previous attempt may have been interrupted
+        self.ResultSetBlock.query.filter_by(result_set_id=result_set_id).delete()
+
+        count = 0
+        cursor = None
+
+        while True:
+            # IDs are read in batches seeking past the last one, so the
+            # inserts do not interleave with an open cursor
+            query = self._get_position_query(collection_id=entity.collection_id,
+                    start_time=start_time, end_time=end_time,
+                    bindings=entity.content_bindings, until=entity.high_water_mark)
+
+            rows = self._seek(query, collection_id=entity.collection_id, after=cursor) \
+                    .limit(batch_size).all()
+
+            if not rows:
+                break
+
+            session.execute(table.insert(), [dict(
+                result_set_id = result_set_id,
+                position = count + i,
+                content_block_id = row.id) for i, row in enumerate(rows)])
+
+            count += len(rows)
+            cursor = (rows[-1].date_created, rows[-1].id)
+
+        result_set.ready = True
+        result_set.blocks_count = count
+
+        session.commit()
+
+        log.info("Result set materialized", result_set_id=result_set_id, blocks=count)
+
+        return count
+
+    def get_result_set_blocks(self, result_set_id, offset=0, limit=10):
+
+        query = self.Session().query(*self._get_block_columns()) \
+                .select_from(self.ResultSetBlock) \
+                .join(self.ContentBlock,
+                        self.ContentBlock.id == self.ResultSetBlock.content_block_id) \
+                .outerjoin(self.ContentPayload,
+                        self.ContentPayload.id == self.ContentBlock.payload_id) \
+                .filter(self.ResultSetBlock.result_set_id == result_set_id,
+                        self.ResultSetBlock.position >= offset,
+                        self.ResultSetBlock.position < offset + limit) \
+                .order_by(self.ResultSetBlock.position)
+
+        return map(conv.row_to_block_entity, query.all())
+
     def get_subscription(self, subscription_id):
         s = self.Subscription.query.get(subscription_id)
         return conv.to_subscription_entity(s)
@@ -346,6 +1326,70 @@ class SQLDatabaseAPI(OpenTAXIIPersistenceAPI):
         return self.update_subscription(entity, service_id=service_id)
 
 
+def _get_digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update(part or '')
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _get_binding_columns(entity):
+
+    if not entity.content_binding:
+        return None, None
+
+    binding = entity.content_binding.binding
+    subtype = entity.content_binding.subtypes[0] \
+            if entity.content_binding.subtypes else None
+
+    return binding, subtype
+
+
+def _get_binding_criteria(source, bindings):
+
+    criteria = []
+    for binding in bindings:
+        if binding.subtypes:
+            criterion = and_(source.binding_id == binding.binding,
+                    source.binding_subtype.in_(binding.subtypes))
+        else:
+            criterion = source.binding_id == binding.binding
+        criteria.append(criterion)
+
+    return or_(*criteria)
+
+
+def _add_counts(entries, counters, buckets):
+    '''
+    Count `(collection_id, date_created, binding_id, binding_subtype)`
+    entries per collection and binding in `counters`, and per collection,
+    hour and binding in `buckets`.
+    '''
+
+    for collection_id, date_created, binding, subtype in entries:
+        binding, subtype = binding or '', subtype or ''
+        counters[(collection_id, binding, subtype)] += 1
+        buckets[(collection_id, _get_bucket(date_created), binding, subtype)] += 1
+
+
+def _to_utc(date):
+    if date.tzinfo:
+        return date.astimezone(pytz.UTC).replace(tzinfo=None)
+    return date
+
+
+def _get_bucket(date):
+    return _to_utc(date).replace(minute=0, second=0, microsecond=0)
+
+
 def attach_all(obj, module):
     for key in module.__all__:
         if not hasattr(obj, key):
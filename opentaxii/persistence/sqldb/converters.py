@@ -1,4 +1,5 @@
 import json
+import zlib
 import pytz
 
 from opentaxii.taxii import entities
@@ -13,7 +14,9 @@ def to_collection_entity(model):
         type = model.type,
         description = model.description,
         accept_all_content = model.accept_all_content,
-        supported_content = deserialize_content_bindings(model.bindings)
+        supported_content = deserialize_content_bindings(model.bindings),
+        compress_content = bool(model.compress_content),
+        validate_content = bool(model.validate_content)
     )
 
 
@@ -21,11 +24,33 @@ def to_block_entity(model):
     if not model:
         return
 
+    content = get_payload_content(model.payload) if model.payload else model.content
+
+    return _to_block_entity(model, content)
+
+
+def row_to_block_entity(row):
+    '''
+    Convert a row of content block columns with `payload_content` and
+    `payload_compressed_content` columns of its payload.
+    '''
+
+    if row.payload_id:
+        content = decompress_content(row.payload_content, row.payload_compressed_content)
+    else:
+        content = row.content
+
+    return _to_block_entity(row, content)
+
+
+def _to_block_entity(model, content):
+
     subtypes = [model.binding_subtype] if model.binding_subtype else None
 
     return entities.ContentBlockEntity(
         id = model.id,
-        content = model.content,
+        date_created = model.date_created,
+        content = content,
 
         timestamp_label = enforce_timezone(model.timestamp_label),
         content_binding = entities.ContentBindingEntity(
@@ -47,7 +72,11 @@ def to_inbox_message_entity(model):
     return entities.InboxMessageEntity(
         id = model.id,
         message_id = model.message_id,
-        original_message = model.original_message,
+        original_message = get_original_message(model),
+        compress_original_message = model.compressed_message is not None,
+        idempotency_key = model.idempotency_key,
+        rejected_blocks = map(tuple, json.loads(model.rejected_blocks or '[]')),
+        completed = model.completed,
         content_block_count = model.content_block_count,
         destination_collections = names,
 
@@ -72,7 +101,11 @@ def to_result_set_entity(model):
         result_id = model.id,
         collection_id = model.collection_id,
         content_bindings = deserialize_content_bindings(model.bindings),
-        timeframe = map(enforce_timezone, (model.begin_time, model.end_time))
+        timeframe = map(enforce_timezone, (model.begin_time, model.end_time)),
+        high_water_mark = (model.high_water_date, model.high_water_id)
+            if model.high_water_id is not None else None,
+        ready = model.ready,
+        blocks_count = model.blocks_count
     )
 
 
@@ -103,6 +136,26 @@ def to_service_entity(model):
             properties=model.properties)
 
 
+def get_payload_content(payload):
+    return decompress_content(payload.content, payload.compressed_content)
+
+
+def decompress_content(content, compressed_content):
+    if compressed_content is not None:
+        return zlib.decompress(compressed_content).decode('utf-8')
+    return content
+
+
+def get_original_message(model):
+    # Raw and compressed messages are returned as bytes
+    if model.compressed_message is not None:
+        return zlib.decompress(model.compressed_message)
+    if model.raw_message is not None:
+        return str(model.raw_message)
+    # Empty message means it was not retained
+    return model.original_message or None
+
+
 def serialize_content_bindings(content_bindings):
     return json.dumps([(c.binding, c.subtypes) for c in content_bindings])
 
@@ -2,15 +2,18 @@ import json
 from datetime import datetime
 
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Table, Column, ForeignKey
-from sqlalchemy.types import Integer, String, DateTime, Boolean, Text
+from sqlalchemy.schema import Table, Column, ForeignKey, Index
+from sqlalchemy.types import Integer, String, DateTime, Boolean, Text, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 
-__all__ = ['Base', 'ContentBlock', 'DataCollection', 'Service', 'InboxMessage', 'ResultSet', 'Subscription']
+__all__ = ['Base', 'ContentBlock', 'ContentPayload', 'DataCollection', 'Service', 'InboxMessage',
+        'ResultSet', 'ResultSetPart', 'ResultSetBlock', 'CollectionTimeline', 'CollectionCounter',
+        'CollectionHistogram', 'Subscription', 'collection_to_content_block']
 
 Base = declarative_base()
 
 MAX_STR_LEN = 256
+DIGEST_LEN = 64
 
 
 class Timestamped(Base):
@@ -26,6 +29,13 @@ class ContentBlock(Timestamped):
 
     __tablename__ = 'content_blocks'
 
+    # Poll results are ordered by, and seek on, the first pair of columns.
+    # The second index serves binding filters.
+    __table_args__ = (
+        Index('ix_content_blocks_date_created_id', 'date_created', 'id'),
+        Index('ix_content_blocks_binding', 'binding_id', 'binding_subtype'),
+    )
+
     id = Column(Integer, primary_key=True)
     message = Column(Text, nullable=True)
 
@@ -35,7 +45,14 @@ class ContentBlock(Timestamped):
         onupdate="CASCADE", ondelete="CASCADE"), nullable=True)
     inbox_message = relationship('InboxMessage', backref='content_blocks')
 
-    content = Column(Text)
+    # Content stored inline, only used by rows created before deduplication
+    content = Column(Text, nullable=True)
+
+    payload_id = Column(Integer, ForeignKey('content_payloads.id'), nullable=True)
+    payload = relationship('ContentPayload', lazy='joined')
+
+    # Digest of the content and the binding of the block
+    digest = Column(String(DIGEST_LEN), nullable=True)
 
     binding_id = Column(String(MAX_STR_LEN))
     binding_subtype = Column(String(MAX_STR_LEN))
@@ -45,6 +62,24 @@ class ContentBlock(Timestamped):
                 self.id, self.inbox_message_id, self.binding_id, self.binding_subtype)
 
 
+class ContentPayload(Base):
+
+    __tablename__ = 'content_payloads'
+
+    id = Column(Integer, primary_key=True)
+
+    # Not unique: concurrent writers may store the same payload twice,
+    # which wastes space but does not change poll results
+    digest = Column(String(DIGEST_LEN), index=True, nullable=False)
+
+    # Empty if the content is stored compressed
+    content = Column(Text, nullable=False)
+    compressed_content = Column(LargeBinary, nullable=True)
+
+    def __repr__(self):
+        return 'ContentPayload(id=%s, digest=%s)' % (self.id, self.digest)
+
+
 service_to_collection = Table('service_to_collection', Base.metadata,
     Column('service_id', String(MAX_STR_LEN), ForeignKey('services.id')),
     Column('collection_id', Integer, ForeignKey('data_collections.id'))
@@ -72,11 +107,73 @@ class Service(Timestamped):
 
 
 
+# Poll queries check if a block is in a collection, counts and scans of
+# a collection can start from its links instead
 collection_to_content_block = Table('collection_to_content_block', Base.metadata,
     Column('collection_id', Integer, ForeignKey('data_collections.id')),
-    Column('content_block_id', Integer, ForeignKey('content_blocks.id'))
+    Column('content_block_id', Integer, ForeignKey('content_blocks.id')),
+    Index('ix_collection_to_content_block_block', 'content_block_id', 'collection_id'),
+    Index('ix_collection_to_content_block_collection', 'collection_id', 'content_block_id'),
 )
 
+class CollectionTimeline(Base):
+    '''
+    Content blocks of every collection in the order they are polled.
+    Copies creation dates and bindings of the blocks, so poll queries of a
+    collection are range scans of the primary key, or of the binding index,
+    without a join until the blocks are fetched.
+    '''
+
+    __tablename__ = 'collection_timeline'
+
+    __table_args__ = (
+        Index('ix_collection_timeline_binding', 'collection_id', 'binding_id',
+            'binding_subtype', 'date_created', 'content_block_id'),
+    )
+
+    collection_id = Column(Integer, ForeignKey('data_collections.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    date_created = Column(DateTime(timezone=True), primary_key=True)
+    content_block_id = Column(Integer, ForeignKey('content_blocks.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+
+    binding_id = Column(String(MAX_STR_LEN))
+    binding_subtype = Column(String(MAX_STR_LEN))
+
+
+class CollectionCounter(Base):
+    '''
+    Amount of content blocks of a collection per binding. Bindings without
+    a subtype have an empty subtype.
+    '''
+
+    __tablename__ = 'collection_counters'
+
+    collection_id = Column(Integer, ForeignKey('data_collections.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    binding_id = Column(String(MAX_STR_LEN), primary_key=True)
+    binding_subtype = Column(String(MAX_STR_LEN), primary_key=True)
+
+    blocks_count = Column(Integer, nullable=False, default=0)
+
+
+class CollectionHistogram(Base):
+    '''
+    Amount of content blocks of a collection per binding created in the
+    hour starting at `bucket`.
+    '''
+
+    __tablename__ = 'collection_histogram'
+
+    collection_id = Column(Integer, ForeignKey('data_collections.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    binding_id = Column(String(MAX_STR_LEN), primary_key=True)
+    binding_subtype = Column(String(MAX_STR_LEN), primary_key=True)
+
+    blocks_count = Column(Integer, nullable=False, default=0)
+
+
 class DataCollection(Timestamped):
 
     __tablename__ = 'data_collections'
@@ -90,6 +187,9 @@ class DataCollection(Timestamped):
     available = Column(Boolean, default=True)
     accept_all_content = Column(Boolean, default=False)
 
+    compress_content = Column(Boolean, default=False, nullable=True)
+    validate_content = Column(Boolean, default=False, nullable=True)
+
     content_blocks = relationship('ContentBlock', secondary=collection_to_content_block, backref="collections")
 
     bindings = Column(String(MAX_STR_LEN))
@@ -117,6 +217,18 @@ class InboxMessage(Timestamped):
     inclusive_end_timestamp_label = Column(DateTime(timezone=True), nullable=True)
 
     original_message = Column(Text, nullable=False)
+
+    # Request body as received, stored without decoding
+    raw_message = Column(LargeBinary, nullable=True)
+    compressed_message = Column(LargeBinary, nullable=True)
+
+    # Only set for messages received by idempotent inbox services
+    idempotency_key = Column(String(DIGEST_LEN), nullable=True, index=True, unique=True)
+    rejected_blocks = Column(Text, nullable=True)
+
+    # False while content of a message with idempotency key is being stored
+    completed = Column(Boolean, nullable=True)
+
     content_block_count = Column(Integer)
 
     # FIXME: should be a proper reference ID
@@ -143,6 +255,54 @@ class ResultSet(Timestamped):
     begin_time = Column(DateTime(timezone=True), nullable=True)
     end_time = Column(DateTime(timezone=True), nullable=True)
 
+    # Cursor of the last content block visible when the result set was
+    # created, later blocks are not part of the result set
+    high_water_date = Column(DateTime(timezone=True), nullable=True)
+    high_water_id = Column(Integer, nullable=True)
+
+    # NULL for result sets computed on request, False until the snapshot
+    # of a materialized result set is written
+    ready = Column(Boolean, nullable=True)
+    blocks_count = Column(Integer, nullable=True)
+
+    # Time a worker claimed the result set to write its snapshot,
+    # NULL if no worker is writing it
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class ResultSetPart(Base):
+    '''
+    Cursor of a served part of a result set: `date_created` and `id` of
+    the last content block in the part. Only parts that were served are
+    stored, so the table is sparse.
+    '''
+
+    __tablename__ = 'result_set_parts'
+
+    result_set_id = Column(String(MAX_STR_LEN), ForeignKey('result_sets.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True)
+    part_number = Column(Integer, primary_key=True, autoincrement=False)
+
+    cursor_date = Column(DateTime(timezone=True), nullable=False)
+    cursor_id = Column(Integer, nullable=False)
+
+
+class ResultSetBlock(Base):
+    '''
+    Snapshot of a materialized result set: IDs of matching content blocks
+    numbered from 0 in the order they are served.
+    '''
+
+    __tablename__ = 'result_set_blocks'
+
+    result_set_id = Column(String(MAX_STR_LEN), ForeignKey('result_sets.id',
+        onupdate="CASCADE", ondelete="CASCADE"), primary_key=True)
+    position = Column(Integer, primary_key=True, autoincrement=False)
+
+    content_block_id = Column(Integer, ForeignKey('content_blocks.id',
+        onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+    content_block = relationship('ContentBlock')
+
 
 class Subscription(Timestamped):
 
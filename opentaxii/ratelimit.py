@@ -0,0 +1,196 @@
+import math
+import time
+import sqlite3
+import threading
+import structlog
+
+from contextlib import contextmanager
+
+from libtaxii.constants import ST_RETRY, SD_ESTIMATED_WAIT
+
+from .taxii.exceptions import StatusMessageException
+
+log = structlog.getLogger(__name__)
+
+REQUESTS = 'requests'
+BLOCKS = 'blocks'
+BYTES = 'bytes'
+
+LIMITS = (REQUESTS, BLOCKS, BYTES)
+
+
+class BucketStore(object):
+    '''
+    Storage of token buckets. A bucket is a tuple `(tokens, updated)`.
+    '''
+
+    def consume(self, buckets, force=False):
+        '''
+        Take tokens from all buckets at once.
+
+        `buckets` is a list of `(key, rate, capacity, amount)` tuples.
+        If any bucket does not hold enough tokens, nothing is taken
+        and the time in seconds until it is refilled is returned.
+        Amounts bigger than the capacity are granted from a full bucket
+        and leave it in debt. With `force`, tokens are always taken.
+
+        Returns 0 if tokens were taken.
+        '''
+
+        now = time.time()
+
+        with self._transaction([b[0] for b in buckets]) as states:
+
+            updated = {}
+            wait = 0
+
+            for key, rate, capacity, amount in buckets:
+
+                tokens, timestamp = states.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - timestamp) * rate)
+
+                required = min(amount, capacity)
+                if tokens < required and not force:
+                    wait = max(wait, (required - tokens) / rate)
+
+                updated[key] = (tokens - amount, now)
+
+            if not wait:
+                states.update(updated)
+
+        return wait
+
+
+class MemoryBucketStore(BucketStore):
+    '''
+    Buckets kept in the memory of the process.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def _transaction(self, keys):
+        with self._lock:
+            yield self.buckets
+
+
+class SQLiteBucketStore(BucketStore):
+    '''
+    Buckets kept in an SQLite file, shared by all processes using it.
+
+    :param path: path to the SQLite database file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._get_connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS token_buckets ('
+                    'key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+
+    def _get_connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if not conn:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.connection = conn
+        return conn
+
+
+    @contextmanager
+    def _transaction(self, keys):
+
+        conn = self._get_connection()
+
+        # Lock the database for writing before reading the buckets
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            query = 'SELECT key, tokens, updated FROM token_buckets WHERE key IN (%s)' % \
+                    ', '.join('?' * len(keys))
+
+            states = dict((key, (tokens, updated)) for key, tokens, updated
+                    in conn.execute(query, keys))
+
+            original = dict(states)
+            yield states
+
+            changed = [(key, tokens, updated) for key, (tokens, updated)
+                    in states.items() if original.get(key) != (tokens, updated)]
+
+            conn.executemany('INSERT OR REPLACE INTO token_buckets '
+                    '(key, tokens, updated) VALUES (?, ?, ?)', changed)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+
+class RateLimiter(object):
+    '''
+    Token bucket rate limiter.
+
+    :param limits: dict with allowed amounts per second of `requests`,
+                   content `blocks` and `bytes`
+    :param burst=1: bucket capacity, in seconds worth of tokens
+    :param store=None: path to an SQLite file to share buckets between
+                       processes, buckets are kept in memory if not set
+    '''
+
+    def __init__(self, limits, burst=1, store=None):
+
+        unknown = set(limits) - set(LIMITS)
+        if unknown:
+            raise ValueError('Unknown rate limits: %s' % ', '.join(sorted(unknown)))
+
+        self.limits = dict((name, float(rate)) for name, rate in limits.items() if rate)
+        self.burst = float(burst)
+
+        self.store = SQLiteBucketStore(store) if store else MemoryBucketStore()
+
+
+    def _get_buckets(self, key, amounts):
+        buckets = []
+        for name, amount in amounts.items():
+            rate = self.limits.get(name)
+            if rate and amount:
+                buckets.append(('%s:%s' % (key, name), rate,
+                    max(rate * self.burst, 1), amount))
+        return buckets
+
+
+    def acquire(self, key, in_response_to='0', **amounts):
+        '''
+        Take `amounts` of `requests`, `blocks` and `bytes` from the
+        buckets of `key`.
+
+        :raises StatusMessageException: with `ST_RETRY` status and an
+                                        estimated wait if a limit is hit
+        '''
+
+        buckets = self._get_buckets(key, amounts)
+        if not buckets:
+            return
+
+        wait = self.store.consume(buckets)
+
+        if wait:
+            log.warning("Rate limit exceeded", key=key, wait=wait, **amounts)
+            raise StatusMessageException(ST_RETRY, message='Rate limit exceeded',
+                    in_response_to=in_response_to,
+                    status_details={SD_ESTIMATED_WAIT: int(math.ceil(wait))})
+
+
+    def charge(self, key, **amounts):
+        '''
+        Take `amounts` from the buckets of `key` even if they do not hold
+        enough tokens, so the following requests have to wait.
+        '''
+
+        buckets = self._get_buckets(key, amounts)
+        if buckets:
+            self.store.consume(buckets, force=True)
@@ -20,9 +20,10 @@ TYPE_TO_SERVICE = dict(
 
 class TAXIIServer(object):
 
-    def __init__(self, domain, persistence_manager, auth_manager):
+    def __init__(self, domain, persistence_manager, auth_manager, pretty_print=False):
 
         self.domain = domain
+        self.pretty_print = pretty_print
 
         self.persistence = persistence_manager
         self.auth = auth_manager
@@ -34,6 +35,9 @@ class TAXIIServer(object):
 
 
     def reload_services(self):
+        for service in self.services:
+            service.stop()
+
         self.services = []
         self.path_to_service = dict()
         self._create_services(self.persistence.get_services())
@@ -101,7 +105,7 @@ def create_server(config=None):
 
     domain = config['domain']
     server = TAXIIServer(domain, persistence_manager=persistence_manager,
-            auth_manager=auth_manager)
+            auth_manager=auth_manager, pretty_print=config.get('xml_pretty_print', False))
 
     return server
 
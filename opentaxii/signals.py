@@ -1,2 +1,3 @@
 
 POST_SAVE_CONTENT_BLOCK = 'post_save.content_block'
+POST_SAVE_COLLECTION = 'post_save.collection'
@@ -0,0 +1,484 @@
+import os
+import time
+import errno
+import Queue
+import socket
+import itertools
+import threading
+import structlog
+
+log = structlog.getLogger(__name__)
+
+INCOMING = 'incoming'
+PROCESSING = 'processing'
+FAILED = 'failed'
+
+RECORD_EXTENSION = '.msg'
+HEADER_SEPARATOR = '\n'
+OWNER_SEPARATOR = '@'
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class RecordRejected(Exception):
+    '''
+    Raised by the processing callable of a :class:`SpoolDrainer` for
+    records that can never be processed, e.g. malformed messages.
+    '''
+    pass
+
+
+class Spool(object):
+    '''
+    Durable on-disk queue of raw messages.
+
+    Every record is written to its own segment file, fsync'ed and atomically
+    renamed into the `incoming` directory, so a record is either fully
+    persisted or not visible at all. Records are claimed for processing by
+    renaming them into the `processing` directory and are removed once
+    processed. Records that failed to process are kept in `failed`.
+
+    Several processes can share a spool. Records taken for processing are
+    tagged with the host, the process ID and a random nonce of their
+    owner, and hold a lease that the owner renews by touching the file.
+    Records are returned to the queue only if their owner is not running
+    anymore or their lease expired. The nonce tells a restarted process
+    reusing the process ID, e.g. in a container, from its predecessor.
+
+    :param path: directory where the spool is kept
+    :param max_size=None: maximum total size in bytes of records
+                          waiting to be processed
+    :param lease=300: seconds a record taken for processing is kept
+                      by its owner without renewal
+    '''
+
+    def __init__(self, path, max_size=None, lease=300):
+
+        self.path = path
+        self.max_size = max_size
+        self.lease = lease
+
+        for name in (INCOMING, PROCESSING, FAILED):
+            directory = os.path.join(path, name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+        self.size = 0
+        self.depth = 0
+
+        self.recover()
+
+        names = self.pending()
+
+        with self._lock:
+            self.depth = len(names)
+            self.size = sum(os.path.getsize(os.path.join(self._dir(INCOMING), n))
+                    for n in names)
+
+        if names:
+            log.info("Spool loaded", path=self.path, spool_depth=self.depth,
+                    spool_size=self.size)
+
+
+    def _dir(self, name):
+        return os.path.join(self.path, name)
+
+
+    @property
+    def owner(self):
+        # Evaluated on every use, as the spool may be shared by forked processes
+        return '%s-%d-%s' % (socket.gethostname(), os.getpid(), _get_nonce())
+
+
+    def _processing_path(self, name):
+        return os.path.join(self._dir(PROCESSING), name + OWNER_SEPARATOR + self.owner)
+
+
+    def recover(self):
+        '''
+        Return records abandoned by their owners to the queue. Returns
+        names of the recovered records.
+        '''
+
+        now = time.time()
+
+        recovered = []
+
+        for entry in os.listdir(self._dir(PROCESSING)):
+
+            name, _, entry_owner = entry.partition(OWNER_SEPARATOR)
+
+            path = os.path.join(self._dir(PROCESSING), entry)
+            incoming = os.path.join(self._dir(INCOMING), name)
+
+            try:
+                expired = now - os.path.getmtime(path) >= self.lease
+                if not expired and _is_running(entry_owner):
+                    continue
+
+                os.rename(path, incoming)
+                size = os.path.getsize(incoming)
+            except OSError:
+                # Completed or recovered by another process meanwhile
+                continue
+
+            with self._lock:
+                self.depth += 1
+                self.size += size
+
+            recovered.append(name)
+
+            log.warning("Spooled record recovered", record=name, owner=entry_owner)
+
+        return recovered
+
+
+    def renew(self, names):
+        '''
+        Renew leases of records taken for processing by this process.
+        '''
+
+        for name in names:
+            try:
+                os.utime(self._processing_path(name), None)
+            except OSError:
+                log.warning("Failed to renew spooled record", record=name, exc_info=True)
+
+
+    def pending(self):
+        names = os.listdir(self._dir(INCOMING))
+        return sorted(n for n in names if n.endswith(RECORD_EXTENSION))
+
+
+    def append(self, header, data):
+        '''
+        Durably store a record and return its name.
+
+        :raises SpoolFull: if the record would make the spool exceed `max_size`
+        '''
+
+        record = header + HEADER_SEPARATOR + data
+
+        with self._lock:
+            if self.max_size and self.size + len(record) > self.max_size:
+                raise SpoolFull("Spool size limit of %d bytes reached" % self.max_size)
+
+            self.size += len(record)
+            self.depth += 1
+
+            name = '%020d-%d-%010d%s' % (int(time.time() * 1e6), os.getpid(),
+                    next(self._counter), RECORD_EXTENSION)
+
+        tmp_path = os.path.join(self.path, name + '.tmp')
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp_path, os.path.join(self._dir(INCOMING), name))
+            _fsync_dir(self._dir(INCOMING))
+        except:
+            with self._lock:
+                self.size -= len(record)
+                self.depth -= 1
+            raise
+
+        return name
+
+
+    def claim(self, name):
+        '''
+        Take a record for processing. Returns `(header, data)` or None if
+        the record was already claimed.
+        '''
+
+        path = self._processing_path(name)
+
+        try:
+            os.rename(os.path.join(self._dir(INCOMING), name), path)
+            # Lease starts now, not when the record was written
+            os.utime(path, None)
+        except OSError:
+            return None
+
+        header, data = self.read(name)
+
+        with self._lock:
+            self.size -= len(header) + len(HEADER_SEPARATOR) + len(data)
+            self.depth -= 1
+
+        return header, data
+
+
+    def read(self, name):
+        '''
+        Return `(header, data)` of a record taken for processing.
+        '''
+
+        with open(self._processing_path(name), 'rb') as f:
+            record = f.read()
+
+        header, _, data = record.partition(HEADER_SEPARATOR)
+        return header, data
+
+
+    def complete(self, name):
+        os.remove(self._processing_path(name))
+
+
+    def fail(self, name):
+        os.rename(self._processing_path(name), os.path.join(self._dir(FAILED), name))
+
+
+    def stats(self):
+        with self._lock:
+            return dict(spool_depth=self.depth, spool_size=self.size)
+
+
+    @staticmethod
+    def get_timestamp(name):
+        return int(name.split('-', 1)[0]) / 1e6
+
+
+class SpoolDrainer(object):
+    '''
+    Pool of worker threads that process records from a spool.
+
+    Records rejected by `process` with :class:`RecordRejected` are moved
+    to the failed records. Records that failed with any other error stay
+    taken for processing and are retried after `retry_delay` seconds,
+    doubled on every attempt up to `retry_max_delay`.
+
+    Leases of records held by the drainer are renewed, and records
+    abandoned by other processes are recovered, every third of the lease
+    of the spool.
+
+    :param spool: :class:`Spool` instance
+    :param process: callable that takes `(header, data)` of a record
+    :param workers=1: number of worker threads
+    :param retry_delay=1: seconds before the first retry of a record
+    :param retry_max_delay=300: maximum seconds between retries
+    '''
+
+    def __init__(self, spool, process, workers=1, retry_delay=1, retry_max_delay=300):
+
+        self.spool = spool
+        self.process = process
+        self.workers = workers
+
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        self.retries = {}
+        self.active = set()
+        self._lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._maintenance = None
+
+        self.last_latency = None
+
+
+    def start(self):
+
+        for name in self.spool.pending():
+            self.queue.put((name, 0))
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                    name='spool-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        self._stopped.clear()
+        self._maintenance = threading.Thread(target=self._maintain,
+                name='spool-maintenance')
+        self._maintenance.daemon = True
+        self._maintenance.start()
+
+
+    def stop(self, timeout=None):
+
+        self._stopped.set()
+        if self._maintenance:
+            self._maintenance.join(timeout)
+            self._maintenance = None
+
+        with self._lock:
+            for timer in self.retries.values():
+                timer.cancel()
+            self.retries = {}
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.threads = []
+
+
+    def notify(self, name):
+        self.queue.put((name, 0))
+
+
+    def join(self):
+        '''
+        Block until every queued record is processed.
+        '''
+        self.queue.join()
+
+
+    def _work(self):
+
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._drain(*item)
+            except Exception:
+                # Spool errors, e.g. of renames, must not stop the worker
+                log.error("Failed to drain spooled record", record=item[0], exc_info=True)
+            finally:
+                self.queue.task_done()
+
+
+    def _maintain(self):
+
+        interval = self.spool.lease / 3.0
+
+        while not self._stopped.wait(interval):
+            try:
+                with self._lock:
+                    active = list(self.active)
+
+                self.spool.renew(active)
+
+                for name in self.spool.recover():
+                    self.notify(name)
+            except Exception:
+                log.error("Failed to maintain spool", exc_info=True)
+
+
+    def _drain(self, name, attempt=0):
+
+        # Retried records are already taken for processing
+        record = self.spool.read(name) if attempt else self.spool.claim(name)
+        if not record:
+            return
+
+        with self._lock:
+            self.active.add(name)
+
+        try:
+            self.process(*record)
+        except RecordRejected:
+            log.error("Spooled record rejected", record=name, exc_info=True)
+            self._release(name)
+            self.spool.fail(name)
+            return
+        except Exception:
+            delay = min(self.retry_delay * 2 ** attempt, self.retry_max_delay)
+            log.warning("Failed to process spooled record", record=name,
+                    attempt=attempt + 1, retry_delay=delay, exc_info=True)
+            self._retry(name, attempt + 1, delay)
+            return
+
+        self._release(name)
+        self.spool.complete(name)
+
+        self.last_latency = time.time() - self.spool.get_timestamp(name)
+
+        log.info("Spooled record processed", record=name,
+                drain_latency=self.last_latency, **self.spool.stats())
+
+
+    def _release(self, name):
+        with self._lock:
+            self.active.discard(name)
+
+
+    def _retry(self, name, attempt, delay):
+
+        def requeue():
+            with self._lock:
+                self.retries.pop(name, None)
+            self.queue.put((name, attempt))
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+
+        with self._lock:
+            self.retries[name] = timer
+
+        timer.start()
+
+
+    def stats(self):
+        stats = self.spool.stats()
+        stats['drain_latency'] = self.last_latency
+        stats['spool_retries'] = len(self.retries)
+        return stats
+
+
+_nonce = None
+_nonce_pid = None
+
+
+def _get_nonce():
+    # Generated again in forked processes
+    global _nonce, _nonce_pid
+
+    if _nonce_pid != os.getpid():
+        _nonce = os.urandom(4).encode('hex')
+        _nonce_pid = os.getpid()
+
+    return _nonce
+
+
+def _is_running(owner):
+    '''
+    Tell if the owner of a record may be running. Only processes of this
+    host can be checked, others are trusted until their lease expires.
+    '''
+
+    parts = owner.rsplit('-', 2)
+    if len(parts) != 3:
+        return True
+
+    host, pid, nonce = parts
+
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+
+    # Owner with the process ID of this process is either this process
+    # or a process that was running before it
+    if int(pid) == os.getpid():
+        return nonce == _get_nonce()
+
+    try:
+        os.kill(int(pid), 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
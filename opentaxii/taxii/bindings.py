@@ -6,13 +6,35 @@ from libtaxii.constants import (
     CB_STIX_XML_10, CB_STIX_XML_101, CB_STIX_XML_11, CB_STIX_XML_111,
     VID_TAXII_HTTP_10, VID_TAXII_HTTPS_10,
     VID_TAXII_XML_10, VID_TAXII_XML_11,
-    VID_TAXII_SERVICES_10, VID_TAXII_SERVICES_11
+    VID_TAXII_SERVICES_10, VID_TAXII_SERVICES_11,
+    ns_map
 )
 
 from collections import namedtuple
+from functools import partial
+
+from lxml import etree
 
 ValidatorAndParser = namedtuple('ValidatorAndParser', ['validator', 'parser'])
 
+
+def get_message_from_etree(module, etree_xml):
+    '''
+    Create a TAXII message from an already parsed etree, the same way
+    `get_message_from_xml` of the libtaxii module does from a string.
+    '''
+
+    qn = etree.QName(etree_xml)
+    if qn.namespace != MESSAGE_NAMESPACES[module]:
+        raise ValueError('Unsupported namespace: %s' % qn.namespace)
+
+    for cls in MESSAGE_CLASSES[module]:
+        if cls.message_type == qn.localname:
+            return cls.from_etree(etree_xml)
+
+    raise ValueError('Unknown message_type: %s' % qn.localname)
+
+
 CONTENT_BINDINGS = [
     CB_STIX_XML_10,
     CB_STIX_XML_101,
@@ -40,9 +62,30 @@ SERVICE_BINDINGS = [
     VID_TAXII_SERVICES_11
 ]
 
+MESSAGE_NAMESPACES = {
+    tm10: ns_map['taxii'],
+    tm11: ns_map['taxii_11']
+}
+
+MESSAGE_CLASSES = {
+    tm10: [
+        tm10.DiscoveryRequest, tm10.DiscoveryResponse,
+        tm10.FeedInformationRequest, tm10.FeedInformationResponse,
+        tm10.PollRequest, tm10.PollResponse, tm10.StatusMessage, tm10.InboxMessage,
+        tm10.ManageFeedSubscriptionRequest, tm10.ManageFeedSubscriptionResponse
+    ],
+    tm11: [
+        tm11.DiscoveryRequest, tm11.DiscoveryResponse,
+        tm11.CollectionInformationRequest, tm11.CollectionInformationResponse,
+        tm11.PollRequest, tm11.PollResponse, tm11.StatusMessage, tm11.InboxMessage,
+        tm11.ManageCollectionSubscriptionRequest, tm11.ManageCollectionSubscriptionResponse,
+        tm11.PollFulfillmentRequest
+    ]
+}
+
 MESSAGE_VALIDATOR_PARSER = {
-    VID_TAXII_XML_10: ValidatorAndParser(SchemaValidator(SchemaValidator.TAXII_10_SCHEMA), tm10.get_message_from_xml),
-    VID_TAXII_XML_11: ValidatorAndParser(SchemaValidator(SchemaValidator.TAXII_11_SCHEMA), tm11.get_message_from_xml)
+    VID_TAXII_XML_10: ValidatorAndParser(SchemaValidator(SchemaValidator.TAXII_10_SCHEMA), partial(get_message_from_etree, tm10)),
+    VID_TAXII_XML_11: ValidatorAndParser(SchemaValidator(SchemaValidator.TAXII_11_SCHEMA), partial(get_message_from_etree, tm11))
 }
 
 
@@ -0,0 +1,65 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    '''
+    LRU cache of serialized poll result parts, holding at most `size`
+    parts.
+
+    Keys start with a collection ID and end with the generation of the
+    collection returned by :meth:`get_generation`. Saving content to a
+    collection bumps its generation, so parts cached before are not found
+    anymore and are evicted as least recently used. A part computed while
+    content was saved is stored under the generation it was computed for
+    and is never returned.
+
+    Parts expire after `ttl` seconds, unless they are cached as permanent.
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+
+        self._parts = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+
+    def get_generation(self, collection_id):
+        return self._generations.get(collection_id, 0)
+
+
+    def invalidate(self, collection_id):
+        with self._lock:
+            self._generations[collection_id] = self.get_generation(collection_id) + 1
+
+
+    def get(self, key):
+
+        with self._lock:
+            cached = self._parts.pop(key, None)
+            if not cached:
+                return None
+
+            expires, part = cached
+            if expires and expires <= time.time():
+                return None
+
+            self._parts[key] = cached
+
+        return part
+
+
+    def set(self, key, part, permanent=False):
+
+        expires = time.time() + self.ttl if self.ttl and not permanent else None
+
+        with self._lock:
+            self._parts.pop(key, None)
+            self._parts[key] = (expires, part)
+
+            while len(self._parts) > self.size:
+                self._parts.popitem(last=False)
@@ -9,6 +9,7 @@ from libtaxii.constants import (
 from .entities import (
     ContentBindingEntity, InboxMessageEntity, ContentBlockEntity
 )
+from .serialization import StoredContentBlock10, StoredContentBlock11
 
 
 
@@ -213,11 +214,14 @@ def subscription_to_subscription_instance(subscription, polling_services,
 
 
 
-def inbox_message_to_inbox_message_entity(inbox_message, service_id, version):
+def inbox_message_to_inbox_message_entity(inbox_message, service_id, version,
+        original_message=None, compress_original_message=False, idempotency_key=None):
 
     params = dict(
         message_id = inbox_message.message_id,
-        original_message = inbox_message.to_xml(), #FIXME: raw?
+        original_message = original_message,
+        compress_original_message = compress_original_message,
+        idempotency_key = idempotency_key,
         content_block_count = len(inbox_message.content_blocks),
         service_id = service_id
     )
@@ -284,15 +288,16 @@ def content_block_entity_to_content_block(entity, version):
 
     content_bindings = content_binding_entity_to_content_binding(entity.content_binding, version=version)
 
+    # Content is not parsed until the block is serialized by libtaxii
     if version == 10:
-        return tm10.ContentBlock(
+        return StoredContentBlock10(
             content_binding = content_bindings,
             content = entity.content,
             timestamp_label = entity.timestamp_label,
         )
 
     elif version == 11:
-        return tm11.ContentBlock(
+        return StoredContentBlock11(
             content_binding = content_bindings,
             content = entity.content,
             timestamp_label = entity.timestamp_label,
@@ -4,7 +4,7 @@ from libtaxii.constants import (
     RT_FULL
 )
 
-from .utils import is_content_supported
+from .utils import ContentBindingMatcher
 
 class Entity(object):
 
@@ -38,7 +38,8 @@ class CollectionEntity(Entity):
     TYPE_SET = CT_DATA_SET
 
     def __init__(self, name, id=None, description=None, type=TYPE_FEED,
-            accept_all_content=False, supported_content=[], available=True):
+            accept_all_content=False, supported_content=[], available=True,
+            compress_content=False, validate_content=False):
 
         self.id = id
         self.name = name
@@ -51,8 +52,10 @@ class CollectionEntity(Entity):
 
         self.description = description
         self.accept_all_content = accept_all_content
+        self.compress_content = compress_content
+        self.validate_content = validate_content
 
-        self.supported_content = []
+        bindings = []
         for content in supported_content:
             if isinstance(content, basestring):
                 binding = ContentBindingEntity(content)
@@ -64,14 +67,27 @@ class CollectionEntity(Entity):
             else:
                 raise ValueError('Unknown content binding "%s"' % content)
 
-            self.supported_content.append(binding)
+            bindings.append(binding)
+
+        self.supported_content = bindings
+
+
+    @property
+    def supported_content(self):
+        return self._supported_content
+
+
+    @supported_content.setter
+    def supported_content(self, bindings):
+        self._supported_content = bindings
+        self._matcher = ContentBindingMatcher(bindings)
 
 
     def is_content_supported(self, content_binding):
         if self.accept_all_content:
             return True
 
-        return is_content_supported(self.supported_content, content_binding)
+        return self._matcher.matches(content_binding)
 
 
     def get_matching_bindings(self, requested_bindings):
@@ -89,25 +105,27 @@ class CollectionEntity(Entity):
         overlap = []
 
         for requested in requested_bindings:
-            for supported in supported_bindings:
 
-                if requested.binding != supported.binding:
-                    continue
+            if requested.binding not in self._matcher:
+                continue
 
-                if not supported.subtypes:
-                    overlap.append(requested)
-                    continue
+            subtypes = self._matcher.get_subtypes(requested.binding)
 
-                if not requested.subtypes:
-                    overlap.append(supported)
-                    continue
-
-                subtypes_overlap = set(supported.subtypes).intersection(requested.subtypes)
+            if subtypes is None:
+                overlap.append(requested)
+                continue
 
+            if not requested.subtypes:
                 overlap.append(ContentBindingEntity(
-                    binding = requested.binding, 
-                    subtypes = subtypes_overlap
+                    binding = requested.binding,
+                    subtypes = list(subtypes)
                 ))
+                continue
+
+            overlap.append(ContentBindingEntity(
+                binding = requested.binding,
+                subtypes = subtypes.intersection(requested.subtypes)
+            ))
 
         return overlap
 
@@ -119,11 +137,12 @@ class CollectionEntity(Entity):
 class ContentBlockEntity(Entity):
 
     def __init__(self, content, timestamp_label, content_binding=None, id=None,
-            message=None, inbox_message_id=None):
+            message=None, inbox_message_id=None, date_created=None):
 
         self.content = content
 
         self.id = id
+        self.date_created = date_created
         self.timestamp_label = timestamp_label
         self.content_binding = content_binding
         self.message = message
@@ -136,12 +155,18 @@ class InboxMessageEntity(Entity):
             service_id, id=None, result_id=None, destination_collections=[],
             record_count=None, partial_count=False, subscription_collection_name=None,
             subscription_id=None, exclusive_begin_timestamp_label=None,
-            inclusive_end_timestamp_label=None):
+            inclusive_end_timestamp_label=None, compress_original_message=False,
+            idempotency_key=None, rejected_blocks=[], completed=None):
 
         self.id = id
 
         self.message_id = message_id
         self.original_message = original_message
+        self.compress_original_message = compress_original_message
+
+        self.idempotency_key = idempotency_key
+        self.rejected_blocks = rejected_blocks
+        self.completed = completed
         self.content_block_count = content_block_count
 
         self.service_id = service_id
@@ -162,7 +187,8 @@ class InboxMessageEntity(Entity):
 
 class ResultSetEntity(Entity):
 
-    def __init__(self, result_id, collection_id, content_bindings=[], timeframe=None):
+    def __init__(self, result_id, collection_id, content_bindings=[], timeframe=None,
+            high_water_mark=None, ready=None, blocks_count=None):
 
         self.result_id = result_id
 
@@ -170,6 +196,14 @@ class ResultSetEntity(Entity):
         self.content_bindings = content_bindings
         self.timeframe = timeframe
 
+        # `(date_created, id)` of the last block visible at creation
+        self.high_water_mark = high_water_mark
+
+        # None if the result set is computed on request, False while
+        # the result set is being materialized
+        self.ready = ready
+        self.blocks_count = blocks_count
+
 
 class SubscriptionParameters(Entity):
 
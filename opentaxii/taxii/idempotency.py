@@ -0,0 +1,108 @@
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def get_idempotency_key(service_id, message_id, account_id=None):
+    digest = hashlib.sha256()
+    for part in (service_id, message_id, account_id):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update(str(part) if part is not None else '')
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class BloomFilter(object):
+    '''
+    Set of hex digests that can only tell for sure if a digest
+    was never added.
+
+    :param size: amount of bits in the filter
+    :param hashes: amount of bits set for every digest
+    '''
+
+    def __init__(self, size, hashes=4):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+
+    def _positions(self, digest):
+        # Digest is already a hash, so its slices are used as independent hashes
+        for i in range(self.hashes):
+            yield int(digest[i * 8:(i + 1) * 8], 16) % self.size
+
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+
+    def __contains__(self, digest):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                for position in self._positions(digest))
+
+
+class ProcessedMessages(object):
+    '''
+    In-memory front of the processed inbox messages stored in the database.
+
+    Recently processed messages are kept in an LRU cache. A Bloom filter
+    of all keys seen by the process tells which keys can not belong to a
+    processed message, so new messages are recognised without a query.
+    Keys seen by other processes are caught by the unique index of
+    the database.
+
+    :param lookup: callable that takes an idempotency key and returns
+                   the rejected blocks of a processed message, or None
+                   if there is no such message
+    :param cache_size=1000: amount of messages kept in the LRU cache
+    :param filter_size=1048576: amount of bits in the Bloom filter
+    '''
+
+    def __init__(self, lookup, cache_size=1000, filter_size=2 ** 20):
+
+        self.lookup = lookup
+        self.cache_size = cache_size
+
+        self.cache = OrderedDict()
+        self.seen = BloomFilter(filter_size)
+
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        Return the rejected blocks of the processed message with the key,
+        or None if the message was not processed.
+        '''
+
+        with self._lock:
+            if key in self.cache:
+                rejected = self.cache.pop(key)
+                self.cache[key] = rejected
+                return rejected
+
+            if key not in self.seen:
+                return None
+
+        rejected = self.lookup(key)
+
+        if rejected is not None:
+            self.add(key, rejected)
+
+        return rejected
+
+
+    def add(self, key, rejected):
+
+        with self._lock:
+            self.seen.add(key)
+
+            self.cache.pop(key, None)
+            self.cache[key] = rejected
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
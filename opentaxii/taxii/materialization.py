@@ -0,0 +1,119 @@
+import time
+import Queue
+import threading
+import structlog
+
+log = structlog.getLogger(__name__)
+
+
+class ResultSetMaterializer(object):
+    '''
+    Pool of worker threads that materialize result sets in the background.
+
+    :param materialize: callable that takes a result set ID
+    :param workers=1: number of worker threads
+    '''
+
+    def __init__(self, materialize, workers=1):
+
+        self.materialize = materialize
+        self.workers = workers
+
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        self.queued = set()
+        self._lock = threading.Lock()
+
+        self.last_duration = None
+
+
+    def start(self):
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                    name='materialization-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def stop(self, timeout=None):
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.threads = []
+
+
+    def submit(self, result_id):
+        '''
+        Queue a result set, unless it is already queued or being
+        materialized.
+        '''
+
+        with self._lock:
+            if result_id in self.queued:
+                return
+            self.queued.add(result_id)
+
+        self.queue.put(result_id)
+
+
+    def join(self):
+        '''
+        Block until every queued result set is materialized.
+        '''
+        self.queue.join()
+
+
+    @property
+    def depth(self):
+        return len(self.queued)
+
+
+    def get_wait_time(self, default):
+        '''
+        Estimate in seconds how long a result set queued now waits to be
+        materialized, from the queue depth and the duration of the last
+        materialization. `default` is returned before anything was
+        materialized.
+        '''
+
+        if self.last_duration is None:
+            return default
+
+        rounds = self.depth // max(self.workers, 1) + 1
+        return max(1, int(round(rounds * self.last_duration)))
+
+
+    def _work(self):
+
+        while True:
+            result_id = self.queue.get()
+            try:
+                if result_id is None:
+                    return
+                self._materialize(result_id)
+            finally:
+                self.queue.task_done()
+
+
+    def _materialize(self, result_id):
+
+        started = time.time()
+
+        try:
+            self.materialize(result_id)
+        except Exception:
+            log.error("Failed to materialize result set", result_id=result_id,
+                    exc_info=True)
+            return
+        finally:
+            with self._lock:
+                self.queued.discard(result_id)
+
+        self.last_duration = time.time() - started
@@ -0,0 +1,152 @@
+import itertools
+import threading
+import structlog
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .converters import parse_content_binding
+from .entities import ContentBlockEntity
+
+log = structlog.getLogger(__name__)
+
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+POOL_TYPES = {
+    POOL_THREAD : ThreadPool,
+    POOL_PROCESS : Pool,
+}
+
+
+class WorkerPool(object):
+    '''
+    Pool of workers that applies a function to a list of items,
+    keeping the order of the results.
+
+    The pool is started on first use. If `workers` is 0, items are
+    processed in the calling thread.
+
+    :param workers=0: number of workers
+    :param pool_type='thread': `thread` or `process`
+    '''
+
+    def __init__(self, workers=0, pool_type=POOL_THREAD):
+
+        if pool_type not in POOL_TYPES:
+            raise ValueError('Unknown pool type: %s' % pool_type)
+
+        self.workers = workers
+        self.pool_type = pool_type
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+
+    def map(self, func, items):
+
+        if not self.workers:
+            return map(func, items)
+
+        # Exceptions raised by a worker are re-raised here
+        return self._get_pool().map(func, items)
+
+
+    def _get_pool(self):
+        with self._lock:
+            if not self._pool:
+                self._pool = POOL_TYPES[self.pool_type](self.workers)
+            return self._pool
+
+
+    def stop(self):
+        with self._lock:
+            if self._pool:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+class ContentBlockProcessor(object):
+    '''
+    Per-block stage of the inbox pipeline: checks if a content block is
+    supported and converts it into an entity.
+
+    Instances are picklable, so they can be sent to a process pool.
+    Content blocks parsed from XML hold lxml elements that can not be
+    pickled, so an instance is called with the fields of a block returned
+    by :meth:`get_fields` and returns a tuple
+    `(content_block_entity, collections)` or None if the block should be
+    skipped.
+
+    :param version: TAXII version of the message, 10 or 11
+    :param content_matcher: :class:`opentaxii.taxii.utils.ContentBindingMatcher`
+                            of the service, None if all content is accepted
+    :param collections: collections the blocks are destined to
+    :param filter_collections=False: if True, a block is attached only to
+                                     collections that support its binding
+    '''
+
+    def __init__(self, version, content_matcher, collections,
+            filter_collections=False):
+
+        self.version = version
+        self.content_matcher = content_matcher
+        self.collections = collections
+        self.filter_collections = filter_collections
+
+
+    @staticmethod
+    def get_fields(content_block):
+        '''
+        Return a picklable tuple `(content_binding, content, timestamp_label,
+        message)` of a libtaxii content block, with serialized content.
+        '''
+
+        return (content_block.content_binding, content_block.content,
+                content_block.timestamp_label, getattr(content_block, 'message', None))
+
+
+    def __call__(self, fields):
+
+        binding, content, timestamp_label, message = fields
+
+        # FIXME: is it correct to skip unsupported content blocks?
+        # 3.2 Inbox Exchange, http://taxii.mitre.org/specifications/version1.1/TAXII_Services_Specification.pdf
+        if self.content_matcher and not self.content_matcher.matches(binding,
+                version=self.version):
+            log.warning("Content block binding is not supported: %s" % binding)
+            return None
+
+        if self.filter_collections:
+            collections = [c for c in self.collections if c.is_content_supported(binding)]
+        else:
+            collections = self.collections
+
+        block = ContentBlockEntity(
+            id = None,
+            message = message if self.version == 11 else None,
+            content = content,
+            timestamp_label = timestamp_label,
+            content_binding = parse_content_binding(binding, version=self.version)
+        )
+
+        return block, collections
+
+
+def batches(items, size=None):
+    '''
+    Split an iterable into lists of `size` items, or into a single list
+    if `size` is not set.
+    '''
+
+    if not size:
+        yield list(items)
+        return
+
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,411 @@
+'''
+Fast XML serialization of the most frequent TAXII responses.
+
+Poll responses, status messages and discovery responses are written as
+text directly from libtaxii message attributes, without building an
+element tree. Stored content of content blocks is spliced into the
+document as is. Other messages, and messages with extended headers,
+are serialized by libtaxii.
+'''
+import re
+
+from lxml import etree
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.common import get_xml_parser
+from libtaxii.constants import NS_MAP
+
+INDENT = '  '
+
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+
+NAMESPACE_ATTRIBUTES = sorted(('xmlns:%s' % prefix, uri) for prefix, uri in NS_MAP.items())
+
+PREFIXES = {
+    tm10: 'taxii',
+    tm11: 'taxii_11',
+}
+
+TEXT_ENTITIES = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')]
+ATTRIBUTE_ENTITIES = TEXT_ENTITIES + [('"', '&quot;'), ('\n', '&#10;'),
+        ('\r', '&#13;'), ('\t', '&#9;')]
+
+
+class StoredContentBlockMixin(object):
+    '''
+    Content block keeping the content as it was stored. libtaxii parses
+    the content of every block it creates, here it is parsed only when
+    the block is serialized by libtaxii.
+    '''
+
+    def _stringify_content(self, content):
+        if isinstance(content, basestring):
+            return content, False
+        return super(StoredContentBlockMixin, self)._stringify_content(content)
+
+    @property
+    def stored_content(self):
+        '''
+        Content as stored, None once it was parsed.
+        '''
+        return None if self.content_is_xml else self._content
+
+    def to_etree(self):
+        self._content, self.content_is_xml = \
+                super(StoredContentBlockMixin, self)._stringify_content(self._content)
+        return super(StoredContentBlockMixin, self).to_etree()
+
+
+class StoredContentBlock10(StoredContentBlockMixin, tm10.ContentBlock):
+    pass
+
+
+class StoredContentBlock11(StoredContentBlockMixin, tm11.ContentBlock):
+    pass
+
+
+class Raw(object):
+    '''
+    Serialized XML inserted into a document without changes.
+    '''
+
+    def __init__(self, xml):
+        self.xml = xml
+
+
+def escape(value, entities=TEXT_ENTITIES):
+    if not isinstance(value, basestring):
+        value = str(value)
+    for char, entity in entities:
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+def to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def element(tag, attributes=(), text=None, children=()):
+    '''
+    Element node: a tuple of the prefixed tag, a list of `(name, value)`
+    attribute pairs, text and child nodes. Attributes with None value
+    are skipped.
+    '''
+    return (tag, attributes, text, children)
+
+
+def start_tag(tag, attributes):
+    return '<' + tag + ''.join(' %s="%s"' % (name, to_utf8(escape(value, ATTRIBUTE_ENTITIES)))
+            for name, value in attributes if value is not None)
+
+
+def render(node, pretty_print=False, depth=0):
+    '''
+    Generator of XML fragments of a node.
+    '''
+
+    indent = INDENT * depth if pretty_print else ''
+    newline = '\n' if pretty_print else ''
+
+    if isinstance(node, Raw):
+        yield indent + node.xml + newline
+        return
+
+    tag, attributes, text, children = node
+
+    start = start_tag(tag, attributes)
+
+    if text is not None:
+        yield '%s%s>%s</%s>%s' % (indent, start, to_utf8(escape(text)), tag, newline)
+        return
+
+    children = iter(children)
+    first = next(children, None)
+
+    if first is None:
+        yield indent + start + '/>' + newline
+        return
+
+    yield indent + start + '>' + newline
+
+    for fragment in render(first, pretty_print, depth + 1):
+        yield fragment
+    for child in children:
+        for fragment in render(child, pretty_print, depth + 1):
+            yield fragment
+
+    yield indent + '</' + tag + '>' + newline
+
+
+def format_boolean(value):
+    return None if value is None else str(value).lower()
+
+
+def format_timestamp(value):
+    return value.isoformat() if value else None
+
+
+def optional(tag, text):
+    if text is not None:
+        yield element(tag, text=text)
+
+
+def is_xml(content):
+    '''
+    Tell if `content` is well-formed XML, as libtaxii does before it
+    inserts content as XML.
+    '''
+
+    try:
+        etree.fromstring(content, get_xml_parser())
+    except (etree.XMLSyntaxError, ValueError):
+        return False
+
+    return True
+
+
+def content_node(tag, block):
+    stored = getattr(block, 'stored_content', None)
+
+    if stored is not None:
+        # Stored content parsed by libtaxii on arrival was saved as
+        # serialized XML, anything else is text. Only content that looks
+        # like XML is parsed, to tell it from text starting with markup.
+        if stored.lstrip().startswith('<'):
+            xml = to_utf8(XML_DECLARATION.sub('', stored, count=1))
+            if is_xml(xml):
+                return element(tag, children=[Raw(xml)])
+        return element(tag, text=stored)
+
+    if block.content_is_xml:
+        return element(tag, children=[Raw(block.content)])
+
+    return element(tag, text=block.content)
+
+
+def content_block_10(block):
+    p = 'taxii:'
+    return element(p + 'Content_Block', children=[
+        element(p + 'Content_Binding', text=block.content_binding),
+        content_node(p + 'Content', block),
+    ] + list(optional(p + 'Timestamp_Label', format_timestamp(block.timestamp_label)))
+      + list(optional(p + 'Padding', block.padding)))
+
+
+def content_binding_11(binding):
+    p = 'taxii_11:'
+    return element(p + 'Content_Binding', [('binding_id', binding.binding_id)],
+            children=[element(p + 'Subtype', [('subtype_id', s)]) for s in binding.subtype_ids])
+
+
+def content_block_11(block):
+    p = 'taxii_11:'
+    return element(p + 'Content_Block', children=[
+        content_binding_11(block.content_binding),
+        content_node(p + 'Content', block),
+    ] + list(optional(p + 'Timestamp_Label', format_timestamp(block.timestamp_label)))
+      + list(optional(p + 'Message', block.message))
+      + list(optional(p + 'Padding', block.padding)))
+
+
+def content_block_nodes(content_blocks, get_node):
+    for block in content_blocks:
+        yield block if isinstance(block, Raw) else get_node(block)
+
+
+def serialize_content_block(block, pretty_print=False):
+    '''
+    Serialize a content block ahead of its message. The returned
+    :class:`Raw` node can be written in place of the block.
+    '''
+
+    if isinstance(block, tm10.ContentBlock):
+        node = content_block_10(block)
+    else:
+        node = content_block_11(block)
+
+    xml = ''.join(render(node, pretty_print, depth=1))
+
+    if pretty_print:
+        # Indentation of the first line and the newline are added back
+        # when the node is written
+        xml = xml[len(INDENT):-1]
+
+    return Raw(xml)
+
+
+def poll_response_10(message, content_blocks):
+    p = 'taxii:'
+    attributes = [('feed_name', message.feed_name),
+            ('subscription_id', message.subscription_id)]
+
+    children = list(optional(p + 'Message', message.message))
+    children += optional(p + 'Inclusive_Begin_Timestamp',
+            format_timestamp(message.inclusive_begin_timestamp_label))
+    children.append(element(p + 'Inclusive_End_Timestamp',
+        text=message.inclusive_end_timestamp_label.isoformat()))
+
+    return attributes, children, content_block_nodes(content_blocks, content_block_10)
+
+
+def poll_response_11(message, content_blocks):
+    p = 'taxii_11:'
+    attributes = [('collection_name', message.collection_name),
+            ('result_id', message.result_id),
+            ('more', format_boolean(message.more)),
+            ('result_part_number', message.result_part_number)]
+
+    children = list(optional(p + 'Subscription_ID', message.subscription_id))
+    children += optional(p + 'Exclusive_Begin_Timestamp',
+            format_timestamp(message.exclusive_begin_timestamp_label))
+    children += optional(p + 'Inclusive_End_Timestamp',
+            format_timestamp(message.inclusive_end_timestamp_label))
+
+    if message.record_count:
+        count = message.record_count
+        children.append(element(p + 'Record_Count',
+            [('partial_count', format_boolean(count.partial_count))],
+            text=count.record_count))
+
+    children += optional(p + 'Message', message.message)
+
+    return attributes, children, content_block_nodes(content_blocks, content_block_11)
+
+
+def status_message_10(message, content_blocks):
+    p = 'taxii:'
+    children = list(optional(p + 'Status_Detail', message.status_detail))
+    children += optional(p + 'Message', message.message)
+    return [('status_type', message.status_type)], children, ()
+
+
+def status_message_11(message, content_blocks):
+    p = 'taxii_11:'
+    children = []
+
+    if message.status_detail:
+        details = []
+        for name, value in message.status_detail.iteritems():
+            for item in (value if isinstance(value, list) else [value]):
+                text = str(item).lower() if item in (True, False) else item
+                details.append(element(p + 'Detail', [('name', name)], text=text))
+        children.append(element(p + 'Status_Detail', children=details))
+
+    children += optional(p + 'Message', message.message)
+
+    return [('status_type', message.status_type)], children, ()
+
+
+def service_instance_10(instance):
+    p = 'taxii:'
+    attributes = [('service_type', instance.service_type),
+            ('service_version', instance.services_version),
+            ('available', format_boolean(instance.available) if instance.available else None)]
+
+    children = [element(p + 'Protocol_Binding', text=instance.protocol_binding),
+            element(p + 'Address', text=instance.service_address)]
+    children += [element(p + 'Message_Binding', text=b) for b in instance.message_bindings]
+    children += [element(p + 'Content_Binding', text=b)
+            for b in instance.inbox_service_accepted_content]
+    children += optional(p + 'Message', instance.message)
+
+    return element(p + 'Service_Instance', attributes, children=children)
+
+
+def service_instance_11(instance):
+    p = 'taxii_11:'
+    attributes = [('service_type', instance.service_type),
+            ('service_version', instance.services_version),
+            ('available', format_boolean(instance.available))]
+
+    children = [element(p + 'Protocol_Binding', text=instance.protocol_binding),
+            element(p + 'Address', text=instance.service_address)]
+    children += [element(p + 'Message_Binding', text=b) for b in instance.message_bindings]
+
+    for query in instance.supported_query:
+        if type(query) is tm11.SupportedQuery:
+            children.append(element(p + 'Supported_Query', [('format_id', query.format_id)]))
+        else:
+            # Query formats carry their own information
+            children.append(Raw(etree.tostring(query.to_etree())))
+
+    children += [content_binding_11(b) for b in instance.inbox_service_accepted_content]
+    children += optional(p + 'Message', instance.message)
+
+    return element(p + 'Service_Instance', attributes, children=children)
+
+
+def discovery_response_10(message, content_blocks):
+    return [], map(service_instance_10, message.service_instances), ()
+
+
+def discovery_response_11(message, content_blocks):
+    return [], map(service_instance_11, message.service_instances), ()
+
+
+WRITERS = {
+    tm10.PollResponse: (tm10, poll_response_10),
+    tm11.PollResponse: (tm11, poll_response_11),
+    tm10.StatusMessage: (tm10, status_message_10),
+    tm11.StatusMessage: (tm11, status_message_11),
+    tm10.DiscoveryResponse: (tm10, discovery_response_10),
+    tm11.DiscoveryResponse: (tm11, discovery_response_11),
+}
+
+
+def iter_message_xml(message, pretty_print=False, content_blocks=None):
+    '''
+    Generator of XML fragments of a message: the root start tag, every
+    child element, with each content block in a fragment of its own, and
+    the root end tag.
+
+    `content_blocks` replaces content blocks of the message, so blocks
+    can be produced while the message is written. Content blocks of poll
+    responses can be serialized beforehand with
+    :func:`serialize_content_block`.
+    '''
+
+    writer = WRITERS.get(type(message))
+
+    if not writer or message.extended_headers:
+        if content_blocks is not None:
+            message.content_blocks = list(content_blocks)
+        yield message.to_xml(pretty_print=pretty_print)
+        return
+
+    if content_blocks is None:
+        content_blocks = getattr(message, 'content_blocks', None) or []
+
+    module, get_nodes = writer
+    attributes, children, blocks = get_nodes(message, content_blocks)
+
+    tag = '%s:%s' % (PREFIXES[module], message.message_type)
+
+    attributes = NAMESPACE_ATTRIBUTES + [('message_id', message.message_id),
+            ('in_response_to', message.in_response_to)] + attributes
+
+    newline = '\n' if pretty_print else ''
+
+    children = iter(children)
+    blocks = iter(blocks)
+
+    first = next(children, None) or next(blocks, None)
+    if first is None:
+        yield ''.join(render(element(tag, attributes), pretty_print))
+        return
+
+    yield start_tag(tag, attributes) + '>' + newline
+
+    for child in [[first], children, blocks]:
+        for node in child:
+            yield ''.join(render(node, pretty_print, depth=1))
+
+    yield '</%s>%s' % (tag, newline)
+
+
+def message_to_xml(message, pretty_print=False):
+    return ''.join(iter_message_xml(message, pretty_print=pretty_print))
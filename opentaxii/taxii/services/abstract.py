@@ -1,5 +1,6 @@
 import structlog
 import hashlib
+import threading
 
 from libtaxii.common import generate_message_id
 from libtaxii.constants import (
@@ -7,6 +8,7 @@ from libtaxii.constants import (
     VID_TAXII_HTTPS_10
 )
 
+from ...ratelimit import RateLimiter
 from ..exceptions import StatusMessageException, raise_failure
 from ..bindings import PROTOCOL_TO_SCHEME
 from ..converters import service_to_service_instances
@@ -22,11 +24,26 @@ class TaxiiService(object):
 
     authentication_required = False
 
+    max_body_size = None
+    streaming = False
+
+    # If True, the request body and the account of the request are passed
+    # to the handler as `raw_message` and `account`
+    accepts_request_details = False
+
+    validate_envelope_only = False
+
+    rate_limiter = None
+
+    started = False
+
     supported_message_bindings = [VID_TAXII_XML_10, VID_TAXII_XML_11]
     supported_protocol_bindings = [VID_TAXII_HTTPS_10]
 
     def __init__(self, id, server, address, description=None,
-            protocol_bindings=[], enabled=True, authentication_required=False):
+            protocol_bindings=[], enabled=True, authentication_required=False,
+            max_body_size=None, validate_envelope_only=False, rate_limits=None,
+            rate_limit_burst=1, rate_limit_store=None):
 
         self.id = id
         self.server = server
@@ -37,15 +54,27 @@ class TaxiiService(object):
         self.enabled = enabled
         self.authentication_required = authentication_required
 
+        self.max_body_size = int(max_body_size) if max_body_size else None
+        self.validate_envelope_only = validate_envelope_only
+
+        if rate_limits:
+            self.rate_limiter = RateLimiter(rate_limits, burst=rate_limit_burst,
+                    store=rate_limit_store)
+
         self.log = structlog.getLogger("%s.%s" % (self.__module__,
             self.__class__.__name__), service_id=id)
 
+        self._start_lock = threading.Lock()
+
 
     def generate_id(self):
         return generate_message_id()
 
 
-    def process(self, headers, message):
+    def process(self, headers, message, **kwargs):
+
+        if not self.started:
+            self._start_once()
 
         self.log.info("Processing message", message_id=message.message_id,
                 message_type=message.message_type, message_version=message.version)
@@ -56,7 +85,7 @@ class TaxiiService(object):
         handler.verify_message_is_supported(message)
 
         try:
-            response_message = handler.handle_message(self, message)
+            response_message = handler.handle_message(self, message, **kwargs)
         except StatusMessageException:
             raise
         except Exception:
@@ -70,6 +99,28 @@ class TaxiiService(object):
         return response_message
 
 
+    def start(self):
+        '''
+        Start background workers of the service.
+
+        Workers are started when the service processes its first message,
+        so command line tools never start them and every process of a
+        preforking server starts its own.
+        '''
+        pass
+
+
+    def _start_once(self):
+        with self._start_lock:
+            if not self.started:
+                self.start()
+                self.started = True
+
+
+    def stop(self):
+        pass
+
+
     def get_message_handler(self, message):
         try:
             return self.handlers[message.message_type]
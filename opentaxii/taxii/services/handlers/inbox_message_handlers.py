@@ -1,3 +1,4 @@
+import sys
 import structlog
 
 import libtaxii.messages_11 as tm11
@@ -6,54 +7,162 @@ from libtaxii.constants import ST_SUCCESS
 
 from .base_handlers import BaseMessageHandler
 from ...exceptions import raise_failure
-from ...converters import (
-    inbox_message_to_inbox_message_entity,
-    content_block_to_content_block_entity
-)
+from ....persistence.exceptions import DuplicateInboxMessage
+from ...converters import inbox_message_to_inbox_message_entity
+from ...validation import SD_REJECTED_CONTENT_BLOCK
 
 log = structlog.getLogger(__name__)
 
-class InboxMessage11Handler(BaseMessageHandler):
 
-    supported_request_messages = [tm11.InboxMessage]
+class ContentBlocksWriter(object):
+    '''
+    Accumulates content blocks and persists them in batches.
 
-    @classmethod
-    def handle_message(cls, service, request):
+    If `batch_size` is not set, all blocks are persisted at once on `flush`.
+    '''
 
-        collections = service.validate_destination_collection_names(
-                request.destination_collection_names, request.message_id)
+    def __init__(self, service, inbox_message, batch_size=None):
+        self.service = service
+        self.inbox_message = inbox_message
+        self.batch_size = batch_size
+
+        self.blocks = []
+        self.collections = []
+
+    def add(self, block, collections):
+        self.blocks.append(block)
+        self.collections.append(collections)
+
+        if self.batch_size and len(self.blocks) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.service.server.persistence.create_content_blocks(self.blocks,
+                inbox_message=self.inbox_message, collections=self.collections)
+
+        self.blocks = []
+        self.collections = []
+
+
+def get_rejected_details(rejected):
+    return ['%d: %s' % (index, error) for index, error in rejected]
+
+
+def store_inbox_message(service, request, version, raw_message=None, account=None):
+    '''
+    Persist the inbox message. Returns None if the message was already
+    received by an idempotent inbox service.
+
+    Messages with idempotency key are stored as incomplete until their
+    content is stored. Repeated incomplete messages are answered with
+    a retry status, unless the original one was abandoned.
+    '''
 
-        message = inbox_message_to_inbox_message_entity(request,
-                service_id=service.id, version=11)
+    original_message, compress = service.get_retained_message(request,
+            raw_message=raw_message)
 
-        message = service.server.persistence.create_inbox_message(message)
+    key = service.get_idempotency_key(request.message_id, account)
 
-        for content_block in request.content_blocks:
+    message = inbox_message_to_inbox_message_entity(request,
+            service_id=service.id, version=version, original_message=original_message,
+            compress_original_message=compress, idempotency_key=key)
 
-            is_supported = service.is_content_supported(content_block.content_binding, version=11)
+    if key:
+        message.completed = False
 
-            # FIXME: is it correct to skip unsupported content blocks?
-            # 3.2 Inbox Exchange, http://taxii.mitre.org/specifications/version1.1/TAXII_Services_Specification.pdf
-            if not is_supported:
-                log.warning("Content block binding is not supported: %s" % content_block.content_binding)
-                continue
+    try:
+        return service.server.persistence.create_inbox_message(message)
+    except DuplicateInboxMessage:
+        log.info("Repeated inbox message", message_id=request.message_id)
+        return service.claim_message(key, request.message_id)
 
-            supporting_collections = []
-            for collection in collections:
-                supported_by_collection = collection.is_content_supported(content_block.content_binding)
-                if supported_by_collection:
-                    supporting_collections.append(collection)
 
-            if len(supporting_collections) == 0 and not is_supported:
-                # There's nothing to add this content block to
-                log.warning("No collection that support binding %s were found" % content_block.content_binding)
-                continue
+def finalize_inbox_message(service, message, received, rejected, streamed):
 
-            block = content_block_to_content_block_entity(content_block, version=11)
+    if streamed:
+        # Streamed envelope has no content blocks, so the count is known only now
+        message.content_block_count = received
 
-            service.server.persistence.create_content(block, inbox_message=message,
-                    collections=supporting_collections, service_id=service.id)
+    if message.idempotency_key:
+        # Rejected blocks are kept to answer repeated messages the same way
+        message.rejected_blocks = rejected
+        message.completed = True
 
+    if streamed or message.idempotency_key:
+        service.server.persistence.update_inbox_message(message)
+
+    service.message_processed(message.idempotency_key, rejected)
+
+
+def release_inbox_message(service, message):
+    try:
+        service.server.persistence.release_inbox_message(message)
+    except Exception:
+        # Abandoned message is taken over once its lease expires
+        log.error("Failed to release inbox message", inbox_message_id=message.id,
+                exc_info=True)
+
+
+def handle_inbox_message(handler, service, request, collections, content_blocks=None,
+        raw_message=None, account=None, filter_collections=False):
+
+    message = store_inbox_message(service, request, handler.version,
+            raw_message=raw_message, account=account)
+
+    if not message:
+        key = service.get_idempotency_key(request.message_id, account)
+        return handler.get_status_message(request, service.get_processed_message(key) or [])
+
+    streamed = content_blocks is not None
+    batch_size = service.stream_batch_size if streamed else None
+
+    try:
+        received, rejected = service.process_content_blocks(
+                content_blocks if streamed else request.content_blocks,
+                collections, ContentBlocksWriter(service, message, batch_size=batch_size),
+                version=handler.version, filter_collections=filter_collections,
+                batch_size=batch_size)
+
+        finalize_inbox_message(service, message, received, rejected, streamed)
+    except:
+        exc_info = sys.exc_info()
+        if message.idempotency_key:
+            release_inbox_message(service, message)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    return handler.get_status_message(request, rejected)
+
+
+class InboxMessage11Handler(BaseMessageHandler):
+
+    supported_request_messages = [tm11.InboxMessage]
+
+    version = 11
+
+    @classmethod
+    def spool_message(cls, service, request, raw_message=None, account=None):
+
+        # Destination errors have to be reported before the message is accepted
+        service.validate_destination_collection_names(
+                request.destination_collection_names, request.message_id)
+
+        service.spool_message(request, raw_message=raw_message, account=account)
+
+        return cls.get_status_message(request)
+
+    @classmethod
+    def handle_message(cls, service, request, content_blocks=None, raw_message=None,
+            account=None):
+
+        collections = service.validate_destination_collection_names(
+                request.destination_collection_names, request.message_id)
+
+        return handle_inbox_message(cls, service, request, collections,
+                content_blocks=content_blocks, raw_message=raw_message,
+                account=account, filter_collections=True)
+
+    @classmethod
+    def get_status_message(cls, request, rejected=[]):
 
         # Create and return a Status Message indicating success
         status_message = tm11.StatusMessage(
@@ -62,6 +171,11 @@ class InboxMessage11Handler(BaseMessageHandler):
             status_type = ST_SUCCESS
         )
 
+        if rejected:
+            status_message.message = '%d content blocks rejected' % len(rejected)
+            status_message.status_detail = {
+                SD_REJECTED_CONTENT_BLOCK: get_rejected_details(rejected)}
+
         return status_message
 
 
@@ -69,27 +183,27 @@ class InboxMessage10Handler(BaseMessageHandler):
 
     supported_request_messages = [tm10.InboxMessage]
 
-    @classmethod
-    def handle_message(cls, service, request):
+    version = 10
 
-        collections = service.get_destination_collections()
+    @classmethod
+    def spool_message(cls, service, request, raw_message=None, account=None):
 
-        message = inbox_message_to_inbox_message_entity(request,
-                service_id=service.id, version=10)
+        service.spool_message(request, raw_message=raw_message, account=account)
 
-        message = service.server.persistence.create_inbox_message(message)
+        return cls.get_status_message(request)
 
-        for content_block in request.content_blocks:
-            is_supported = service.is_content_supported(content_block.content_binding, version=10)
+    @classmethod
+    def handle_message(cls, service, request, content_blocks=None, raw_message=None,
+            account=None):
 
-            if not is_supported:
-                log.warning("Content block binding is not supported: %s" % content_block.content_binding)
-                continue
+        collections = service.get_destination_collections()
 
-            block = content_block_to_content_block_entity(content_block, version=10)
+        return handle_inbox_message(cls, service, request, collections,
+                content_blocks=content_blocks, raw_message=raw_message,
+                account=account)
 
-            service.server.persistence.create_content(block, inbox_message=message,
-                    collections=collections, service_id=service.id)
+    @classmethod
+    def get_status_message(cls, request, rejected=[]):
 
         status_message = tm10.StatusMessage(
             message_id = cls.generate_id(),
@@ -97,6 +211,11 @@ class InboxMessage10Handler(BaseMessageHandler):
             status_type = ST_SUCCESS
         )
 
+        if rejected:
+            # TAXII 1.0 status detail is a plain string
+            status_message.message = '%d content blocks rejected' % len(rejected)
+            status_message.status_detail = '; '.join(get_rejected_details(rejected))
+
         return status_message
 
 
@@ -105,11 +224,27 @@ class InboxMessageHandler(BaseMessageHandler):
     supported_request_messages = [tm10.InboxMessage, tm11.InboxMessage]
 
     @classmethod
-    def handle_message(cls, service, request):
+    def handle_message(cls, service, request, content_blocks=None, raw_message=None,
+            account=None):
         if isinstance(request, tm10.InboxMessage):
-            return InboxMessage10Handler.handle_message(service, request)
+            handler = InboxMessage10Handler
         elif isinstance(request, tm11.InboxMessage):
-            return InboxMessage11Handler.handle_message(service, request)
+            handler = InboxMessage11Handler
         else:
             raise_failure("TAXII Message not supported by message handler", request.message_id)
 
+        # Repeated messages get the response of the original one,
+        # without touching the content
+        rejected = service.get_processed_message(
+                service.get_idempotency_key(request.message_id, account))
+
+        if rejected is not None:
+            log.info("Repeated inbox message", message_id=request.message_id)
+            return handler.get_status_message(request, rejected)
+
+        if service.spool:
+            return handler.spool_message(service, request, raw_message=raw_message,
+                    account=account)
+
+        return handler.handle_message(service, request, content_blocks=content_blocks,
+                raw_message=raw_message, account=account)
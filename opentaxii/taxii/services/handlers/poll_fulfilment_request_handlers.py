@@ -28,7 +28,17 @@ class PollFulfilmentRequest11Handler(BaseMessageHandler):
         if not result_set or result_set.collection_id != collection.id:
             raise StatusMessageException(ST_NOT_FOUND, in_response_to=request.message_id,
                 status_details={SD_ITEM: result_id})
-            
+
+        if result_set.ready is not None:
+            # Materialized result set, served from its snapshot
+            return PollRequest11Handler.prepare_snapshot_response(
+                service = service,
+                collection = collection,
+                result_set = result_set,
+                in_response_to = request.message_id,
+                result_part = part_number
+            )
+
         response = PollRequest11Handler.prepare_poll_response(
             service = service,
             collection = collection,
@@ -38,7 +48,8 @@ class PollFulfilmentRequest11Handler(BaseMessageHandler):
             result_part = part_number,
             allow_async = True,
             return_content = True,
-            result_id = result_id
+            result_id = result_id,
+            high_water_mark = result_set.high_water_mark
         )
         return response
 
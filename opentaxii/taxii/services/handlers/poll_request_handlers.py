@@ -17,7 +17,8 @@ from ...converters import (
     content_block_entity_to_content_block, parse_content_bindings,
     content_binding_entities_to_content_bindings
 )
-from ...utils import get_utc_now
+from ...utils import get_utc_now, get_cursor
+from ...streaming import StreamedMessage
 
 log = structlog.getLogger(__name__)
 
@@ -118,41 +119,98 @@ class PollRequest11Handler(BaseMessageHandler):
     @classmethod
     def prepare_poll_response(cls, service, collection, in_response_to, timeframe=(None, None),
             content_bindings=None, result_part=1, allow_async=False, return_content=True,
-            result_id=None, subscription_id=None):
+            result_id=None, subscription_id=None, high_water_mark=None):
 
-        try:
-            total_count = service.get_content_blocks_count(collection,
-                    timeframe=timeframe, content_bindings=content_bindings)
-        except ResultsNotReady:
-            if not allow_async:
-                message = "The content is not available now and "\
-                        "the request has allow_asynch set to false"
+        exact_count = service.is_exact_count_required(return_content)
+        stream = return_content and service.stream_responses
+
+        content_blocks = None
 
-                raise_failure(message=message, in_response_to=in_response_to)
+        part_key = service.get_result_part_key(collection, timeframe=timeframe,
+                content_bindings=content_bindings, part_number=result_part,
+                version=11, return_content=return_content,
+                high_water_mark=high_water_mark)
+
+        cached = service.get_cached_result_part(part_key)
+
+        if not cached and allow_async and not result_id and \
+                service.is_materialization_required(collection, timeframe=timeframe,
+                        content_bindings=content_bindings):
 
             result_set = service.create_result_set(collection, timeframe=timeframe,
-                    content_bindings=content_bindings)
+                    content_bindings=content_bindings, materialize=True)
+
+            return cls.prepare_pending_response(service, result_set.result_id,
+                    in_response_to)
+
+        if not cached:
+            try:
+                if exact_count:
+                    total_count = service.get_content_blocks_count(collection,
+                            timeframe=timeframe, content_bindings=content_bindings,
+                            high_water_mark=high_water_mark)
+                elif stream:
+                    has_more = service.has_more_content(collection, timeframe=timeframe,
+                            content_bindings=content_bindings, part_number=result_part,
+                            result_id=result_id, high_water_mark=high_water_mark)
+                else:
+                    content_blocks = service.get_content_blocks(collection, timeframe=timeframe,
+                            content_bindings=content_bindings, part_number=result_part,
+                            result_id=result_id, lookahead=True,
+                            high_water_mark=high_water_mark)
+            except ResultsNotReady:
+                if not allow_async:
+                    message = "The content is not available now and "\
+                            "the request has allow_asynch set to false"
+
+                    raise_failure(message=message, in_response_to=in_response_to)
+
+                result_set = service.create_result_set(collection, timeframe=timeframe,
+                        content_bindings=content_bindings, materialize=True)
+
+                return cls.prepare_pending_response(service, result_set.result_id,
+                        in_response_to)
+
+        if cached:
+            has_more, capped_count, is_partial, cursor, content_blocks = cached
+        elif exact_count:
+            has_more = total_count > (result_part * service.max_result_size)
+            capped_count = min(service.max_result_count, total_count)
+            is_partial = (capped_count < total_count)
+        else:
+            if content_blocks is not None:
+                has_more = len(content_blocks) > service.max_result_size
+                content_blocks = content_blocks[:service.max_result_size]
+
+                # Blocks served so far and the one fetched ahead are a lower bound
+                served_count = (result_part - 1) * service.max_result_size \
+                        + len(content_blocks) + int(has_more)
+            elif has_more:
+                served_count = result_part * service.max_result_size + 1
+            else:
+                served_count = (result_part - 1) * service.max_result_size
+
+            cached_count = service.get_cached_content_blocks_count(collection,
+                    timeframe=timeframe, content_bindings=content_bindings)
 
-            return tm11.StatusMessage(
-                message_id = generate_message_id(),
-                in_response_to = in_response_to,
-                status_type = ST_PENDING,
-                status_details = {
-                    SD_ESTIMATED_WAIT: service.wait_time,
-                    SD_RESULT_ID: result_set.result_id,
-                    SD_WILL_PUSH: service.can_push
-                }
-            )
-
-        has_more = total_count > (result_part * service.max_result_size)
-        capped_count = min(service.max_result_count, total_count)
-        is_partial = (capped_count < total_count)
+            capped_count = min(service.max_result_count,
+                    max(served_count, cached_count or 0))
+            is_partial = True
 
         if has_more and not result_id:
             result_set = service.create_result_set(collection, timeframe=timeframe,
                     content_bindings=content_bindings)
             result_id = result_set.result_id
 
+            if content_blocks and not cached:
+                service.update_result_set_cursor(result_id, result_part,
+                        get_cursor(content_blocks))
+
+        # Parts served from the cache record their cursor as well, so the
+        # following part seeks past it
+        if cached and result_id:
+            service.update_result_set_cursor(result_id, result_part, cursor)
+
         response = tm11.PollResponse(
             message_id = generate_message_id(),
             in_response_to = in_response_to,
@@ -168,17 +226,90 @@ class PollRequest11Handler(BaseMessageHandler):
             subscription_id = subscription_id
         )
 
-        if return_content:
+        if cached:
+            return StreamedMessage(response, content_blocks)
+
+        if not return_content:
+            service.cache_result_part(part_key, has_more, capped_count, is_partial)
+            return response
+
+        if stream:
+            content_blocks = service.iter_content_blocks(collection, timeframe=timeframe,
+                    content_bindings=content_bindings, part_number=result_part,
+                    result_id=result_id, high_water_mark=high_water_mark)
 
+            return StreamedMessage(response, (content_block_entity_to_content_block(block,
+                version=11) for block in content_blocks))
+
+        if content_blocks is None:
             content_blocks = service.get_content_blocks(collection, timeframe=timeframe,
-                    content_bindings=content_bindings, part_number=result_part)
+                    content_bindings=content_bindings, part_number=result_part,
+                    result_id=result_id, high_water_mark=high_water_mark)
+
+        cursor = get_cursor(content_blocks)
+
+        content_blocks = [content_block_entity_to_content_block(block, version=11)
+                for block in content_blocks]
+
+        if part_key is None:
+            response.content_blocks.extend(content_blocks)
+            return response
+
+        # Blocks are serialized once, for the cache and for this response
+        content_blocks = service.cache_result_part(part_key, has_more, capped_count,
+                is_partial, content_blocks, cursor=cursor)
+
+        return StreamedMessage(response, content_blocks)
+
+
+    @classmethod
+    def prepare_snapshot_response(cls, service, collection, result_set, in_response_to,
+            result_part=1):
+
+        try:
+            content_blocks = service.get_result_set_blocks(result_set,
+                    part_number=result_part)
+        except ResultsNotReady:
+            return cls.prepare_pending_response(service, result_set.result_id,
+                    in_response_to)
+
+        total_count = result_set.blocks_count
+        capped_count = min(service.max_result_count, total_count)
+
+        response = tm11.PollResponse(
+            message_id = generate_message_id(),
+            in_response_to = in_response_to,
+            collection_name = collection.name,
+
+            more = total_count > (result_part * service.max_result_size),
+            result_id = result_set.result_id,
+            result_part_number = result_part,
+
+            exclusive_begin_timestamp_label = result_set.timeframe[0],
+            inclusive_end_timestamp_label = result_set.timeframe[1],
+            record_count = tm11.RecordCount(capped_count, capped_count < total_count),
+        )
 
-            for block in content_blocks:
-                response.content_blocks.append(content_block_entity_to_content_block(block, version=11))
+        for block in content_blocks:
+            response.content_blocks.append(content_block_entity_to_content_block(block, version=11))
 
         return response
 
 
+    @classmethod
+    def prepare_pending_response(cls, service, result_id, in_response_to):
+
+        return tm11.StatusMessage(
+            message_id = generate_message_id(),
+            in_response_to = in_response_to,
+            status_type = ST_PENDING,
+            status_detail = {
+                SD_ESTIMATED_WAIT: service.get_wait_time(),
+                SD_RESULT_ID: str(result_id),
+                SD_WILL_PUSH: service.can_push
+            }
+        )
+
 
 class PollRequest10Handler(BaseMessageHandler):
 
@@ -231,13 +362,35 @@ class PollRequest10Handler(BaseMessageHandler):
             inclusive_end_timestamp_label = end_response,
         )
 
+        part_key = service.get_result_part_key(collection, timeframe=(start, end),
+                content_bindings=content_bindings, version=10)
+
+        cached = service.get_cached_result_part(part_key)
+
+        if cached:
+            return StreamedMessage(response, cached[-1])
+
+        if service.stream_responses:
+            content_blocks = service.iter_content_blocks(collection, timeframe=(start, end),
+                    content_bindings=content_bindings)
+
+            return StreamedMessage(response, (content_block_entity_to_content_block(block,
+                version=10) for block in content_blocks))
+
         content_blocks = service.get_content_blocks(collection, timeframe=(start, end),
                 content_bindings=content_bindings)
 
-        for block in content_blocks:
-            response.content_blocks.append(content_block_entity_to_content_block(block, version=10))
+        content_blocks = [content_block_entity_to_content_block(block, version=10)
+                for block in content_blocks]
 
-        return response
+        if part_key is None:
+            response.content_blocks.extend(content_blocks)
+            return response
+
+        content_blocks = service.cache_result_part(part_key, False, len(content_blocks),
+                False, content_blocks)
+
+        return StreamedMessage(response, content_blocks)
 
 
 class PollRequestHandler(BaseMessageHandler):
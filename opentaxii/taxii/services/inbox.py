@@ -1,10 +1,22 @@
 
+import math
+import time
+
+from blinker import signal
+
 from libtaxii.constants import (
     SVC_INBOX, MSG_INBOX_MESSAGE, SD_ACCEPTABLE_DESTINATION,
-    ST_DESTINATION_COLLECTION_ERROR, ST_NOT_FOUND, SD_ITEM
+    ST_DESTINATION_COLLECTION_ERROR, ST_NOT_FOUND, SD_ITEM,
+    ST_RETRY, ST_FAILURE, SD_ESTIMATED_WAIT, VID_TAXII_XML_10
 )
 
-from ..utils import is_content_supported
+from ...signals import POST_SAVE_COLLECTION
+from ...spool import Spool, SpoolDrainer, SpoolFull, RecordRejected
+from ..pipeline import WorkerPool, ContentBlockProcessor, POOL_THREAD, batches
+from ..validation import ContentValidator
+from ..idempotency import ProcessedMessages, get_idempotency_key
+from ..utils import ContentBindingMatcher, parse_message, get_message_envelope
+from ..streaming import iterparse_inbox_message, BoundedReader
 from ..entities import ContentBindingEntity
 from ..exceptions import StatusMessageException
 
@@ -12,6 +24,14 @@ from ..converters import content_binding_entities_to_content_bindings, service_t
 
 from .abstract import TaxiiService
 from .handlers import InboxMessageHandler
+from .handlers.inbox_message_handlers import InboxMessage10Handler, InboxMessage11Handler
+
+RETAIN_FULL = 'full'
+RETAIN_HEADERS = 'headers'
+RETAIN_COMPRESSED = 'compressed'
+RETAIN_NONE = 'none'
+
+MESSAGE_RETENTION_POLICIES = (RETAIN_FULL, RETAIN_HEADERS, RETAIN_COMPRESSED, RETAIN_NONE)
 
 
 class InboxService(TaxiiService):
@@ -25,35 +45,397 @@ class InboxService(TaxiiService):
     destination_collection_required = False
     accept_all_content = False
     supported_content = []
+    content_matcher = None
+
+    stream_batch_size = None
+
+    accepts_request_details = True
+    message_retention = RETAIN_FULL
+
+    collections_cache_ttl = None
+
+    block_pool = None
+    content_validator = None
+
+    spool = None
+    spool_drainer = None
+
+    processed_messages = None
+    idempotency_lease = None
 
 
     def __init__(self, accept_all_content=False, destination_collection_required=False,
-            supported_content=[], **kwargs):
+            supported_content=[], streaming=False, stream_batch_size=100,
+            spool_dir=None, spool_workers=1, spool_max_size=None,
+            spool_retry_delay=1, spool_retry_max_delay=300, spool_lease=300,
+            message_retention=RETAIN_FULL, collections_cache_ttl=60,
+            block_workers=0, block_pool_type=POOL_THREAD, content_schemas=None,
+            validation_workers=1, schema_cache_size=16, idempotent=False,
+            idempotency_cache_size=1000, idempotency_filter_size=2 ** 20,
+            idempotency_lease=600, **kwargs):
 
         super(InboxService, self).__init__(**kwargs)
 
+        if message_retention not in MESSAGE_RETENTION_POLICIES:
+            raise ValueError('Unknown message retention policy: %s' % message_retention)
+
+        self.message_retention = message_retention
+
         self.accept_all_content = accept_all_content
         self.supported_content = map(ContentBindingEntity, supported_content)
+        self.content_matcher = ContentBindingMatcher(self.supported_content)
 
         self.destination_collection_required = destination_collection_required
 
+        # Collections are cached for `collections_cache_ttl` seconds or until
+        # collections are changed in this process. 0 disables the cache.
+        self.collections_cache_ttl = float(collections_cache_ttl or 0)
+        self._collections_cache = None
+
+        signal(POST_SAVE_COLLECTION).connect(self._on_collection_saved)
+
+        self.block_pool = WorkerPool(workers=int(block_workers),
+                pool_type=block_pool_type)
+
+        # Payloads are validated only for collections with enabled validation
+        if content_schemas:
+            self.content_validator = ContentValidator(content_schemas,
+                    workers=validation_workers, cache_size=schema_cache_size)
+
+        # Repeated messages with the same ID from the same account
+        # are answered without being processed again
+        if idempotent:
+            self.processed_messages = ProcessedMessages(self._get_rejected_blocks,
+                    cache_size=int(idempotency_cache_size),
+                    filter_size=int(idempotency_filter_size))
+
+            # Incomplete messages not updated for this amount of seconds
+            # were left by stopped processes and are processed again
+            self.idempotency_lease = int(idempotency_lease)
+
+        self.streaming = streaming
+        self.stream_batch_size = int(stream_batch_size)
+
+        if spool_dir:
+            if streaming:
+                raise ValueError('Streaming and spooling can not be enabled '
+                        'for the same Inbox Service')
+
+            self.spool = Spool(spool_dir,
+                    max_size=int(spool_max_size) if spool_max_size else None,
+                    lease=float(spool_lease))
+
+            self.spool_drainer = SpoolDrainer(self.spool, self.process_spooled,
+                    workers=int(spool_workers), retry_delay=float(spool_retry_delay),
+                    retry_max_delay=float(spool_retry_max_delay))
+
+
+    def start(self):
+        if self.spool_drainer:
+            self.spool_drainer.start()
+
+
+    def stop(self):
+        if self.spool_drainer:
+            self.spool_drainer.stop()
+        self.block_pool.stop()
+        if self.content_validator:
+            self.content_validator.stop()
+
+
+    def process_stream(self, headers, content_type, stream, account=None,
+            limit_key=None):
+        '''
+        Process an Inbox Message read incrementally from `stream`.
+
+        Content blocks are parsed one by one and persisted in batches of
+        `stream_batch_size`, so memory usage does not depend on the size
+        of the message. Content blocks are taken from the `blocks` rate
+        limit of `limit_key` as they are read.
+        '''
+
+        stream = BoundedReader(stream, max_size=self.max_body_size)
+
+        message, content_blocks = iterparse_inbox_message(content_type, stream)
+
+        if self.rate_limiter and limit_key:
+            # The amount of blocks is not known before the message is read,
+            # a client still in debt is held back by the first one
+            self.rate_limiter.acquire(limit_key, in_response_to=message.message_id,
+                    blocks=1)
+            content_blocks = self._charge_blocks(content_blocks, limit_key)
+
+        return self.process(headers, message, content_blocks=content_blocks,
+                account=account)
+
+
+    def _charge_blocks(self, content_blocks, limit_key):
+        # The blocks following the acquired one are charged in batches,
+        # delaying the following requests
+        count = charged = 1
+        try:
+            for count, block in enumerate(content_blocks, 1):
+                yield block
+                if count - charged >= self.stream_batch_size:
+                    self.rate_limiter.charge(limit_key, blocks=count - charged)
+                    charged = count
+        finally:
+            if count > charged:
+                self.rate_limiter.charge(limit_key, blocks=count - charged)
+
+
+    def spool_message(self, message, raw_message=None, account=None):
+        '''
+        Store the message in the spool, to be persisted by a worker later.
+        '''
+
+        data = raw_message if raw_message is not None else message.to_xml()
+
+        header = message.version
+        if account:
+            header += ' %s' % account['id']
+
+        try:
+            name = self.spool.append(header, data)
+        except SpoolFull:
+            wait = int(math.ceil(self.spool_drainer.last_latency or 1))
+            raise StatusMessageException(ST_RETRY, message='Inbox is overloaded',
+                    in_response_to=message.message_id,
+                    status_details={SD_ESTIMATED_WAIT: wait})
+
+        self.spool_drainer.notify(name)
+
+        self.log.debug("Message spooled", message_id=message.message_id,
+                record=name, **self.spool.stats())
+
+
+    def process_spooled(self, header, data):
+        '''
+        Persist a spooled message. Messages that can not be parsed or are
+        not valid for the service are rejected, other errors are
+        considered temporary.
+        '''
+
+        content_type, _, account_id = header.partition(' ')
+        account = dict(id=int(account_id)) if account_id else None
+
+        if content_type == VID_TAXII_XML_10:
+            handler = InboxMessage10Handler
+        else:
+            handler = InboxMessage11Handler
+
+        try:
+            message = parse_message(content_type, data, do_validate=False)
+
+            handler.handle_message(self, message, raw_message=data, account=account)
+        except StatusMessageException, e:
+            if e.status_type in (ST_RETRY, ST_FAILURE):
+                raise
+            raise RecordRejected('%s: %s' % (e.status_type, e.message))
+
+
+    def get_idempotency_key(self, message_id, account=None):
+        '''
+        Return the key identifying the message, None if the service
+        is not idempotent.
+        '''
+
+        if not self.processed_messages:
+            return None
+
+        return get_idempotency_key(self.id, message_id,
+                account['id'] if account else None)
+
+
+    def get_processed_message(self, idempotency_key):
+        '''
+        Return the rejected blocks of an already processed message,
+        None if the message was not processed yet.
+        '''
+
+        if not idempotency_key:
+            return None
+
+        return self.processed_messages.get(idempotency_key)
+
+
+    def message_processed(self, idempotency_key, rejected):
+        if idempotency_key:
+            self.processed_messages.add(idempotency_key, rejected)
+
+
+    def _get_rejected_blocks(self, idempotency_key):
+        message = self.server.persistence.get_inbox_message(idempotency_key)
+        if not message or message.completed is False:
+            return None
+        return message.rejected_blocks
+
+
+    def claim_message(self, idempotency_key, in_response_to):
+        '''
+        Return the incomplete message with the key if it was abandoned by
+        another process. Raise a retry status if it is still being stored,
+        or return None if it was completed, recording its rejected blocks
+        as those of a processed message.
+        '''
+
+        persistence = self.server.persistence
+
+        message = persistence.get_inbox_message(idempotency_key)
+        if message and message.completed is not False:
+            # Completed by another process or before a restart, following
+            # repeats are answered without a query
+            self.message_processed(idempotency_key, message.rejected_blocks or [])
+            return None
+
+        claimed = persistence.claim_inbox_message(idempotency_key, self.idempotency_lease)
+
+        if claimed:
+            self.log.warning("Incomplete inbox message processed again",
+                    message_id=claimed.message_id, inbox_message_id=claimed.id)
+            return claimed
+
+        raise StatusMessageException(ST_RETRY,
+                message='Message with the same ID is being processed',
+                in_response_to=in_response_to,
+                status_details={SD_ESTIMATED_WAIT: self.idempotency_lease})
+
+
+    def process_content_blocks(self, content_blocks, collections, writer,
+            version, filter_collections=False, batch_size=None):
+        '''
+        Check and convert content blocks in the worker pool, keeping their
+        order, and pass the results to `writer`.
+
+        Blocks are taken from `content_blocks` in batches of `batch_size`,
+        all at once if it is not set. Returns a tuple `(received, rejected)`
+        with the amount of blocks received and a list of `(index, error)`
+        tuples for blocks that failed payload validation.
+        '''
+
+        processor = ContentBlockProcessor(version,
+                content_matcher=None if self.accept_all_content else self.content_matcher,
+                collections=collections, filter_collections=filter_collections)
+
+        received = 0
+        rejected = []
+
+        for batch in batches(content_blocks, batch_size):
+            results = self.block_pool.map(processor,
+                    [processor.get_fields(block) for block in batch])
+
+            if self.content_validator:
+                results = self.validate_content_blocks(results, rejected, offset=received)
+
+            received += len(batch)
+
+            for result in results:
+                if result:
+                    writer.add(*result)
+
+        writer.flush()
+
+        return received, rejected
+
+
+    def validate_content_blocks(self, results, rejected, offset=0):
+        '''
+        Validate payloads of processed blocks destined to collections with
+        enabled validation. Invalid blocks are detached from such
+        collections and skipped if no collection is left; their
+        positions in the message and errors are added to `rejected`.
+        '''
+
+        validated = [(i, r) for i, r in enumerate(results)
+                if r and self.content_validator.is_supported(r[0].content_binding.binding)
+                and any(c.validate_content for c in r[1])]
+
+        if not validated:
+            return results
+
+        started = time.time()
+        errors = self.content_validator.validate([block for _, (block, _) in validated])
+        elapsed = time.time() - started
+
+        results = list(results)
+        failed = 0
+
+        for (i, (block, collections)), error in zip(validated, errors):
+            if error is None:
+                continue
+
+            failed += 1
+            rejected.append((offset + i, error))
+
+            remaining = [c for c in collections if not c.validate_content]
+            results[i] = (block, remaining) if remaining else None
+
+        self.log.info("Content validated", blocks=len(validated), rejected=failed,
+                validation_time=elapsed)
+
+        return results
+
+
+    def get_retained_message(self, message, raw_message=None):
+        '''
+        Return `(original_message, compress)` to be stored for the message,
+        according to the message retention policy of the service.
+
+        `raw_message` holds the request body as received and is stored as
+        bytes, without decoding. It is not available for streamed messages,
+        so only their envelope can be kept.
+        '''
+
+        if self.message_retention == RETAIN_NONE:
+            return None, False
+
+        if self.message_retention == RETAIN_HEADERS:
+            return get_message_envelope(message), False
+
+        if raw_message is None:
+            raw_message = message.to_xml()
+
+        return raw_message, self.message_retention == RETAIN_COMPRESSED
+
 
     def is_content_supported(self, content_binding, version=None):
 
         if self.accept_all_content:
             return True
 
-        return is_content_supported(self.supported_content, content_binding, version=version)
+        return self.content_matcher.matches(content_binding, version=version)
 
 
     def get_destination_collections(self):
-        return self.server.persistence.get_collections(self.id)
+
+        cached = self._collections_cache
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+        collections = self.server.persistence.get_collections(self.id)
+
+        if self.collections_cache_ttl:
+            self._collections_cache = (time.time() + self.collections_cache_ttl,
+                    collections)
+
+        return collections
+
+
+    def invalidate_collections_cache(self):
+        self._collections_cache = None
+
+
+    def _on_collection_saved(self, sender, collection_id=None, service_ids=None):
+        if service_ids is None or self.id in service_ids:
+            self.invalidate_collections_cache()
 
 
     def validate_destination_collection_names(self, name_list, in_response_to):
 
         name_list = name_list or []
 
+        destinations = self.get_destination_collections()
+
         if (self.destination_collection_required and not name_list) or \
                 (not self.destination_collection_required and name_list):
 
@@ -62,7 +444,7 @@ class InboxService(TaxiiService):
             else:
                 message = 'Destination_Collection_Names are prohibited for this Inbox Service'
 
-            details = {SD_ACCEPTABLE_DESTINATION: [c.name for c in self.get_destination_collections() if c.enabled]}
+            details = {SD_ACCEPTABLE_DESTINATION: [c.name for c in destinations if c.available]}
 
             raise StatusMessageException(ST_DESTINATION_COLLECTION_ERROR, message=message,
                     in_response_to=in_response_to, extended_headers=details)
@@ -70,7 +452,7 @@ class InboxService(TaxiiService):
 
         collections = []
 
-        destinations_map = dict((c.name, c) for c in self.get_destination_collections())
+        destinations_map = dict((c.name, c) for c in destinations)
 
         for name in name_list:
             if name in destinations_map:
@@ -1,16 +1,35 @@
 import sys
+import time
+import threading
 import structlog
 
+from collections import OrderedDict
+
+from blinker import signal
+
 from libtaxii.constants import (
         MSG_POLL_REQUEST, MSG_POLL_FULFILLMENT_REQUEST, SVC_POLL
 )
 
+from ...signals import POST_SAVE_CONTENT_BLOCK
+from ...persistence.exceptions import ResultsNotReady
+from ..cache import ResponseCache
+from ..materialization import ResultSetMaterializer
 from ..entities import ResultSetEntity
+from ..serialization import serialize_content_block
+from ..utils import get_utc_now, get_cursor
 from .abstract import TaxiiService
 from .handlers import PollRequestHandler, PollFulfilmentRequestHandler
 
 log = structlog.getLogger(__name__)
 
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATED = 'estimated'
+
+COUNT_MODES = (COUNT_EXACT, COUNT_ESTIMATED)
+
+COUNT_CACHE_SIZE = 1000
+
 
 class PollService(TaxiiService):
 
@@ -28,8 +47,22 @@ class PollService(TaxiiService):
     max_result_size = sys.maxint
     mac_result_count = sys.maxint
 
+    count_mode = COUNT_EXACT
+
+    stream_responses = False
+    stream_batch_size = 100
+
+    response_cache = None
+
+    async_threshold = None
+    async_lease = None
+    materializer = None
+
     def __init__(self, subscription_required=False, max_result_size=-1,
-            max_result_count=-1, **kwargs):
+            max_result_count=-1, count_mode=COUNT_EXACT, count_cache_ttl=300,
+            stream_responses=False, stream_batch_size=100, response_cache_size=0,
+            response_cache_ttl=60, async_threshold=None, async_workers=1,
+            async_lease=600, **kwargs):
         super(PollService, self).__init__(**kwargs)
 
         self.subscription_required = subscription_required
@@ -37,6 +70,58 @@ class PollService(TaxiiService):
         self.max_result_size = max_result_size if max_result_size >= 0 else sys.maxint
         self.max_result_count = max_result_count if max_result_count >= 0 else sys.maxint
 
+        if count_mode not in COUNT_MODES:
+            raise ValueError('Unknown count mode: %s' % count_mode)
+
+        # In estimated mode only count-only requests count content blocks.
+        # Other responses report the count cached from such requests for
+        # `count_cache_ttl` seconds, or a lower bound, as a partial count.
+        self.count_mode = count_mode
+        self.count_cache_ttl = float(count_cache_ttl or 0)
+
+        self._counts = OrderedDict()
+        self._counts_lock = threading.Lock()
+
+        # Streamed responses are written block by block as blocks are read
+        # from the database, so memory use does not depend on the part size
+        self.stream_responses = stream_responses
+        self.stream_batch_size = int(stream_batch_size)
+
+        # Serialized result parts are cached until content is saved to their
+        # collection in this process, or for `response_cache_ttl` seconds.
+        # Parts of timeframes that ended in the past do not change and are
+        # cached until evicted. 0 disables the cache.
+        if response_cache_size:
+            self.response_cache = ResponseCache(int(response_cache_size),
+                    ttl=float(response_cache_ttl or 0))
+
+        signal(POST_SAVE_CONTENT_BLOCK).connect(self._on_content_block_saved)
+
+        # Polls that allow asynchronous responses and are estimated to match
+        # more than `async_threshold` blocks are answered with a pending
+        # status. Matching block IDs are written to a snapshot by background
+        # workers and fulfilment requests are served from the snapshot.
+        if async_threshold is not None:
+            self.async_threshold = int(async_threshold)
+
+            # A result set is materialized by the worker that claimed it,
+            # other processes take it over if it is not ready after
+            # `async_lease` seconds
+            self.async_lease = int(async_lease)
+
+            self.materializer = ResultSetMaterializer(self.materialize_result_set,
+                    workers=int(async_workers))
+
+
+    def start(self):
+        if self.materializer:
+            self.materializer.start()
+
+
+    def stop(self):
+        if self.materializer:
+            self.materializer.stop()
+
 
     def get_collection(self, name):
         return self.server.persistence.get_collection(name, self.id)
@@ -50,48 +135,364 @@ class PollService(TaxiiService):
         return offset, limit
 
 
+    def is_exact_count_required(self, return_content):
+        # Blocks are counted if the count is all the client asks for,
+        # or if the service always reports exact counts
+        return self.count_mode == COUNT_EXACT or not return_content
+
+
     def get_content_blocks_count(self, collection, timeframe=None,
-            content_bindings=[]):
+            content_bindings=[], high_water_mark=None):
 
         start_time, end_time = timeframe or (None, None)
 
-        return self.server.persistence.get_content_blocks_count(
+        count = self.server.persistence.get_content_blocks_count(
             collection_id = collection.id,
             start_time = start_time,
             end_time = end_time,
-            bindings = content_bindings
+            bindings = content_bindings,
+            until = high_water_mark
         )
 
+        if self.count_mode == COUNT_ESTIMATED and self.count_cache_ttl \
+                and not high_water_mark:
+            key = get_count_key(collection, timeframe, content_bindings)
+            with self._counts_lock:
+                self._counts.pop(key, None)
+                self._counts[key] = (time.time() + self.count_cache_ttl, count)
+                while len(self._counts) > COUNT_CACHE_SIZE:
+                    self._counts.popitem(last=False)
+
+        return count
+
+
+    def get_cached_content_blocks_count(self, collection, timeframe=None,
+            content_bindings=[]):
+        '''
+        Return the count of content blocks cached by a recent call to
+        :meth:`get_content_blocks_count`, or None.
+        '''
+
+        key = get_count_key(collection, timeframe, content_bindings)
+
+        with self._counts_lock:
+            cached = self._counts.get(key)
+
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+
+    def get_part_position(self, part_number, result_id=None):
+        '''
+        Return `(offset, cursor)` of the first block of a result part.
+
+        Parts of a result set are fetched by seeking past the cursor of the
+        closest preceding part that was served, so following parts cost as
+        much as the first one. Only the parts skipped since that cursor are
+        paged over with an offset.
+        '''
+
+        offset, _ = self.get_offset_limit(part_number)
+
+        if not result_id or part_number <= 1:
+            return offset, None
+
+        served, cursor = self.server.persistence.get_result_set_cursor(
+                result_id, part_number)
+        offset, _ = self.get_offset_limit(part_number - served)
+
+        return offset, cursor
+
 
     def get_content_blocks(self, collection, timeframe=None, content_bindings=[],
-            part_number=1):
+            part_number=1, result_id=None, lookahead=False, high_water_mark=None):
+        '''
+        Get content blocks of a result part. With `lookahead`, the first
+        block of the following part is fetched as well, so the caller can
+        tell if there are more parts without counting the blocks.
+
+        Parts of a result set pass its `high_water_mark`, so blocks saved
+        after the result set was created do not shift the following parts.
+        '''
 
         start_time, end_time = timeframe or (None, None)
 
-        offset, limit = self.get_offset_limit(part_number)
+        offset, cursor = self.get_part_position(part_number, result_id)
+        limit = self.max_result_size
 
-        return self.server.persistence.get_content_blocks(
+        if lookahead:
+            limit = min(limit + 1, sys.maxint)
+
+        blocks = self.server.persistence.get_content_blocks(
             collection_id = collection.id,
             start_time = start_time,
             end_time = end_time,
             bindings = content_bindings,
             offset = offset,
             limit = limit,
+            after = cursor,
+            until = high_water_mark,
         )
 
+        if result_id:
+            self.update_result_set_cursor(result_id, part_number,
+                    get_cursor(blocks[:self.max_result_size]))
+
+        return blocks
+
+
+    def iter_content_blocks(self, collection, timeframe=None, content_bindings=[],
+            part_number=1, result_id=None, high_water_mark=None):
+        '''
+        Generator of content blocks of a result part, read from the database
+        in batches of `stream_batch_size`.
+        '''
+
+        start_time, end_time = timeframe or (None, None)
 
-    def create_result_set(self, collection, content_bindings=[], timeframe=(None, None)):
+        offset, cursor = self.get_part_position(part_number, result_id)
+
+        blocks = self.server.persistence.iter_content_blocks(
+            collection_id = collection.id,
+            start_time = start_time,
+            end_time = end_time,
+            bindings = content_bindings,
+            offset = offset,
+            limit = self.max_result_size,
+            after = cursor,
+            until = high_water_mark,
+            batch_size = self.stream_batch_size,
+        )
+
+        if result_id:
+            blocks = self._track_result_set_cursor(blocks, result_id, part_number)
+
+        return blocks
+
+
+    def _track_result_set_cursor(self, blocks, result_id, part_number):
+        last = None
+        for block in blocks:
+            yield block
+            last = block
+
+        self.update_result_set_cursor(result_id, part_number,
+                get_cursor([last] if last else []))
+
+
+    def has_more_content(self, collection, timeframe=None, content_bindings=[],
+            part_number=1, result_id=None, high_water_mark=None):
+        '''
+        Check if there are content blocks after a result part, without
+        counting or fetching the blocks of the part.
+        '''
+
+        start_time, end_time = timeframe or (None, None)
+
+        offset, cursor = self.get_part_position(part_number, result_id)
+
+        following = self.server.persistence.get_content_blocks(
+            collection_id = collection.id,
+            start_time = start_time,
+            end_time = end_time,
+            bindings = content_bindings,
+            offset = min(offset + self.max_result_size, sys.maxint),
+            limit = 1,
+            after = cursor,
+            until = high_water_mark,
+        )
+
+        return bool(following)
+
+
+    def update_result_set_cursor(self, result_id, part_number, cursor):
+        if cursor:
+            self.server.persistence.update_result_set_cursor(result_id,
+                    part_number, cursor)
+
+
+    def get_result_part_key(self, collection, timeframe=None, content_bindings=[],
+            part_number=1, version=11, return_content=True, high_water_mark=None):
+        '''
+        Return the key of a result part in the response cache, None if
+        the cache is disabled.
+        '''
+
+        if not self.response_cache:
+            return None
+
+        collection_id, timeframe, bindings = get_count_key(collection, timeframe,
+                content_bindings)
+
+        # Content is not added to parts bounded by a high-water mark
+        # or to timeframes that ended in the past
+        end_time = timeframe[1]
+        if high_water_mark or (end_time and end_time < get_utc_now()):
+            generation = None
+        else:
+            generation = self.response_cache.get_generation(collection_id)
+
+        return (collection_id, timeframe, bindings, part_number, version,
+                return_content, high_water_mark, generation)
+
+
+    def get_cached_result_part(self, key):
+        '''
+        Return a cached tuple `(more, record_count, partial_count, cursor,
+        content_blocks)` of a result part, or None. Content blocks are
+        serialized, `cursor` is the one of the last block in the part.
+        '''
+
+        if key is None:
+            return None
+
+        return self.response_cache.get(key)
+
+
+    def cache_result_part(self, key, more, record_count, partial_count,
+            content_blocks=[], cursor=None):
+        '''
+        Serialize content blocks of a result part and cache the part.
+        Returns serialized content blocks.
+        '''
+
+        content_blocks = [serialize_content_block(block, self.server.pretty_print)
+                for block in content_blocks]
+
+        if key is not None:
+            self.response_cache.set(key, (more, record_count, partial_count,
+                cursor, content_blocks), permanent=key[-1] is None)
+
+        return content_blocks
+
+
+    def _on_content_block_saved(self, sender, content_block=None, collection_ids=None):
+        if not self.response_cache:
+            return
+        for collection_id in collection_ids or []:
+            self.response_cache.invalidate(collection_id)
+
+
+    def is_materialization_required(self, collection, timeframe=None,
+            content_bindings=[]):
+        '''
+        Check if a result is estimated to hold more blocks than
+        `async_threshold`, from the cached count if there is one, or else
+        by probing for a block past the threshold.
+        '''
+
+        if not self.materializer:
+            return False
+
+        count = self.get_cached_content_blocks_count(collection, timeframe=timeframe,
+                content_bindings=content_bindings)
+
+        if count is not None:
+            return count > self.async_threshold
+
+        start_time, end_time = timeframe or (None, None)
+
+        following = self.server.persistence.get_content_blocks(
+            collection_id = collection.id,
+            start_time = start_time,
+            end_time = end_time,
+            bindings = content_bindings,
+            offset = self.async_threshold,
+            limit = 1,
+        )
+
+        return bool(following)
+
+
+    def create_result_set(self, collection, content_bindings=[], timeframe=(None, None),
+            materialize=False):
+        '''
+        Create a result set bounded by the high-water mark of the
+        collection. With `materialize`, the result set is queued
+        to be materialized if the service has background workers. Its
+        timeframe is then closed at the current time, so the snapshot
+        holds the blocks matching at the time of the request.
+        '''
 
         result_id = self.generate_id()
 
+        materialize = materialize and self.materializer is not None
+
+        if materialize:
+            start_time, end_time = timeframe or (None, None)
+            timeframe = (start_time, end_time or get_utc_now())
+
         entity = ResultSetEntity(
             result_id = result_id,
             collection_id = collection.id,
             content_bindings = content_bindings,
-            timeframe = timeframe
+            timeframe = timeframe,
+            high_water_mark = self.server.persistence.get_high_water_mark(collection.id),
+            ready = False if materialize else None
         )
 
-        return self.server.persistence.create_result_set(entity)
+        result_set = self.server.persistence.create_result_set(entity)
+
+        if materialize:
+            self.materializer.submit(result_id)
+
+        return result_set
+
+
+    def materialize_result_set(self, result_id):
+
+        persistence = self.server.persistence
+
+        if not persistence.claim_result_set(result_id, self.async_lease):
+            log.debug("Result set is materialized by another worker",
+                    result_set_id=result_id)
+            return
+
+        try:
+            persistence.materialize_result_set(result_id)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                persistence.release_result_set(result_id)
+            except Exception:
+                # Abandoned result set is taken over once its lease expires
+                log.error("Failed to release result set", result_set_id=result_id,
+                        exc_info=True)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+    def get_result_set_blocks(self, result_set, part_number=1):
+        '''
+        Get content blocks of a part of a materialized result set.
+        Raises :class:`ResultsNotReady` if the snapshot is not written
+        yet; the result set is queued again if it is not queued in this
+        process, e.g. after a restart.
+        '''
+
+        if not result_set.ready:
+            if self.materializer:
+                self.materializer.submit(result_set.result_id)
+            raise ResultsNotReady()
+
+        offset, limit = self.get_offset_limit(part_number)
+        limit = max(min(limit, result_set.blocks_count - offset), 0)
+
+        if not limit:
+            return []
+
+        return self.server.persistence.get_result_set_blocks(result_set.result_id,
+                offset=offset, limit=limit)
+
+
+    def get_wait_time(self):
+        '''
+        Estimated wait in seconds for results that are not ready.
+        '''
+
+        if not self.materializer:
+            return self.wait_time
+
+        return self.materializer.get_wait_time(self.wait_time)
 
 
     def get_result_set(self, result_set_id):
@@ -100,3 +501,8 @@ class PollService(TaxiiService):
     def get_subscription(self, subscription_id):
         return self.server.persistence.get_subscription(subscription_id)
 
+
+def get_count_key(collection, timeframe, content_bindings):
+    bindings = tuple(sorted((b.binding, tuple(sorted(b.subtypes or [])))
+            for b in content_bindings or []))
+    return (collection.id, tuple(timeframe or (None, None)), bindings)
@@ -11,9 +11,10 @@ from .http import (
     HTTP_X_TAXII_ACCEPT, HTTP_X_TAXII_CONTENT_TYPE,
     get_http_headers
 )
+from .serialization import message_to_xml
 
 
-def process_status_exception(exception, headers, is_secure):
+def process_status_exception(exception, headers, is_secure, pretty_print=False):
 
     accepted_content = headers.get(HTTP_X_TAXII_ACCEPT)
 
@@ -35,7 +36,7 @@ def process_status_exception(exception, headers, is_secure):
 
     response_headers = get_http_headers(version, is_secure)
 
-    return status.to_xml(pretty_print=True), response_headers
+    return message_to_xml(status, pretty_print=pretty_print), response_headers
 
 
 def exception_to_status(exception, format_version):
@@ -52,6 +53,10 @@ def exception_to_status(exception, format_version):
     if format_version == VID_TAXII_XML_11:
         sm = tm11.StatusMessage(**data)
     elif format_version == VID_TAXII_XML_10:
+        # TAXII 1.0 status detail is a plain string
+        if isinstance(data['status_detail'], dict):
+            data['status_detail'] = '; '.join('%s=%s' % (k, v)
+                    for k, v in data['status_detail'].items())
         sm = tm10.StatusMessage(**data)
     else:
         raise ValueError("Unknown version: %s" % format_version)
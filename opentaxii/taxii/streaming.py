@@ -0,0 +1,195 @@
+import copy
+import structlog
+
+from lxml import etree
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import (
+    VID_TAXII_XML_10, VID_TAXII_XML_11, MSG_INBOX_MESSAGE
+)
+
+from .exceptions import BadMessageStatus, raise_failure
+from .bindings import MESSAGE_VALIDATOR_PARSER, MESSAGE_NAMESPACES
+from .serialization import iter_message_xml
+
+log = structlog.getLogger(__name__)
+
+CONTENT_BLOCK_TAG = 'Content_Block'
+
+STREAMING_MESSAGE_MODULES = {
+    VID_TAXII_XML_10: tm10,
+    VID_TAXII_XML_11: tm11,
+}
+
+
+class BoundedReader(object):
+    '''
+    File-like wrapper that fails when more than `max_size` bytes are read.
+    '''
+
+    def __init__(self, stream, max_size=None):
+        self.stream = stream
+        self.max_size = max_size
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+
+        if self.max_size and self.bytes_read > self.max_size:
+            raise_failure("Request body exceeds maximum allowed size of %d bytes"
+                    % self.max_size)
+
+        return data
+
+
+def iterparse_inbox_message(content_type, stream, do_validate=True):
+    '''
+    Incrementally parse an Inbox Message from a file-like object.
+
+    Returns a tuple of the Inbox Message envelope (a libtaxii message
+    without content blocks) and a generator of content blocks. Only the
+    content block being parsed is kept in memory.
+    '''
+
+    if content_type not in STREAMING_MESSAGE_MODULES:
+        raise_failure('TAXII Content Type "%s" is not supported' % content_type)
+
+    module = STREAMING_MESSAGE_MODULES[content_type]
+    namespace = MESSAGE_NAMESPACES[module]
+    validator = MESSAGE_VALIDATOR_PARSER[content_type].validator
+
+    block_tag = '{%s}%s' % (namespace, CONTENT_BLOCK_TAG)
+
+    events = etree.iterparse(stream, events=('start', 'end'), no_network=True,
+            resolve_entities=False, huge_tree=False)
+
+    try:
+        root, envelope, first_block = _read_envelope(events, module, namespace,
+                block_tag, validator if do_validate else None)
+    except etree.XMLSyntaxError as e:
+        log.error("Invalid XML received", exc_info=True)
+        raise BadMessageStatus('Request was invalid XML', e=e)
+
+    def content_blocks():
+
+        if first_block is None:
+            return
+
+        try:
+            for event, elem in events:
+                if event != 'end' or elem.getparent() is not root \
+                        or elem.tag != block_tag:
+                    continue
+
+                if do_validate:
+                    _validate_block(root, elem, validator, envelope.message_id)
+                else:
+                    root.remove(elem)
+
+                yield module.ContentBlock.from_etree(elem)
+
+                elem.clear()
+        except etree.XMLSyntaxError as e:
+            log.error("Invalid XML received", exc_info=True)
+            raise BadMessageStatus('Request was invalid XML', e=e,
+                    in_response_to=envelope.message_id)
+
+    return envelope, content_blocks()
+
+
+def _read_envelope(events, module, namespace, block_tag, validator):
+
+    root = None
+
+    for event, elem in events:
+
+        if root is None:
+            root = elem
+            if etree.QName(root).namespace != namespace or \
+                    etree.QName(root).localname != MSG_INBOX_MESSAGE:
+                raise_failure("Only Inbox Messages can be streamed")
+            continue
+
+        is_first_block = (event == 'start' and elem.tag == block_tag
+                and elem.getparent() is root)
+
+        if is_first_block or (event == 'end' and elem is root):
+
+            envelope_xml = copy.deepcopy(root)
+            for block in envelope_xml.findall(block_tag):
+                envelope_xml.remove(block)
+
+            message_id = root.get('message_id')
+
+            if validator:
+                _validate(validator, envelope_xml, message_id)
+
+            envelope = module.InboxMessage.from_etree(envelope_xml)
+
+            return root, envelope, (elem if is_first_block else None)
+
+    raise BadMessageStatus('Request was invalid XML')
+
+
+def _validate_block(root, block, validator, message_id):
+
+    shell = etree.Element(root.tag, attrib=root.attrib, nsmap=root.nsmap)
+
+    # Moving the block under an empty envelope also detaches it from the root
+    shell.append(block)
+
+    _validate(validator, shell, message_id)
+
+
+def _validate(validator, xml, message_id):
+    result = validator.validate_etree(xml)
+    if not result.valid:
+        errors = '; '.join([str(err) for err in result.error_log])
+        raise BadMessageStatus('Request was not schema valid: %s' % errors,
+                in_response_to=message_id)
+
+
+class StreamedMessage(object):
+    '''
+    TAXII message with content blocks serialized one at a time.
+
+    Wraps a libtaxii message without content blocks and an iterable of
+    libtaxii content blocks, which is consumed only while the message is
+    written with :meth:`iter_xml`.
+    '''
+
+    def __init__(self, envelope, content_blocks):
+        self.envelope = envelope
+        self.content_blocks = content_blocks
+
+        self.blocks_written = 0
+
+    @property
+    def version(self):
+        return self.envelope.version
+
+    @property
+    def message_id(self):
+        return self.envelope.message_id
+
+
+    def iter_xml(self, pretty_print=False):
+        '''
+        Generator of XML fragments of the message: the envelope up to the
+        content blocks, every content block and the rest of the envelope.
+        '''
+
+        return iter_message_xml(self.envelope, pretty_print=pretty_print,
+                content_blocks=self._count_blocks())
+
+
+    def _count_blocks(self):
+        for block in self.content_blocks:
+            yield block
+            self.blocks_written += 1
+
+
+    def to_xml(self, pretty_print=False):
+        return ''.join(self.iter_xml(pretty_print=pretty_print))
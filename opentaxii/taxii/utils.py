@@ -2,10 +2,12 @@ import pytz
 import structlog
 from datetime import datetime
 
+from lxml import etree
 from lxml.etree import XMLSyntaxError
+from libtaxii.common import get_xml_parser
 
 from .exceptions import BadMessageStatus
-from .bindings import MESSAGE_VALIDATOR_PARSER
+from .bindings import MESSAGE_VALIDATOR_PARSER, MESSAGE_NAMESPACES
 
 log = structlog.getLogger(__name__)
 
@@ -14,39 +16,132 @@ def get_utc_now():
     return datetime.utcnow().replace(tzinfo=pytz.UTC)
 
 
-def is_content_supported(supported_bindings, content_binding, version=None):
+def get_cursor(blocks):
+    '''
+    Return the `(date_created, id)` cursor of the last of content block
+    entities `blocks`, None if there are none.
+    '''
+
+    if not blocks:
+        return None
+
+    last = blocks[-1]
+    return (last.date_created, last.id)
+
+
+class ContentBindingMatcher(object):
+    '''
+    Index of supported content bindings, compiled once for constant time
+    lookups of content bindings.
+
+    Binding IDs are mapped to a set of supported subtypes, or to None if
+    all subtypes of a binding are supported.
+    '''
+
+    def __init__(self, supported_bindings):
+
+        self.index = {}
+
+        for supported in supported_bindings:
+            if not supported.subtypes or self.index.get(supported.binding, ()) is None:
+                self.index[supported.binding] = None
+            else:
+                self.index.setdefault(supported.binding, set()).update(supported.subtypes)
+
+
+    def matches(self, content_binding, version=None):
 
-    if not hasattr(content_binding, 'binding_id') or version == 10:
-        binding_id = content_binding
-        subtype = None
-    else:
-        binding_id = content_binding.binding_id
-        subtype = content_binding.subtype_ids[0] if content_binding.subtype_ids else None #FIXME: may be not the best option
+        if not hasattr(content_binding, 'binding_id') or version == 10:
+            binding_id = content_binding
+            subtype = None
+        else:
+            binding_id = content_binding.binding_id
+            subtype = content_binding.subtype_ids[0] if content_binding.subtype_ids else None #FIXME: may be not the best option
 
-    matches = [
-        ((supported.binding == binding_id) and (not supported.subtypes or subtype in supported.subtypes))
-        for supported in supported_bindings
-    ]
+        if binding_id not in self.index:
+            return False
 
-    return any(matches)
+        subtypes = self.index[binding_id]
 
+        return subtypes is None or subtype in subtypes
 
-def parse_message(content_type, body, do_validate=True):
+
+    def get_subtypes(self, binding_id):
+        '''
+        Return supported subtypes of the binding, None if all subtypes
+        are supported. Raises KeyError if the binding is not supported.
+        '''
+        return self.index[binding_id]
+
+
+    def __contains__(self, binding_id):
+        return binding_id in self.index
+
+
+def is_content_supported(supported_bindings, content_binding, version=None):
+    return ContentBindingMatcher(supported_bindings).matches(content_binding,
+            version=version)
+
+
+def parse_message(content_type, body, do_validate=True, envelope_only=False):
 
     validator_parser = MESSAGE_VALIDATOR_PARSER[content_type]
 
+    # The same tree is used for validation and for building the message
+    try:
+        etree_xml = etree.fromstring(body, get_xml_parser())
+    except XMLSyntaxError as e:
+        log.error("Invalid XML received", exc_info=True)
+        raise BadMessageStatus('Request was invalid XML', e=e)
+
     if do_validate:
-        try:
-            result = validator_parser.validator.validate_string(body)
-            if not result.valid:
-                errors = '; '.join([str(err) for err in result.error_log])
-                raise BadMessageStatus('Request was not schema valid: %s' % errors)
-        except XMLSyntaxError as e:
-            log.error("Invalid XML received", exc_info=True)
-            raise BadMessageStatus('Request was invalid XML', e=e)
+        if envelope_only:
+            result = validate_envelope(validator_parser.validator, etree_xml)
+        else:
+            result = validator_parser.validator.validate_etree(etree_xml)
+
+        if not result.valid:
+            errors = '; '.join([str(err) for err in result.error_log])
+            raise BadMessageStatus('Request was not schema valid: %s' % errors)
 
-    taxii_message = validator_parser.parser(body)
+    taxii_message = validator_parser.parser(etree_xml)
 
     return taxii_message
 
 
+def validate_envelope(validator, etree_xml):
+    '''
+    Validate the message against the schema, skipping the XML payloads
+    of the content blocks.
+    '''
+
+    namespaces = {'taxii': etree.QName(etree_xml).namespace}
+    if namespaces['taxii'] not in MESSAGE_NAMESPACES.values():
+        return validator.validate_etree(etree_xml)
+
+    detached = []
+    for content in etree_xml.xpath('./taxii:Content_Block/taxii:Content',
+            namespaces=namespaces):
+        payload = list(content)
+        for child in payload:
+            content.remove(child)
+        detached.append((content, payload))
+
+    try:
+        return validator.validate_etree(etree_xml)
+    finally:
+        for content, payload in detached:
+            content.extend(payload)
+
+
+def get_message_envelope(message):
+    '''
+    Serialize the message without its content blocks.
+    '''
+
+    content_blocks = message.content_blocks
+    message.content_blocks = []
+    try:
+        return message.to_xml()
+    finally:
+        message.content_blocks = content_blocks
@@ -0,0 +1,152 @@
+import time
+import threading
+import structlog
+
+from collections import OrderedDict
+
+from lxml import etree
+from libtaxii.common import get_xml_parser
+
+from .bindings import CONTENT_BINDINGS
+from .pipeline import WorkerPool, POOL_PROCESS
+
+log = structlog.getLogger(__name__)
+
+SD_REJECTED_CONTENT_BLOCK = 'REJECTED_CONTENT_BLOCK'
+
+
+class SchemaCache(object):
+    '''
+    LRU cache of compiled XML schemas, keyed by the path of the XSD file.
+
+    :param size: maximum amount of compiled schemas kept
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.schemas = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, path):
+
+        with self._lock:
+            schema = self.schemas.pop(path, None)
+            if schema is None:
+                log.debug("Compiling schema", path=path)
+                schema = etree.XMLSchema(etree.parse(path))
+
+            self.schemas[path] = schema
+
+            while len(self.schemas) > self.size:
+                self.schemas.popitem(last=False)
+
+            return schema
+
+
+# Compiled schemas are kept per process, so every pool worker
+# compiles a schema at most once
+_schema_cache = None
+
+
+def get_schema(path, cache_size):
+    global _schema_cache
+
+    if _schema_cache is None or _schema_cache.size != cache_size:
+        _schema_cache = SchemaCache(cache_size)
+
+    return _schema_cache.get(path)
+
+
+def validate_payload(task):
+    '''
+    Validate a payload against the XSD. Takes a tuple
+    `(schema_path, cache_size, content)` and returns a tuple
+    `(error, elapsed_time)`, where error is None for a valid payload.
+    '''
+
+    schema_path, cache_size, content = task
+
+    started = time.time()
+
+    schema = get_schema(schema_path, cache_size)
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    try:
+        document = etree.fromstring(content, get_xml_parser())
+    except etree.XMLSyntaxError, e:
+        error = 'Malformed XML: %s' % e
+    else:
+        if schema.validate(document):
+            error = None
+        else:
+            error = str(schema.error_log.last_error)
+
+    return error, time.time() - started
+
+
+class ContentValidator(object):
+    '''
+    Validates content block payloads against XSD schemas of their
+    content bindings, in a pool of worker processes.
+
+    :param schemas: dict of STIX content binding ID to the path of the XSD file
+    :param workers=1: amount of worker processes, 0 validates in
+                      the calling thread
+    :param cache_size=16: amount of compiled schemas kept in every process
+    '''
+
+    def __init__(self, schemas, workers=1, cache_size=16):
+
+        unknown = set(schemas) - set(CONTENT_BINDINGS)
+        if unknown:
+            raise ValueError('Validation is not supported for content bindings: %s'
+                    % ', '.join(sorted(unknown)))
+
+        self.schemas = schemas
+        self.cache_size = int(cache_size)
+        self.pool = WorkerPool(workers=int(workers), pool_type=POOL_PROCESS)
+
+        self.validated_blocks = 0
+        self.rejected_blocks = 0
+        self.validation_time = 0.0
+
+        self._lock = threading.Lock()
+
+
+    def is_supported(self, binding):
+        return binding in self.schemas
+
+
+    def validate(self, blocks):
+        '''
+        Validate content block entities. Returns a list of errors,
+        one per block, None for valid blocks.
+        '''
+
+        tasks = [(self.schemas[b.content_binding.binding], self.cache_size, b.content)
+                for b in blocks]
+
+        results = self.pool.map(validate_payload, tasks)
+
+        errors = [error for error, _ in results]
+
+        with self._lock:
+            self.validated_blocks += len(results)
+            self.rejected_blocks += len(filter(None, errors))
+            self.validation_time += sum(elapsed for _, elapsed in results)
+
+        return errors
+
+
+    def stats(self):
+        with self._lock:
+            return dict(validated_blocks=self.validated_blocks,
+                    rejected_blocks=self.rejected_blocks,
+                    validation_time=self.validation_time)
+
+
+    def stop(self):
+        self.pool.stop()
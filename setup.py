@@ -25,6 +25,12 @@ setup(
         'console_scripts' : [
             'opentaxii-run-dev = opentaxii.cli.run:run_in_dev_mode',
             'opentaxii-create-account = opentaxii.cli.auth:create_account',
+            'opentaxii-dedupe-content = opentaxii.cli.persistence:deduplicate_content',
+            'opentaxii-compress-content = opentaxii.cli.persistence:compress_content',
+            'opentaxii-load-content = opentaxii.cli.persistence:load_content',
+            'opentaxii-upgrade-db = opentaxii.cli.persistence:upgrade_database',
+            'opentaxii-backfill-timeline = opentaxii.cli.persistence:backfill_timeline',
+            'opentaxii-rebuild-statistics = opentaxii.cli.persistence:rebuild_statistics',
         ]
     },
 
@@ -1,11 +1,21 @@
+import os
+import time
+import socket
+import subprocess
 import pytest
 
+from lxml import etree
 from libtaxii import messages_10 as tm10
 from libtaxii import messages_11 as tm11
 
+from opentaxii.spool import Spool
+from opentaxii.taxii.pipeline import WorkerPool
+from opentaxii.taxii.validation import SchemaCache, SD_REJECTED_CONTENT_BLOCK
 from opentaxii.taxii import exceptions
+from opentaxii.taxii.utils import parse_message
 from opentaxii.utils import create_services_from_object, get_config_for_tests
 from opentaxii.server import create_server
+from opentaxii.persistence.sqldb import converters as conv
 
 from utils import get_service, prepare_headers, as_tm
 from fixtures import *
@@ -109,6 +119,24 @@ def test_inbox_request_destination_collection(server, https):
         response = inbox.process(headers, inbox_message)
 
 
+def test_inbox_request_repeated_destination_collection(server):
+    version = 11
+
+    inbox_message = make_inbox_message(version, blocks=[make_content(version)],
+            dest_collection=COLLECTION_OPEN)
+    inbox_message.destination_collection_names.append(COLLECTION_OPEN)
+
+    inbox = get_service(server, 'inbox-B')
+    response = inbox.process(prepare_headers(version, False), inbox_message)
+
+    assert response.status_type == ST_SUCCESS
+
+    collection = server.persistence.get_collection(COLLECTION_OPEN, inbox.id)
+
+    assert len(server.persistence.get_content_blocks(collection.id)) == 1
+    assert server.persistence.get_content_blocks_count(collection.id) == 1
+
+
 @pytest.mark.parametrize("https", [True, False])
 @pytest.mark.parametrize("version", [11, 10])
 def test_inbox_request_inbox_valid_content_binding(server, version, https):
@@ -182,3 +210,548 @@ def test_inbox_request_collection_content_bindings_filtering(server, version, ht
     assert len(blocks) == 1
 
 
+
+
+def create_spooled_server(tmpdir, **spool_options):
+
+    config = get_config_for_tests(DOMAIN,
+            persistence_db='sqlite:///%s' % tmpdir.join('data.db'))
+    server = create_server(config)
+
+    inbox = dict(INBOX_A, spool_dir=str(tmpdir.join('spool')), **spool_options)
+
+    create_services_from_object({'inbox-spooled' : inbox}, server.persistence)
+    server.reload_services()
+
+    return server
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_inbox_spooled(tmpdir, version):
+
+    server = create_spooled_server(tmpdir, spool_workers=2)
+    inbox = get_service(server, 'inbox-spooled')
+
+    blocks = [make_content(version), make_content(version)]
+    inbox_message = make_inbox_message(version, blocks=blocks)
+
+    try:
+        response = inbox.process(prepare_headers(version, False), inbox_message)
+
+        assert response.status_type == ST_SUCCESS
+        assert response.in_response_to == MESSAGE_ID
+
+        inbox.spool_drainer.join()
+    finally:
+        inbox.stop()
+
+    assert len(server.persistence.get_content_blocks(None)) == len(blocks)
+    assert inbox.spool.stats() == dict(spool_depth=0, spool_size=0)
+
+
+def test_inbox_spooled_recovery(tmpdir):
+
+    version = 11
+
+    spool = Spool(str(tmpdir.join('spool')))
+    message = make_inbox_message(version, blocks=[make_content(version)])
+    spool.append(message.version, message.to_xml())
+
+    server = create_spooled_server(tmpdir)
+    inbox = get_service(server, 'inbox-spooled')
+
+    try:
+        inbox.spool_drainer.join()
+    finally:
+        inbox.stop()
+
+    assert len(server.persistence.get_content_blocks(None)) == 1
+    assert not inbox.spool.pending()
+
+
+def test_inbox_spooled_back_pressure(tmpdir):
+
+    version = 11
+
+    server = create_spooled_server(tmpdir, spool_workers=0, spool_max_size=10)
+    inbox = get_service(server, 'inbox-spooled')
+
+    inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+
+    with pytest.raises(exceptions.StatusMessageException) as e:
+        inbox.process(prepare_headers(version, False), inbox_message)
+
+    assert e.value.status_type == ST_RETRY
+    assert SD_ESTIMATED_WAIT in e.value.status_details
+
+
+@pytest.mark.parametrize("retention", ['full', 'headers', 'compressed', 'none'])
+def test_inbox_message_retention(server, retention):
+
+    version = 11
+
+    inbox = get_service(server, 'inbox-A')
+    inbox.message_retention = retention
+
+    content = CONTENT * 100
+    inbox_message = make_inbox_message(version,
+            blocks=[make_content(version, content=content)])
+    # Bytes that are not valid UTF-8 are kept as well
+    raw_message = inbox_message.to_xml(pretty_print=True) + '<!-- \xff\xfe -->'
+
+    response = inbox.process(prepare_headers(version, False), inbox_message,
+            raw_message=raw_message)
+    assert response.status_type == ST_SUCCESS
+
+    api = server.persistence.api
+    stored = api.InboxMessage.query.one()
+    entity = conv.to_inbox_message_entity(stored)
+
+    if retention == 'full':
+        assert entity.original_message == raw_message
+        assert isinstance(entity.original_message, str)
+        assert stored.compressed_message is None
+    elif retention == 'compressed':
+        assert entity.original_message == raw_message
+        assert stored.original_message == ''
+        assert len(stored.compressed_message) < len(raw_message)
+    elif retention == 'headers':
+        assert MESSAGE_ID in entity.original_message
+        assert content not in entity.original_message
+    else:
+        assert entity.original_message is None
+
+    assert entity.content_block_count == 1
+
+
+def test_inbox_destination_collections_cached(server, monkeypatch):
+
+    version = 11
+
+    inbox = get_service(server, 'inbox-B')
+    headers = prepare_headers(version, False)
+
+    calls = []
+    get_collections = server.persistence.api.get_collections
+
+    def counting_get_collections(*args, **kwargs):
+        calls.append(args)
+        return get_collections(*args, **kwargs)
+
+    monkeypatch.setattr(server.persistence.api, 'get_collections',
+            counting_get_collections)
+
+    for _ in range(3):
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)],
+                dest_collection=COLLECTION_OPEN)
+        response = inbox.process(headers, inbox_message)
+        assert response.status_type == ST_SUCCESS
+
+    assert len(calls) == 1
+
+    # Attaching a collection to the service invalidates the cache
+    collection = server.persistence.create_collection(
+            entities.CollectionEntity('new-collection', accept_all_content=True))
+    server.persistence.attach_collection_to_services(collection.id,
+            services_ids=[inbox.id])
+
+    inbox_message = make_inbox_message(version, blocks=[make_content(version)],
+            dest_collection='new-collection')
+    response = inbox.process(headers, inbox_message)
+    assert response.status_type == ST_SUCCESS
+
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("pool_type", ['thread', 'process'])
+def test_inbox_parallel_block_processing(server, pool_type):
+
+    version = 11
+
+    inbox = get_service(server, 'inbox-B')
+    inbox.block_pool = WorkerPool(workers=2, pool_type=pool_type)
+
+    ids = ['package-%d' % i for i in range(20)]
+    blocks = [make_content(version, content='<package xmlns="urn:test" id="%s"/>' % i)
+            for i in ids]
+    blocks.insert(5, make_content(version, content_binding=INVALID_CONTENT_BINDING))
+
+    # Blocks of a parsed message hold XML elements, that can not be pickled
+    inbox_message = parse_message(VID_TAXII_XML_11, make_inbox_message(version,
+        blocks=blocks, dest_collection=COLLECTION_STIX_AND_CUSTOM).to_xml())
+
+    try:
+        response = inbox.process(prepare_headers(version, False), inbox_message)
+    finally:
+        inbox.stop()
+
+    assert response.status_type == ST_SUCCESS
+
+    stored = server.persistence.get_content_blocks(None, limit=100)
+    assert [etree.fromstring(b.content).get('id')
+            for b in sorted(stored, key=lambda b: b.id)] == ids
+
+
+PACKAGE_SCHEMA = '''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+        targetNamespace="http://stix.mitre.org/stix-1"
+        elementFormDefault="qualified">
+    <xs:element name="STIX_Package">
+        <xs:complexType>
+            <xs:attribute name="version" type="xs:string" use="required"/>
+        </xs:complexType>
+    </xs:element>
+</xs:schema>'''
+
+VALID_PACKAGE = '<STIX_Package xmlns="http://stix.mitre.org/stix-1" version="1.1.1"/>'
+INVALID_PACKAGE = '<STIX_Package xmlns="http://stix.mitre.org/stix-1"/>'
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+@pytest.mark.parametrize("version", [11, 10])
+def test_inbox_content_validation(tmpdir, version, workers):
+
+    schema = tmpdir.join('stix_core.xsd')
+    schema.write(PACKAGE_SCHEMA)
+
+    config = get_config_for_tests(DOMAIN)
+    server = create_server(config)
+
+    inbox = dict(INBOX_A, content_schemas={CB_STIX_XML_111: str(schema)},
+            validation_workers=workers, destination_collection_required=(version == 11))
+    create_services_from_object({'inbox-validated' : inbox}, server.persistence)
+    server.reload_services()
+
+    collection = server.persistence.create_collection(entities.CollectionEntity(
+        'validated', accept_all_content=True, validate_content=True))
+    server.persistence.attach_collection_to_services(collection.id,
+            services_ids=['inbox-validated'])
+
+    inbox = get_service(server, 'inbox-validated')
+
+    blocks = [
+        make_content(version, content_binding=CB_STIX_XML_111, content=VALID_PACKAGE),
+        make_content(version, content_binding=CB_STIX_XML_111, content=INVALID_PACKAGE),
+        make_content(version, content_binding=CB_STIX_XML_111, content='<not-closed>'),
+        make_content(version, content_binding=CUSTOM_CONTENT_BINDING, content=INVALID_PACKAGE),
+    ]
+    inbox_message = make_inbox_message(version, blocks=blocks,
+            dest_collection='validated')
+
+    try:
+        response = inbox.process(prepare_headers(version, False), inbox_message)
+    finally:
+        inbox.stop()
+
+    assert response.status_type == ST_SUCCESS
+
+    if version == 11:
+        details = response.status_detail[SD_REJECTED_CONTENT_BLOCK]
+        assert [d.split(':')[0] for d in details] == ['1', '2']
+    else:
+        assert response.status_detail.startswith('1: ')
+
+    # Invalid payload of a binding without schema is not validated
+    stored = server.persistence.get_content_blocks(collection.id)
+    assert sorted(b.content_binding.binding for b in stored) == \
+            sorted([CB_STIX_XML_111, CUSTOM_CONTENT_BINDING])
+
+    assert inbox.content_validator.stats()['rejected_blocks'] == 2
+
+
+def test_schema_cache(tmpdir):
+
+    paths = []
+    for name in ('a', 'b', 'c'):
+        schema = tmpdir.join('%s.xsd' % name)
+        schema.write(PACKAGE_SCHEMA)
+        paths.append(str(schema))
+
+    cache = SchemaCache(size=2)
+
+    compiled = cache.get(paths[0])
+    assert cache.get(paths[0]) is compiled
+
+    cache.get(paths[1])
+    cache.get(paths[2])
+
+    # Least recently used schema is evicted
+    assert cache.schemas.keys() == paths[1:]
+
+
+def create_idempotent_server(tmpdir):
+
+    config = get_config_for_tests(DOMAIN,
+            persistence_db='sqlite:///%s' % tmpdir.join('data.db'))
+    server = create_server(config)
+
+    create_services_from_object({
+        'inbox-idempotent' : dict(INBOX_A, idempotent=True)}, server.persistence)
+    server.reload_services()
+
+    return server
+
+
+def test_inbox_idempotent(tmpdir, monkeypatch):
+
+    version = 11
+
+    server = create_idempotent_server(tmpdir)
+    inbox = get_service(server, 'inbox-idempotent')
+
+    lookups = []
+    get_inbox_message = server.persistence.get_inbox_message
+
+    def counting_get_inbox_message(key):
+        lookups.append(key)
+        return get_inbox_message(key)
+
+    monkeypatch.setattr(server.persistence, 'get_inbox_message', counting_get_inbox_message)
+
+    def send(account=None):
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+        response = inbox.process(prepare_headers(version, False), inbox_message,
+                account=account)
+        assert response.status_type == ST_SUCCESS
+        assert response.in_response_to == MESSAGE_ID
+
+    send()
+    send()
+
+    # New messages and recent repeats are recognised without a query
+    assert lookups == []
+    assert len(server.persistence.get_content_blocks(None)) == 1
+
+    # Messages with the same ID from other accounts are processed
+    send(account=dict(id=1))
+    assert len(server.persistence.get_content_blocks(None)) == 2
+
+    # Another process does not know about processed messages,
+    # but the database does
+    server.reload_services()
+    inbox = get_service(server, 'inbox-idempotent')
+
+    send()
+    assert len(server.persistence.get_content_blocks(None)) == 2
+    assert server.persistence.api.InboxMessage.query.count() == 2
+
+
+def test_inbox_idempotent_processed_elsewhere(tmpdir, monkeypatch):
+
+    version = 11
+
+    server = create_idempotent_server(tmpdir)
+    inbox = get_service(server, 'inbox-idempotent')
+
+    def send():
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+        return inbox.process(prepare_headers(version, False), inbox_message)
+
+    assert send().status_type == ST_SUCCESS
+
+    key = inbox.get_idempotency_key(MESSAGE_ID, None)
+
+    message = server.persistence.get_inbox_message(key)
+    message.rejected_blocks = [(0, 'Invalid content')]
+    server.persistence.update_inbox_message(message)
+
+    # Another process catches the repeat with the unique index
+    server.reload_services()
+    inbox = get_service(server, 'inbox-idempotent')
+
+    response = send()
+    assert response.status_type == ST_SUCCESS
+    assert response.status_detail[SD_REJECTED_CONTENT_BLOCK] == ['0: Invalid content']
+
+    lookups = []
+    monkeypatch.setattr(server.persistence, 'get_inbox_message', lookups.append)
+
+    response = send()
+    assert response.status_detail[SD_REJECTED_CONTENT_BLOCK] == ['0: Invalid content']
+    assert lookups == []
+
+    assert len(server.persistence.get_content_blocks(None)) == 1
+
+
+def test_inbox_idempotent_failed_message_retried(tmpdir, monkeypatch):
+
+    version = 11
+
+    server = create_idempotent_server(tmpdir)
+    inbox = get_service(server, 'inbox-idempotent')
+
+    def send():
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+        return inbox.process(prepare_headers(version, False), inbox_message)
+
+    create_content_blocks = server.persistence.create_content_blocks
+
+    def failing_create_content_blocks(*args, **kwargs):
+        raise RuntimeError('Database is not available')
+
+    monkeypatch.setattr(server.persistence, 'create_content_blocks',
+            failing_create_content_blocks)
+
+    with pytest.raises(exceptions.FailureStatus):
+        send()
+
+    monkeypatch.setattr(server.persistence, 'create_content_blocks', create_content_blocks)
+
+    # Message is processed again, as its content was not stored
+    assert send().status_type == ST_SUCCESS
+    assert len(server.persistence.get_content_blocks(None)) == 1
+
+    assert send().status_type == ST_SUCCESS
+    assert len(server.persistence.get_content_blocks(None)) == 1
+
+
+def test_inbox_idempotent_incomplete_message(tmpdir):
+
+    version = 11
+
+    server = create_idempotent_server(tmpdir)
+    inbox = get_service(server, 'inbox-idempotent')
+
+    def send():
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+        return inbox.process(prepare_headers(version, False), inbox_message)
+
+    # Message stored by a request that did not store its content yet
+    pending = entities.InboxMessageEntity(MESSAGE_ID, None, 1, inbox.id,
+            idempotency_key=inbox.get_idempotency_key(MESSAGE_ID), completed=False)
+    pending = server.persistence.create_inbox_message(pending)
+
+    with pytest.raises(exceptions.StatusMessageException) as e:
+        send()
+
+    assert e.value.status_type == ST_RETRY
+    assert len(server.persistence.get_content_blocks(None)) == 0
+
+    # Abandoned message is taken over once its lease expires
+    inbox.idempotency_lease = 0
+
+    assert send().status_type == ST_SUCCESS
+    assert len(server.persistence.get_content_blocks(None)) == 1
+
+    stored = server.persistence.get_inbox_message(pending.idempotency_key)
+    assert stored.id == pending.id
+    assert stored.completed
+
+
+def test_inbox_spooled_worker_survives_errors(tmpdir, monkeypatch):
+
+    version = 11
+
+    server = create_spooled_server(tmpdir)
+    inbox = get_service(server, 'inbox-spooled')
+
+    def failing_complete(name):
+        raise OSError('Spool is not writable')
+
+    monkeypatch.setattr(inbox.spool, 'complete', failing_complete)
+
+    try:
+        for _ in range(2):
+            inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+            inbox.process(prepare_headers(version, False), inbox_message)
+            inbox.spool_drainer.join()
+
+        assert all(t.is_alive() for t in inbox.spool_drainer.threads)
+    finally:
+        inbox.stop()
+
+    assert len(server.persistence.get_content_blocks(None)) == 2
+
+
+def test_inbox_spooled_temporary_errors_retried(tmpdir, monkeypatch):
+
+    version = 11
+
+    server = create_spooled_server(tmpdir, spool_retry_delay=0.01)
+    inbox = get_service(server, 'inbox-spooled')
+
+    failures = []
+    create_content_blocks = server.persistence.create_content_blocks
+
+    def flaky_create_content_blocks(*args, **kwargs):
+        if len(failures) < 2:
+            failures.append(args)
+            raise RuntimeError('Database is not available')
+        return create_content_blocks(*args, **kwargs)
+
+    monkeypatch.setattr(server.persistence, 'create_content_blocks',
+            flaky_create_content_blocks)
+
+    try:
+        inbox_message = make_inbox_message(version, blocks=[make_content(version)])
+        inbox.process(prepare_headers(version, False), inbox_message)
+
+        for _ in range(100):
+            inbox.spool_drainer.join()
+            if server.persistence.get_content_blocks(None):
+                break
+            time.sleep(0.05)
+    finally:
+        inbox.stop()
+
+    assert len(failures) == 2
+    assert len(server.persistence.get_content_blocks(None)) == 1
+    assert not os.listdir(str(tmpdir.join('spool', 'failed')))
+    assert not os.listdir(str(tmpdir.join('spool', 'processing')))
+
+
+def test_inbox_spooled_invalid_message_rejected(tmpdir):
+
+    server = create_spooled_server(tmpdir)
+    inbox = get_service(server, 'inbox-spooled')
+
+    try:
+        name = inbox.spool.append(VID_TAXII_XML_11, '<not a message')
+        inbox.spool_drainer.notify(name)
+        inbox.spool_drainer.join()
+    finally:
+        inbox.stop()
+
+    assert os.listdir(str(tmpdir.join('spool', 'failed'))) == [name]
+    assert inbox.spool_drainer.stats()['spool_retries'] == 0
+
+
+def test_spool_recovers_abandoned_records(tmpdir):
+
+    path = str(tmpdir.join('spool'))
+    processing = os.path.join(path, 'processing')
+
+    spool = Spool(path, lease=60)
+
+    def take(owner, age=0):
+        name = spool.append(VID_TAXII_XML_11, 'data')
+        spool.claim(name)
+
+        entry = os.path.join(processing, '%s@%s' % (name, owner))
+        os.rename(os.path.join(processing, '%s@%s' % (name, spool.owner)), entry)
+
+        mtime = time.time() - age
+        os.utime(entry, (mtime, mtime))
+        return name
+
+    finished = subprocess.Popen(['true'])
+    finished.wait()
+
+    host = socket.gethostname()
+
+    running = take('%s-%d-0' % (host, os.getppid()))
+    dead = take('%s-%d-0' % (host, finished.pid))
+    # process that was running before with the same process ID
+    restarted = take('%s-%d-0' % (host, os.getpid()))
+    remote = take('other-host-1-0')
+    expired = take('other-host-2-0', age=120)
+    own = take(spool.owner)
+    own_expired = take(spool.owner, age=120)
+
+    recovered = sorted([dead, restarted, expired, own_expired])
+
+    assert sorted(spool.recover()) == recovered
+
+    assert sorted(spool.pending()) == recovered
+    assert sorted(e.partition('@')[0] for e in os.listdir(processing)) == \
+            sorted([running, remote, own])
@@ -1,3 +1,5 @@
+import sys
+import pytz
 import pytest
 import tempfile
 
@@ -10,6 +12,8 @@ from libtaxii import constants
 from opentaxii.taxii import exceptions, entities
 from opentaxii.utils import create_services_from_object, get_config_for_tests
 from opentaxii.server import create_server
+from opentaxii.taxii.services.poll import COUNT_ESTIMATED
+from opentaxii.taxii.cache import ResponseCache
 
 from utils import get_service, prepare_headers, as_tm, persist_content, prepare_subscription_request
 from fixtures import *
@@ -305,3 +309,343 @@ def test_subscribe_and_poll(server, version, https):
     else:
         assert len(poll_response.content_blocks) == blocks_amount
 
+
+
+def test_poll_result_parts_seek(server):
+
+    service = get_service(server, 'poll-A')
+
+    blocks_amount = 50
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    collection = service.get_collection(COLLECTION_OPEN)
+
+    blocks = server.persistence.get_content_blocks(collection.id, limit=blocks_amount)
+    ids = [b.id for b in blocks]
+
+    result_id = service.create_result_set(collection).result_id
+
+    # random access part, no cursor stored yet
+    part = service.get_content_blocks(collection, part_number=3, result_id=result_id)
+    assert [b.id for b in part] == ids[2 * POLL_RESULT_SIZE:]
+
+    served, cursor = server.persistence.get_result_set_cursor(result_id, 4)
+    assert served == 3
+    assert cursor == (part[-1].date_created, part[-1].id)
+
+    part = service.get_content_blocks(collection, part_number=1, result_id=result_id)
+    assert [b.id for b in part] == ids[:POLL_RESULT_SIZE]
+
+    # seeks past the cursor of the first part
+    assert server.persistence.get_result_set_cursor(result_id, 2)[0] == 1
+
+    part = service.get_content_blocks(collection, part_number=2, result_id=result_id)
+    assert [b.id for b in part] == ids[POLL_RESULT_SIZE:2 * POLL_RESULT_SIZE]
+
+    assert server.persistence.get_result_set_cursor(result_id, 3)[0] == 2
+
+
+def test_poll_estimated_count(server):
+
+    version = 11
+
+    service = get_service(server, 'poll-A')
+    service.count_mode = COUNT_ESTIMATED
+    service.max_result_count = sys.maxint
+
+    blocks_amount = 30
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(version, https=False)
+
+    # nothing counted yet, lower bound is reported
+    request = prepare_request(collection_name=COLLECTION_OPEN, version=version)
+    response = service.process(headers, request)
+
+    assert len(response.content_blocks) == POLL_RESULT_SIZE
+    assert response.more is True
+    assert response.record_count.record_count == POLL_RESULT_SIZE + 1
+    assert response.record_count.partial_count is True
+
+    # count-only requests are always counted exactly
+    request = prepare_request(collection_name=COLLECTION_OPEN, count_only=True, version=version)
+    response = service.process(headers, request)
+
+    assert response.record_count.record_count == blocks_amount
+    assert not response.record_count.partial_count
+
+    # count is now cached
+    request = prepare_request(collection_name=COLLECTION_OPEN, version=version)
+    response = service.process(headers, request)
+
+    assert response.record_count.record_count == blocks_amount
+    assert response.record_count.partial_count is True
+
+    request = prepare_fulfilment_request(COLLECTION_OPEN, response.result_id, 2)
+    response = service.process(headers, request)
+
+    assert len(response.content_blocks) == blocks_amount - POLL_RESULT_SIZE
+    assert not response.more
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_poll_response_cache(server, version, monkeypatch):
+
+    service = get_service(server, 'poll-A')
+    service.response_cache = ResponseCache(16)
+
+    blocks_amount = 5
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_ONLY_STIX, service.id)
+
+    headers = prepare_headers(version, https=False)
+    module = tm11 if version == 11 else tm10
+
+    def poll():
+        request = prepare_request(collection_name=COLLECTION_ONLY_STIX, version=version)
+        response = service.process(headers, request)
+        return module.get_message_from_xml(response.to_xml())
+
+    response = poll()
+    assert len(response.content_blocks) == blocks_amount
+
+    # the part is served from the cache with a new envelope
+    def get_content_blocks(*args, **kwargs):
+        raise AssertionError("Content blocks are fetched")
+
+    monkeypatch.setattr(server.persistence, 'get_content_blocks', get_content_blocks)
+
+    cached = poll()
+    assert len(cached.content_blocks) == blocks_amount
+    assert cached.message_id != response.message_id
+    assert [b.content for b in cached.content_blocks] == \
+            [b.content for b in response.content_blocks]
+
+    monkeypatch.undo()
+
+    # saved content invalidates parts of the collection
+    persist_content(server.persistence, COLLECTION_ONLY_STIX, service.id)
+
+    response = poll()
+    assert len(response.content_blocks) == blocks_amount + 1
+
+
+def test_poll_response_cache_result_set_cursor(server):
+
+    service = get_service(server, 'poll-A')
+    service.response_cache = ResponseCache(16)
+    service.max_result_count = sys.maxint
+
+    blocks_amount = 30
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(11, https=False)
+
+    def poll():
+        request = prepare_request(collection_name=COLLECTION_OPEN, version=11)
+        response = service.process(headers, request)
+        return tm11.get_message_from_xml(response.to_xml())
+
+    result_id = poll().result_id
+    cursor = server.persistence.get_result_set_cursor(result_id, 2)
+    assert cursor[1]
+
+    # the part served from the cache records the cursor of its result set
+    cached_result_id = poll().result_id
+    assert cached_result_id != result_id
+    assert server.persistence.get_result_set_cursor(cached_result_id, 2) == cursor
+
+    request = prepare_fulfilment_request(COLLECTION_OPEN, cached_result_id, 2)
+    response = tm11.get_message_from_xml(service.process(headers, request).to_xml())
+
+    assert len(response.content_blocks) == blocks_amount - POLL_RESULT_SIZE
+    assert not response.more
+
+
+def test_poll_response_cache_fixed_timeframe(server):
+
+    service = get_service(server, 'poll-A')
+    service.response_cache = ResponseCache(16, ttl=60)
+
+    collection = service.get_collection(COLLECTION_OPEN)
+
+    past = datetime(2010, 1, 1, tzinfo=pytz.UTC)
+    open_key = service.get_result_part_key(collection, timeframe=(past, None))
+    fixed_key = service.get_result_part_key(collection, timeframe=(None, past))
+
+    service.cache_result_part(open_key, False, 0, False)
+    service.cache_result_part(fixed_key, False, 0, False)
+
+    persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    # content can not be added to a timeframe that ended in the past
+    assert service.get_result_part_key(collection, timeframe=(None, past)) == fixed_key
+    assert service.get_cached_result_part(fixed_key)
+
+    assert service.get_result_part_key(collection, timeframe=(past, None)) != open_key
+
+
+def create_async_server(tmpdir, **poll_options):
+
+    config = get_config_for_tests(DOMAIN,
+            persistence_db='sqlite:///%s' % tmpdir.join('data.db'))
+    server = create_server(config)
+
+    poll = dict(POLL, **poll_options)
+
+    create_services_from_object({'poll-async' : poll}, server.persistence)
+    server.reload_services()
+
+    collection = server.persistence.create_collection(entities.CollectionEntity(
+        name=COLLECTION_OPEN, available=True, accept_all_content=True))
+    server.persistence.attach_collection_to_services(collection.id,
+            services_ids=['poll-async'])
+
+    return server
+
+
+def test_poll_async_materialized(tmpdir):
+
+    server = create_async_server(tmpdir, async_threshold=POLL_RESULT_SIZE)
+    service = get_service(server, 'poll-async')
+
+    blocks_amount = 30
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(11, https=False)
+
+    request = tm11.PollRequest(message_id=MESSAGE_ID, collection_name=COLLECTION_OPEN,
+            poll_parameters=tm11.PollParameters(allow_asynch=True))
+
+    try:
+        response = service.process(headers, request)
+
+        assert isinstance(response, tm11.StatusMessage)
+        assert response.status_type == constants.ST_PENDING
+        assert response.status_detail[constants.SD_ESTIMATED_WAIT] > 0
+
+        result_id = response.status_detail[constants.SD_RESULT_ID]
+
+        # blocks saved after the request are not in the snapshot
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+        service.materializer.join()
+
+        request = prepare_fulfilment_request(COLLECTION_OPEN, result_id, 1)
+        response = service.process(headers, request)
+
+        assert len(response.content_blocks) == POLL_RESULT_SIZE
+        assert response.more
+        assert response.result_id == result_id
+        assert response.record_count.record_count == POLL_MAX_COUNT
+        assert response.record_count.partial_count
+
+        request = prepare_fulfilment_request(COLLECTION_OPEN, result_id, 2)
+        response = service.process(headers, request)
+
+        assert len(response.content_blocks) == blocks_amount - POLL_RESULT_SIZE
+        assert not response.more
+
+        # polls that do not allow asynchronous responses are answered at once
+        request = prepare_request(collection_name=COLLECTION_OPEN, version=11)
+        response = service.process(headers, request)
+
+        assert len(response.content_blocks) == POLL_RESULT_SIZE
+    finally:
+        service.stop()
+
+
+def test_poll_async_pending(tmpdir):
+
+    server = create_async_server(tmpdir, async_threshold=0, async_workers=0)
+    service = get_service(server, 'poll-async')
+
+    persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(11, https=False)
+
+    request = tm11.PollRequest(message_id=MESSAGE_ID, collection_name=COLLECTION_OPEN,
+            poll_parameters=tm11.PollParameters(allow_asynch=True))
+
+    response = service.process(headers, request)
+    result_id = response.status_detail[constants.SD_RESULT_ID]
+
+    # without workers nothing is materialized
+    request = prepare_fulfilment_request(COLLECTION_OPEN, result_id, 1)
+    response = service.process(headers, request)
+
+    assert response.status_type == constants.ST_PENDING
+    assert response.status_detail[constants.SD_RESULT_ID] == result_id
+    assert service.materializer.depth == 1
+
+
+def test_poll_async_claimed(tmpdir):
+
+    server = create_async_server(tmpdir, async_threshold=0, async_workers=0)
+    service = get_service(server, 'poll-async')
+
+    persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(11, https=False)
+
+    request = tm11.PollRequest(message_id=MESSAGE_ID, collection_name=COLLECTION_OPEN,
+            poll_parameters=tm11.PollParameters(allow_asynch=True))
+
+    response = service.process(headers, request)
+    result_id = response.status_detail[constants.SD_RESULT_ID]
+
+    # result set claimed by a worker of another process is skipped
+    assert server.persistence.claim_result_set(result_id, service.async_lease)
+
+    service.materialize_result_set(result_id)
+    assert not server.persistence.get_result_set(result_id).ready
+
+    # claim of a stopped worker is taken over once its lease expires
+    service.async_lease = 0
+
+    service.materialize_result_set(result_id)
+    assert server.persistence.get_result_set(result_id).ready
+
+    assert not server.persistence.claim_result_set(result_id, service.async_lease)
+
+
+def test_poll_result_set_high_water_mark(server):
+
+    version = 11
+
+    service = get_service(server, 'poll-A')
+    service.max_result_count = sys.maxint
+
+    blocks_amount = 30
+    for i in range(blocks_amount):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    headers = prepare_headers(version, https=False)
+
+    request = prepare_request(collection_name=COLLECTION_OPEN, version=version)
+    response = service.process(headers, request)
+
+    assert len(response.content_blocks) == POLL_RESULT_SIZE
+    assert response.record_count.record_count == blocks_amount
+
+    result_id = response.result_id
+
+    # blocks saved after the result set was created are not part of it
+    for i in range(5):
+        persist_content(server.persistence, COLLECTION_OPEN, service.id)
+
+    request = prepare_fulfilment_request(COLLECTION_OPEN, result_id, 2)
+    response = service.process(headers, request)
+
+    assert len(response.content_blocks) == blocks_amount - POLL_RESULT_SIZE
+    assert response.record_count.record_count == blocks_amount
+    assert not response.more
+
+    request = prepare_request(collection_name=COLLECTION_OPEN, version=version)
+    response = service.process(headers, request)
+
+    assert response.record_count.record_count == blocks_amount + 5
@@ -23,3 +23,31 @@ def test_parse_message(content_type):
     assert isinstance(parsed, tm.DiscoveryRequest)
     assert parsed.message_id == MESSAGE_ID
 
+
+
+
+@pytest.mark.parametrize("content_type", [VID_TAXII_XML_10, VID_TAXII_XML_11])
+def test_parse_message_envelope_only(content_type):
+
+    tm = (tm10 if content_type == VID_TAXII_XML_10 else tm11)
+
+    binding = 'custom-binding' if content_type == VID_TAXII_XML_10 \
+            else tm11.ContentBinding('custom-binding')
+
+    payload = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"/>'
+
+    message = tm.InboxMessage(MESSAGE_ID, content_blocks=[
+        tm.ContentBlock(binding, payload)])
+
+    parsed = parse_message(content_type, message.to_xml(), do_validate=True,
+            envelope_only=True)
+
+    assert isinstance(parsed, tm.InboxMessage)
+    assert len(parsed.content_blocks) == 1
+    assert 'STIX_Package' in parsed.content_blocks[0].content
+
+    # Envelope errors are still detected
+    invalid = message.to_xml().replace('message_id="%s"' % MESSAGE_ID, '')
+
+    with pytest.raises(exceptions.BadMessageStatus):
+        parse_message(content_type, invalid, do_validate=True, envelope_only=True)
@@ -0,0 +1,72 @@
+import pytest
+
+from libtaxii import messages_11 as tm11
+
+from opentaxii.taxii import entities
+from opentaxii.taxii.utils import ContentBindingMatcher
+
+from fixtures import *
+
+
+SUPPORTED = [
+    entities.ContentBindingEntity(CB_STIX_XML_111),
+    entities.ContentBindingEntity(CUSTOM_CONTENT_BINDING, subtypes=[CONTENT_BINDING_SUBTYPE]),
+]
+
+
+@pytest.mark.parametrize(("binding", "subtype", "expected"), [
+    (CB_STIX_XML_111, None, True),
+    (CB_STIX_XML_111, CONTENT_BINDING_SUBTYPE, True),
+    (CUSTOM_CONTENT_BINDING, CONTENT_BINDING_SUBTYPE, True),
+    (CUSTOM_CONTENT_BINDING, None, False),
+    (CUSTOM_CONTENT_BINDING, 'other-subtype', False),
+    (INVALID_CONTENT_BINDING, None, False),
+])
+def test_content_binding_matcher(binding, subtype, expected):
+
+    matcher = ContentBindingMatcher(SUPPORTED)
+
+    content_binding = tm11.ContentBinding(binding)
+    if subtype:
+        content_binding.subtype_ids.append(subtype)
+
+    assert matcher.matches(content_binding) == expected
+
+    # TAXII 1.0 bindings have no subtypes
+    assert matcher.matches(binding, version=10) == (binding == CB_STIX_XML_111)
+
+
+def test_content_binding_matcher_merges_subtypes():
+
+    matcher = ContentBindingMatcher([
+        entities.ContentBindingEntity(CUSTOM_CONTENT_BINDING, subtypes=['a']),
+        entities.ContentBindingEntity(CUSTOM_CONTENT_BINDING, subtypes=['b']),
+        entities.ContentBindingEntity(CB_STIX_XML_111, subtypes=['a']),
+        entities.ContentBindingEntity(CB_STIX_XML_111),
+    ])
+
+    assert matcher.get_subtypes(CUSTOM_CONTENT_BINDING) == set(['a', 'b'])
+    assert matcher.get_subtypes(CB_STIX_XML_111) is None
+
+
+def test_collection_matching_bindings():
+
+    collection = entities.CollectionEntity('collection', supported_content=[
+        CB_STIX_XML_111, (CUSTOM_CONTENT_BINDING, ['a', 'b'])])
+
+    assert collection.is_content_supported(tm11.ContentBinding(CB_STIX_XML_111))
+
+    matching = collection.get_matching_bindings([
+        entities.ContentBindingEntity(CB_STIX_XML_111, subtypes=['x']),
+        entities.ContentBindingEntity(CUSTOM_CONTENT_BINDING, subtypes=['b', 'c']),
+        entities.ContentBindingEntity(INVALID_CONTENT_BINDING),
+    ])
+
+    assert [(m.binding, set(m.subtypes)) for m in matching] == [
+        (CB_STIX_XML_111, set(['x'])),
+        (CUSTOM_CONTENT_BINDING, set(['b'])),
+    ]
+
+    # Matcher follows changes of supported content
+    collection.supported_content = []
+    assert not collection.is_content_supported(tm11.ContentBinding(CB_STIX_XML_111))
@@ -5,9 +5,12 @@ from opentaxii.server import create_server
 from opentaxii.utils import create_services_from_object, get_config_for_tests
 
 from libtaxii.constants import (
-    ST_FAILURE, ST_BAD_MESSAGE
+    ST_FAILURE, ST_BAD_MESSAGE, ST_SUCCESS, ST_RETRY, SD_ESTIMATED_WAIT,
+    CB_STIX_XML_111
 )
 
+from opentaxii.taxii import entities
+from opentaxii.taxii.utils import get_utc_now
 from opentaxii.taxii.http import (
     HTTP_X_TAXII_SERVICES
 )
@@ -23,16 +26,63 @@ INBOX = dict(
     protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0', 'urn:taxii.mitre.org:protocol:https:1.0']
 )
 
+STREAM_MAX_BODY_SIZE = 4096
+
+INBOX_STREAMING = dict(
+    type = 'inbox',
+    description = 'inboxStream description',
+    address = '/relative/stream',
+    accept_all_content = True,
+    streaming = True,
+    stream_batch_size = 2,
+    max_body_size = STREAM_MAX_BODY_SIZE,
+    protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0', 'urn:taxii.mitre.org:protocol:https:1.0']
+)
+
+INBOX_LIMITED = dict(
+    type = 'inbox',
+    description = 'inboxLimited description',
+    address = '/relative/limited',
+    accept_all_content = True,
+    rate_limits = dict(blocks=3),
+    protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0', 'urn:taxii.mitre.org:protocol:https:1.0']
+)
+
+INBOX_STREAMING_LIMITED = dict(
+    type = 'inbox',
+    description = 'inboxStreamLimited description',
+    address = '/relative/stream-limited',
+    accept_all_content = True,
+    streaming = True,
+    stream_batch_size = 2,
+    rate_limits = dict(blocks=3),
+    protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0', 'urn:taxii.mitre.org:protocol:https:1.0']
+)
+
+POLL_STREAMING = dict(
+    type = 'poll',
+    description = 'pollStream description',
+    address = '/relative/poll-stream',
+    max_result_size = 3,
+    stream_responses = True,
+    stream_batch_size = 2,
+    protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0', 'urn:taxii.mitre.org:protocol:https:1.0']
+)
+
 DISCOVERY = dict(
     type = 'discovery',
     description = 'discoveryA description',
     address = '/relative/discovery',
-    advertised_services = ['inboxA', 'discoveryA'],
+    advertised_services = ['inboxA', 'inboxStream', 'inboxLimited', 'inboxStreamLimited', 'pollStream', 'discoveryA'],
     protocol_bindings = ['urn:taxii.mitre.org:protocol:http:1.0']
 )
 
 SERVICES = {
     'inboxA' : INBOX,
+    'inboxStream' : INBOX_STREAMING,
+    'inboxLimited' : INBOX_LIMITED,
+    'inboxStreamLimited' : INBOX_STREAMING_LIMITED,
+    'pollStream' : POLL_STREAMING,
     'discoveryA' : DISCOVERY
 }
 
@@ -142,3 +192,182 @@ def test_post_parse_verification(client, version, https):
 
 
 
+
+
+def make_inbox_message(version, blocks_amount, content='some-content'):
+    tm = as_tm(version)
+    if version == 10:
+        blocks = [tm.ContentBlock(CB_STIX_XML_111, content) for _ in range(blocks_amount)]
+    else:
+        blocks = [tm.ContentBlock(tm.ContentBinding(CB_STIX_XML_111), content)
+                for _ in range(blocks_amount)]
+    return tm.InboxMessage(message_id=MESSAGE_ID, content_blocks=blocks)
+
+
+@pytest.mark.parametrize("https", [True, False])
+@pytest.mark.parametrize("version", [11, 10])
+def test_streamed_inbox_message(client, version, https):
+
+    blocks_amount = 5
+    xml_content = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"/>'
+
+    request = make_inbox_message(version, blocks_amount, content=xml_content)
+    base_url = '%s://localhost' % ('https' if https else 'http')
+
+    response = client.post(
+        INBOX_STREAMING['address'],
+        data = request.to_xml(),
+        headers = prepare_headers(version=version, https=https),
+        base_url = base_url
+    )
+
+    assert response.status_code == 200
+    message = as_tm(version).get_message_from_xml(response.data)
+
+    assert message.status_type == ST_SUCCESS
+    assert message.in_response_to == MESSAGE_ID
+
+    blocks = client.application.taxii.persistence.get_content_blocks(None, limit=100)
+
+    assert len(blocks) == blocks_amount
+    assert all('STIX_Package' in b.content for b in blocks)
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_streamed_inbox_message_invalid(client, version):
+
+    response = client.post(
+        INBOX_STREAMING['address'],
+        data = 'invalid-body',
+        headers = prepare_headers(version=version, https=False)
+    )
+
+    message = as_tm(version).get_message_from_xml(response.data)
+    assert message.status_type == ST_BAD_MESSAGE
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_streamed_inbox_message_too_large(client, version):
+
+    request = make_inbox_message(version, 1, content='x' * STREAM_MAX_BODY_SIZE)
+
+    response = client.post(
+        INBOX_STREAMING['address'],
+        data = request.to_xml(),
+        headers = prepare_headers(version=version, https=False)
+    )
+
+    message = as_tm(version).get_message_from_xml(response.data)
+    assert message.status_type == ST_FAILURE
+
+    assert len(client.application.taxii.persistence.get_content_blocks(None)) == 0
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_inbox_rate_limited(client, version):
+
+    def send(blocks_amount):
+        response = client.post(
+            INBOX_LIMITED['address'],
+            data = make_inbox_message(version, blocks_amount).to_xml(),
+            headers = prepare_headers(version=version, https=False)
+        )
+        return as_tm(version).get_message_from_xml(response.data)
+
+    assert send(2).status_type == ST_SUCCESS
+
+    message = send(2)
+    assert message.status_type == ST_RETRY
+    assert message.in_response_to == MESSAGE_ID
+
+    if version == 11:
+        assert message.status_detail[SD_ESTIMATED_WAIT] == 1
+
+    assert len(client.application.taxii.persistence.get_content_blocks(None)) == 2
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_streamed_inbox_rate_limited(client, version):
+
+    def send(blocks_amount):
+        response = client.post(
+            INBOX_STREAMING_LIMITED['address'],
+            data = make_inbox_message(version, blocks_amount).to_xml(),
+            headers = prepare_headers(version=version, https=False)
+        )
+        return as_tm(version).get_message_from_xml(response.data)
+
+    # The amount of blocks is not known upfront, so the message is accepted
+    assert send(7).status_type == ST_SUCCESS
+
+    message = send(1)
+    assert message.status_type == ST_RETRY
+    assert message.in_response_to == MESSAGE_ID
+
+    if version == 11:
+        assert message.status_detail[SD_ESTIMATED_WAIT] == 2
+
+    assert len(client.application.taxii.persistence.get_content_blocks(None)) == 7
+
+
+@pytest.mark.parametrize("version", [11, 10])
+def test_streamed_poll_response(client, version):
+
+    persistence = client.application.taxii.persistence
+
+    collection = persistence.create_collection(entities.CollectionEntity(
+        name='streamed', accept_all_content=True))
+    persistence.attach_collection_to_services(collection.id, services_ids=['pollStream'])
+
+    blocks_amount = 5
+    blocks = [entities.ContentBlockEntity(
+        content = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="p-%d"/>' % i,
+        timestamp_label = get_utc_now(),
+        content_binding = entities.ContentBindingEntity(CB_STIX_XML_111)
+    ) for i in range(blocks_amount)]
+
+    persistence.create_content_blocks(blocks, collections=[[collection]] * blocks_amount)
+
+    tm = as_tm(version)
+    if version == 11:
+        request = tm.PollRequest(message_id=MESSAGE_ID, collection_name='streamed',
+                poll_parameters=tm.PollParameters())
+    else:
+        request = tm.PollRequest(message_id=MESSAGE_ID, feed_name='streamed')
+
+    response = client.post(
+        POLL_STREAMING['address'],
+        data = request.to_xml(),
+        headers = prepare_headers(version=version, https=False)
+    )
+
+    assert response.status_code == 200
+    assert response.is_streamed
+
+    message = tm.get_message_from_xml(response.data)
+
+    assert message.in_response_to == MESSAGE_ID
+    assert all('p-%d' % i in b.content for i, b in enumerate(message.content_blocks))
+
+    assert len(message.content_blocks) == POLL_STREAMING['max_result_size']
+
+    if version == 10:
+        return
+
+    assert message.more is True
+    assert message.record_count.record_count == blocks_amount
+
+    request = tm.PollFulfillmentRequest(message_id=MESSAGE_ID, collection_name='streamed',
+            result_id=message.result_id, result_part_number=2)
+
+    response = client.post(
+        POLL_STREAMING['address'],
+        data = request.to_xml(),
+        headers = prepare_headers(version=version, https=False)
+    )
+
+    message = tm.get_message_from_xml(response.data)
+
+    assert len(message.content_blocks) == blocks_amount - POLL_STREAMING['max_result_size']
+    assert 'p-3' in message.content_blocks[0].content
+    assert not message.more
@@ -0,0 +1,86 @@
+import json
+import pytest
+import tarfile
+
+from opentaxii.loader import ContentLoader, iter_records, NDJSON
+from opentaxii.persistence import PersistenceManager
+from opentaxii.persistence.sqldb import SQLDatabaseAPI
+
+from fixtures import *
+
+PACKAGE = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="%s"/>'
+
+
+@pytest.fixture()
+def manager():
+    api = SQLDatabaseAPI('sqlite://', create_tables=True)
+    return PersistenceManager(api=api)
+
+
+@pytest.fixture()
+def inputs(tmpdir):
+
+    directory = tmpdir.mkdir('packages')
+    for i in range(3):
+        directory.join('package-%d.xml' % i).write(PACKAGE % i)
+    directory.join('readme.txt').write('not a package')
+
+    records = tmpdir.join('records.ndjson')
+    records.write('\n'.join([
+        json.dumps(dict(content=PACKAGE % 'ndjson-1', binding=CUSTOM_CONTENT_BINDING,
+            timestamp='2015-01-01T00:00:00Z')),
+        json.dumps(dict(content='<not-closed>')),
+        json.dumps(dict(content=PACKAGE % 'ndjson-2')),
+    ]))
+
+    archive = tmpdir.join('archive.tar.gz')
+    with tarfile.open(str(archive), 'w:gz') as tar:
+        tar.add(str(directory), arcname='packages')
+
+    return [str(directory), str(records), str(archive)]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_load_content(manager, inputs, tmpdir, workers):
+
+    collection = manager.create_collection(COLLECTIONS_B[0])
+    checkpoint = str(tmpdir.join('checkpoint.json'))
+
+    loader = ContentLoader(manager, [collection], workers=workers, batch_size=2,
+            checkpoint=checkpoint)
+
+    assert loader.load(inputs) == (8, 1)
+
+    blocks = manager.get_content_blocks(collection.id, limit=100)
+    assert len(blocks) == 8
+
+    custom = [b for b in blocks if b.content_binding.binding == CUSTOM_CONTENT_BINDING]
+    assert len(custom) == 1
+    assert custom[0].timestamp_label.year == 2015
+
+    # Loaded records are skipped when the load is resumed
+    loader = ContentLoader(manager, [collection], checkpoint=checkpoint)
+    assert loader.load(inputs) == (0, 0)
+
+    assert manager.get_content_blocks_count(collection.id) == 8
+
+
+def test_iter_records_ndjson_lines(tmpdir):
+
+    records = tmpdir.join('records.ndjson')
+    records.write('{"content": "a"}\r\n\r\n{"content": "b"}\n{"content": "c"}')
+
+    parsed = [(kind, json.loads(data)['content']) for kind, data, _ in
+            iter_records(str(records))]
+
+    assert parsed == [(NDJSON, 'a'), (NDJSON, 'b'), (NDJSON, 'c')]
+
+
+@pytest.mark.parametrize("index", [0, 1, 2])
+def test_iter_records_resumed(inputs, index):
+
+    path = inputs[index]
+    records = list(iter_records(path))
+
+    for i, (_, _, position) in enumerate(records):
+        assert list(iter_records(path, start=position)) == records[i + 1:]
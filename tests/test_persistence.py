@@ -0,0 +1,335 @@
+import pytest
+import pytz
+
+from datetime import datetime, timedelta
+from blinker import signal
+from sqlalchemy.engine import reflection
+
+from opentaxii.persistence import PersistenceManager
+from opentaxii.persistence.sqldb import SQLDatabaseAPI
+from opentaxii.signals import POST_SAVE_CONTENT_BLOCK
+from opentaxii.taxii import entities
+from opentaxii.taxii.utils import get_utc_now
+
+from fixtures import *
+
+
+@pytest.fixture()
+def manager():
+    api = SQLDatabaseAPI('sqlite://', create_tables=True)
+    return PersistenceManager(api=api)
+
+
+def make_block(binding=CB_STIX_XML_111, subtypes=[]):
+    return entities.ContentBlockEntity(
+        content = CONTENT,
+        timestamp_label = get_utc_now(),
+        message = MESSAGE,
+        content_binding = entities.ContentBindingEntity(binding, subtypes=subtypes)
+    )
+
+
+def test_create_content_blocks(manager):
+
+    coll_a, coll_b = [manager.create_collection(c) for c in COLLECTIONS_B[:2]]
+
+    saved = []
+    def on_save(sender, content_block=None, collection_ids=None):
+        saved.append((content_block.id, collection_ids))
+
+    signal(POST_SAVE_CONTENT_BLOCK).connect(on_save, weak=False)
+    try:
+        blocks = manager.create_content_blocks(
+            [make_block(), make_block(subtypes=[CONTENT_BINDING_SUBTYPE]), make_block()],
+            collections=[[coll_a], [coll_a, coll_b], []]
+        )
+    finally:
+        signal(POST_SAVE_CONTENT_BLOCK).disconnect(on_save)
+
+    assert all(b.id for b in blocks)
+    assert len(set(b.id for b in blocks)) == 3
+
+    assert saved == [
+        (blocks[0].id, [coll_a.id]),
+        (blocks[1].id, [coll_a.id, coll_b.id]),
+        (blocks[2].id, [])
+    ]
+
+    assert manager.get_content_blocks_count(coll_a.id) == 2
+    assert manager.get_content_blocks_count(coll_b.id) == 1
+
+    stored = manager.get_content_blocks(coll_b.id)[0]
+    assert stored.content == CONTENT
+    assert stored.message == MESSAGE
+    assert stored.content_binding.subtypes == [CONTENT_BINDING_SUBTYPE]
+
+
+def test_content_payloads_deduplicated(manager):
+
+    coll_a, coll_b = [manager.create_collection(c) for c in COLLECTIONS_B[:2]]
+
+    manager.create_content_blocks([make_block(), make_block()],
+            collections=[[coll_a], [coll_b]])
+    manager.create_content(make_block(), collections=[coll_b])
+
+    api = manager.api
+    assert api.ContentPayload.query.count() == 1
+    assert api.ContentBlock.query.count() == 3
+
+    for collection in (coll_a, coll_b):
+        blocks = manager.get_content_blocks(collection.id)
+        assert all(b.content == CONTENT for b in blocks)
+
+
+def test_deduplicate_content(manager):
+
+    api = manager.api
+    s = api.Session()
+
+    for content in [CONTENT, CONTENT, 'other-content']:
+        s.add(api.ContentBlock(content=content, binding_id=CB_STIX_XML_111))
+    s.commit()
+
+    assert manager.deduplicate_content(batch_size=2) == 3
+
+    assert api.ContentPayload.query.count() == 2
+    assert api.ContentBlock.query.filter(api.ContentBlock.content != None).count() == 0
+
+    contents = sorted(b.content for b in manager.get_content_blocks(None))
+    assert contents == sorted([CONTENT, CONTENT, 'other-content'])
+
+    # Nothing left to deduplicate
+    assert manager.deduplicate_content() == 0
+
+
+def test_content_compressed(manager):
+
+    coll_plain = manager.create_collection(COLLECTIONS_B[0])
+    coll_zlib = manager.create_collection(entities.CollectionEntity(
+        name='compressed', accept_all_content=True, compress_content=True))
+
+    large = make_block()
+    large.content = CONTENT * 100
+
+    manager.create_content_blocks([large, make_block()],
+            collections=[[coll_zlib], [coll_zlib]])
+    manager.create_content(make_block(), collections=[coll_plain])
+
+    api = manager.api
+    compressed = api.ContentPayload.query.filter(
+            api.ContentPayload.compressed_content != None).all()
+
+    # Content below the minimal size is never compressed
+    assert len(compressed) == 1
+    assert compressed[0].content == ''
+    assert len(compressed[0].compressed_content) < len(large.content)
+
+    contents = sorted(b.content for b in manager.get_content_blocks(coll_zlib.id))
+    assert contents == sorted([CONTENT, CONTENT * 100])
+
+
+def test_compress_content(manager):
+
+    collection = manager.create_collection(COLLECTIONS_B[0])
+
+    large = make_block()
+    large.content = CONTENT * 100
+    manager.create_content_blocks([large, make_block()],
+            collections=[[collection], [collection]])
+
+    assert manager.compress_content() == 0
+
+    collection.compress_content = True
+    manager.api.update_collection(collection)
+
+    assert manager.compress_content(batch_size=1) == 1
+    assert manager.compress_content() == 0
+
+    contents = sorted(b.content for b in manager.get_content_blocks(collection.id))
+    assert contents == sorted([CONTENT, CONTENT * 100])
+
+
+def test_content_blocks_filtered_by_subtype(manager):
+
+    collection = manager.create_collection(COLLECTIONS_B[0])
+
+    manager.create_content_blocks(
+        [make_block(), make_block(subtypes=[CONTENT_BINDING_SUBTYPE]),
+            make_block(CUSTOM_CONTENT_BINDING, subtypes=[CONTENT_BINDING_SUBTYPE])],
+        collections=[[collection]] * 3)
+
+    bindings = [entities.ContentBindingEntity(CB_STIX_XML_111,
+        subtypes=[CONTENT_BINDING_SUBTYPE])]
+
+    assert manager.get_content_blocks_count(collection.id, bindings=bindings) == 1
+    assert len(manager.get_content_blocks(collection.id, bindings=bindings)) == 1
+
+
+def test_upgrade_tables_creates_indexes(manager):
+
+    api = manager.api
+    api.engine.execute('DROP INDEX ix_collection_to_content_block_block')
+    api.engine.execute('DROP INDEX ix_content_blocks_binding')
+
+    manager.upgrade_tables(online=True)
+
+    inspector = reflection.Inspector.from_engine(api.engine)
+
+    assert 'ix_collection_to_content_block_block' in \
+            [i['name'] for i in inspector.get_indexes('collection_to_content_block')]
+    assert 'ix_content_blocks_binding' in \
+            [i['name'] for i in inspector.get_indexes('content_blocks')]
+
+    collection = manager.create_collection(COLLECTIONS_B[0])
+    plans = dict(manager.explain_content_queries(collection.id))
+
+    assert sorted(plans) == ['count', 'page', 'seek']
+    assert 'ix_collection_to_content_block_block' in '\n'.join(plans['count'])
+
+
+def test_timeline_backfilled(manager):
+
+    api = manager.api
+    coll_a, coll_b = [manager.create_collection(c) for c in COLLECTIONS_B[:2]]
+
+    blocks = manager.create_content_blocks([make_block() for _ in range(5)],
+            collections=[[coll_a, coll_b]] * 3 + [[coll_a]] * 2)
+
+    api.attach_content_to_collections(blocks[3], [coll_b.id])
+
+    timeline = api.CollectionTimeline.__table__
+    entries = api.engine.execute(timeline.select()).fetchall()
+    assert len(entries) == 9
+
+    # Content attached before the timeline existed
+    api.engine.execute(timeline.delete().where(timeline.c.content_block_id != blocks[1].id))
+
+    assert manager.backfill_timeline(batch_size=2) == 7
+    assert manager.backfill_timeline() == 0
+
+    assert sorted(api.engine.execute(timeline.select()).fetchall()) == sorted(entries)
+
+    api.use_timeline = True
+
+    for collection in [coll_a, coll_b]:
+        expected = [b.id for b in blocks[:4]] if collection == coll_b \
+                else [b.id for b in blocks]
+        assert manager.get_content_blocks_count(collection.id) == len(expected)
+        assert sorted(b.id for b in manager.get_content_blocks(collection.id)) \
+                == sorted(expected)
+
+        # Seek pages read the timeline
+        first = manager.get_content_blocks(collection.id, limit=2)
+        rest = manager.get_content_blocks(collection.id, limit=10,
+                after=(first[-1].date_created, first[-1].id))
+        assert [b.id for b in first + rest] == \
+                [b.id for b in manager.get_content_blocks(collection.id, limit=10)]
+
+
+def test_statistics_counts(manager):
+
+    api = manager.api
+    coll_a, coll_b = [manager.create_collection(c) for c in COLLECTIONS_B[:2]]
+
+    blocks = manager.create_content_blocks(
+        [make_block(subtypes=[CONTENT_BINDING_SUBTYPE] if i % 3 else [])
+            for i in range(8)],
+        collections=[[coll_a, coll_b]] * 4 + [[coll_a]] * 4)
+
+    api.attach_content_to_collections(blocks[4], [coll_b.id])
+
+    # Spread content over several hours
+    now = datetime.utcnow().replace(microsecond=0)
+    table = api.ContentBlock.__table__
+    for i, block in enumerate(blocks):
+        api.engine.execute(table.update().where(table.c.id == block.id)
+                .values(date_created=now - timedelta(minutes=40 * i)))
+
+    assert manager.rebuild_statistics(batch_size=3) == 13
+
+    bindings = [entities.ContentBindingEntity(CB_STIX_XML_111,
+        subtypes=[CONTENT_BINDING_SUBTYPE])]
+    utc = lambda d: d.replace(tzinfo=pytz.UTC)
+
+    timeframes = [
+        (None, None),
+        (utc(now - timedelta(minutes=150)), None),
+        (None, utc(now - timedelta(minutes=100))),
+        (utc(now - timedelta(minutes=250)), utc(now - timedelta(minutes=30))),
+        (utc(now - timedelta(minutes=85)), utc(now - timedelta(minutes=75))),
+    ]
+
+    for collection in [coll_a, coll_b]:
+        for start_time, end_time in timeframes:
+            for filters in [[], bindings]:
+                args = dict(start_time=start_time, end_time=end_time, bindings=filters)
+
+                api.use_statistics = False
+                expected = manager.get_content_blocks_count(collection.id, **args)
+
+                api.use_statistics = True
+                assert manager.get_content_blocks_count(collection.id, **args) == expected
+
+    api.use_statistics = True
+    assert manager.get_content_blocks_count(coll_a.id) == 8
+    assert manager.get_content_blocks_count(coll_b.id) == 5
+
+    # Counted when content is attached
+    manager.create_content_blocks([make_block()], collections=[[coll_b]])
+    assert manager.get_content_blocks_count(coll_b.id) == 6
+
+
+def test_content_blocks_not_kept_in_session(manager):
+
+    api = manager.api
+    collection = manager.create_collection(entities.CollectionEntity(
+        name='compressed', accept_all_content=True, compress_content=True))
+
+    large = make_block()
+    large.content = CONTENT * 100
+
+    manager.create_content_blocks([large, make_block()],
+            collections=[[collection]] * 2)
+
+    # Content stored inline before deduplication
+    inline = manager.create_content(make_block(), collections=[collection])
+    table = api.ContentBlock.__table__
+    api.engine.execute(table.update().where(table.c.id == inline.id)
+            .values(payload_id=None, content=CONTENT * 2))
+
+    expected = [CONTENT * 100, CONTENT, CONTENT * 2]
+
+    assert [b.content for b in manager.get_content_blocks(collection.id)] == expected
+    assert [b.content for b in manager.iter_content_blocks(collection.id,
+        batch_size=1)] == expected
+
+    session = api.Session()
+    assert not [o for o in session if isinstance(o, (api.ContentBlock, api.ContentPayload))]
+
+
+def test_create_tables_upgrades_schema(tmpdir):
+
+    connection = 'sqlite:///%s' % tmpdir.join('data.db')
+
+    api = SQLDatabaseAPI(connection, create_tables=True)
+
+    # Schema of a deployment older than the inbox message columns
+    api.engine.execute('CREATE TABLE inbox_messages_old AS SELECT id, message_id, '
+            'original_message, content_block_count, service_id FROM inbox_messages')
+    api.engine.execute('DROP TABLE inbox_messages')
+    api.engine.execute('ALTER TABLE inbox_messages_old RENAME TO inbox_messages')
+    api.engine.execute('DROP INDEX ix_content_blocks_binding')
+
+    api = SQLDatabaseAPI(connection, create_tables=True)
+    inspector = reflection.Inspector.from_engine(api.engine)
+
+    columns = [c['name'] for c in inspector.get_columns('inbox_messages')]
+    assert 'idempotency_key' in columns
+    assert 'completed' in columns
+
+    assert [i['name'] for i in inspector.get_indexes('inbox_messages')] == \
+            ['ix_inbox_messages_idempotency_key']
+
+    # Indexes only needed for performance are left to upgrade_tables
+    assert 'ix_content_blocks_binding' not in \
+            [i['name'] for i in inspector.get_indexes('content_blocks')]
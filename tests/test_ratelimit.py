@@ -0,0 +1,59 @@
+import time
+import pytest
+
+from libtaxii.constants import ST_RETRY, SD_ESTIMATED_WAIT
+
+from opentaxii.ratelimit import RateLimiter
+from opentaxii.taxii.exceptions import StatusMessageException
+
+
+def test_rate_limiter_requests():
+
+    limiter = RateLimiter(dict(requests=2))
+
+    limiter.acquire('key', requests=1)
+    limiter.acquire('key', requests=1)
+
+    with pytest.raises(StatusMessageException) as e:
+        limiter.acquire('key', requests=1)
+
+    assert e.value.status_type == ST_RETRY
+    assert e.value.status_details == {SD_ESTIMATED_WAIT: 1}
+
+    # Buckets are kept per key
+    limiter.acquire('other-key', requests=1)
+
+
+def test_rate_limiter_debt():
+
+    limiter = RateLimiter(dict(blocks=10, bytes=100))
+
+    # Amount bigger than the bucket is granted from a full bucket
+    limiter.acquire('key', blocks=15)
+
+    with pytest.raises(StatusMessageException):
+        limiter.acquire('key', blocks=1, bytes=50)
+
+    # Failed acquire does not take tokens from other buckets
+    limiter.acquire('key', bytes=100)
+
+    limiter.charge('key', bytes=100)
+    with pytest.raises(StatusMessageException) as e:
+        limiter.acquire('key', bytes=1)
+    assert e.value.status_details[SD_ESTIMATED_WAIT] == 2
+
+
+def test_rate_limiter_shared_store(tmpdir):
+
+    store = str(tmpdir.join('buckets.db'))
+
+    first = RateLimiter(dict(requests=1), store=store)
+    second = RateLimiter(dict(requests=1), store=store)
+
+    first.acquire('key', requests=1)
+
+    with pytest.raises(StatusMessageException):
+        second.acquire('key', requests=1)
+
+    time.sleep(1)
+    second.acquire('key', requests=1)
@@ -0,0 +1,175 @@
+import pytest
+
+from datetime import datetime
+
+import pytz
+
+import libtaxii.messages_10 as tm10
+import libtaxii.messages_11 as tm11
+import libtaxii.taxii_default_query as tdq
+from libtaxii.constants import (
+    VID_TAXII_XML_10, VID_TAXII_XML_11, ST_SUCCESS, ST_FAILURE, ST_PENDING,
+    SD_ESTIMATED_WAIT, SD_RESULT_ID, SD_WILL_PUSH, SD_SUPPORTED_CONTENT,
+    ST_UNSUPPORTED_CONTENT_BINDING, SVC_INBOX, SVC_POLL, VID_TAXII_SERVICES_10,
+    VID_TAXII_SERVICES_11, VID_TAXII_HTTP_10, CB_STIX_XML_111, CM_CORE
+)
+
+from opentaxii.taxii.bindings import MESSAGE_VALIDATOR_PARSER
+from opentaxii.taxii.entities import ContentBlockEntity, ContentBindingEntity
+from opentaxii.taxii.converters import content_block_entity_to_content_block
+from opentaxii.taxii.serialization import (
+    message_to_xml, iter_message_xml, serialize_content_block
+)
+
+TIMESTAMP = datetime(2015, 3, 16, 12, 30, 15, 12, tzinfo=pytz.UTC)
+
+STIX_PACKAGE = '<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="example:Package-1"/>'
+
+CONTENTS = [
+    STIX_PACKAGE,
+    '<?xml version="1.0" encoding="UTF-8"?>\n' + STIX_PACKAGE,
+    u'<a xmlns="urn:example">caf\xe9 &amp; "more"</a>',
+    'plain text & <not xml',
+    '<not xml & stuff',
+]
+
+MESSAGE = u'Message with <markup> & "quotes"\nand caf\xe9'
+
+
+def get_blocks(version):
+    blocks = []
+    for content in CONTENTS:
+        entity = ContentBlockEntity(content=content, timestamp_label=TIMESTAMP,
+                message=MESSAGE, content_binding=ContentBindingEntity(CB_STIX_XML_111,
+                    subtypes=['urn:example:subtype']))
+
+        # Stored content and content parsed by libtaxii
+        blocks.append(content_block_entity_to_content_block(entity, version))
+        if version == 10:
+            blocks.append(tm10.ContentBlock(CB_STIX_XML_111, content, timestamp_label=TIMESTAMP))
+        else:
+            blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111), content,
+                message=MESSAGE))
+    return blocks
+
+
+def get_messages_10():
+
+    service = tm10.ServiceInstance(SVC_INBOX, VID_TAXII_SERVICES_10, VID_TAXII_HTTP_10,
+            'http://example.com/inbox', [VID_TAXII_XML_10],
+            inbox_service_accepted_content=[CB_STIX_XML_111], available=True,
+            message=MESSAGE)
+
+    return [
+        tm10.PollResponse(message_id='1', in_response_to='2', feed_name='feed',
+            inclusive_end_timestamp_label=TIMESTAMP, content_blocks=get_blocks(10)),
+        tm10.PollResponse(message_id='1', in_response_to='2', feed_name='feed',
+            subscription_id='s-1', message=MESSAGE,
+            inclusive_begin_timestamp_label=TIMESTAMP,
+            inclusive_end_timestamp_label=TIMESTAMP),
+        tm10.StatusMessage(message_id='1', in_response_to='2', status_type=ST_SUCCESS),
+        tm10.StatusMessage(message_id='1', in_response_to='2', status_type=ST_FAILURE,
+            status_detail='detail & more', message=MESSAGE),
+        tm10.DiscoveryResponse(message_id='1', in_response_to='2',
+            service_instances=[service]),
+        tm10.DiscoveryResponse(message_id='1', in_response_to='2'),
+    ]
+
+
+def get_messages_11():
+
+    query_info = tdq.DefaultQueryInfo([tdq.DefaultQueryInfo.TargetingExpressionInfo(
+        CB_STIX_XML_111, preferred_scope=['**/@id'])], [CM_CORE])
+
+    services = [
+        tm11.ServiceInstance(SVC_INBOX, VID_TAXII_SERVICES_11, VID_TAXII_HTTP_10,
+            'http://example.com/inbox', [VID_TAXII_XML_11], available=True,
+            inbox_service_accepted_content=[tm11.ContentBinding(CB_STIX_XML_111,
+                subtype_ids=['urn:example:subtype'])], message=MESSAGE),
+        tm11.ServiceInstance(SVC_POLL, VID_TAXII_SERVICES_11, VID_TAXII_HTTP_10,
+            'http://example.com/poll', [VID_TAXII_XML_11],
+            supported_query=[query_info]),
+    ]
+
+    return [
+        tm11.PollResponse(message_id='1', in_response_to='2', collection_name='collection',
+            content_blocks=get_blocks(11)),
+        tm11.PollResponse(message_id='1', in_response_to='2', collection_name='collection',
+            more=True, result_id='r-1', result_part_number=2, subscription_id='s-1',
+            exclusive_begin_timestamp_label=TIMESTAMP,
+            inclusive_end_timestamp_label=TIMESTAMP,
+            record_count=tm11.RecordCount(10, True), message=MESSAGE,
+            content_blocks=get_blocks(11)[:2]),
+        tm11.StatusMessage(message_id='1', in_response_to='2', status_type=ST_SUCCESS),
+        tm11.StatusMessage(message_id='1', in_response_to='2', status_type=ST_PENDING,
+            status_detail={SD_ESTIMATED_WAIT: 300, SD_RESULT_ID: 'r-1', SD_WILL_PUSH: False},
+            message=MESSAGE),
+        tm11.StatusMessage(message_id='1', in_response_to='2',
+            status_type=ST_UNSUPPORTED_CONTENT_BINDING,
+            status_detail={SD_SUPPORTED_CONTENT: [tm11.ContentBinding(CB_STIX_XML_111),
+                tm11.ContentBinding('urn:example')]}),
+        tm11.StatusMessage(message_id='1', in_response_to='2', status_type=ST_FAILURE,
+            extended_headers={'header': 'value'}),
+        tm11.DiscoveryResponse(message_id='1', in_response_to='2',
+            service_instances=services),
+    ]
+
+
+MESSAGES = [(VID_TAXII_XML_10, tm10, m) for m in get_messages_10()] + \
+        [(VID_TAXII_XML_11, tm11, m) for m in get_messages_11()]
+
+
+@pytest.mark.parametrize("pretty_print", [False, True])
+@pytest.mark.parametrize(("version", "module", "message"), MESSAGES)
+def test_serialization_conformance(version, module, message, pretty_print):
+
+    xml = message_to_xml(message, pretty_print=pretty_print)
+
+    result = MESSAGE_VALIDATOR_PARSER[version].validator.validate_string(xml)
+    assert result.valid, result.errors
+
+    expected = module.get_message_from_xml(message.to_xml(pretty_print=pretty_print))
+    assert module.get_message_from_xml(xml).to_dict() == expected.to_dict()
+
+
+def test_serialization_stored_content_spliced():
+
+    entity = ContentBlockEntity(content=CONTENTS[1], timestamp_label=TIMESTAMP,
+            content_binding=ContentBindingEntity(CB_STIX_XML_111))
+
+    message = tm11.PollResponse(message_id='1', in_response_to='2',
+            collection_name='collection',
+            content_blocks=[content_block_entity_to_content_block(entity, 11)])
+
+    xml = message_to_xml(message)
+
+    assert STIX_PACKAGE in xml
+    assert '<?xml' not in xml
+    assert message.content_blocks[0].stored_content == CONTENTS[1]
+
+
+def test_serialization_fragments():
+
+    blocks = get_blocks(11)
+
+    message = tm11.PollResponse(message_id='1', in_response_to='2',
+            collection_name='collection')
+
+    fragments = list(iter_message_xml(message, content_blocks=iter(blocks)))
+
+    # root start tag, one fragment per block and root end tag
+    assert len(fragments) == len(blocks) + 2
+    assert fragments[-1] == '</taxii_11:Poll_Response>'
+
+
+@pytest.mark.parametrize("pretty_print", [False, True])
+@pytest.mark.parametrize(("version", "module", "message"),
+        [m for m in MESSAGES if m[2].message_type == 'Poll_Response'])
+def test_serialization_serialized_blocks(version, module, message, pretty_print):
+
+    blocks = [serialize_content_block(b, pretty_print) for b in message.content_blocks]
+
+    xml = ''.join(iter_message_xml(message, pretty_print=pretty_print,
+        content_blocks=blocks))
+
+    assert xml == message_to_xml(message, pretty_print=pretty_print)